@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# Dedicated to the public domain under CC0: https://creativecommons.org/publicdomain/zero/1.0/.
+
+'''
+Generate a synthetic corpus of writeup documents for benchmarking.
+The corpus mixes realistic documents with pathological ones:
+deep section trees, wide and deep lists, long text runs, many inline spans,
+and large code, CSV, SVG and nested writeup embeds.
+Generation is deterministic for a given scale and seed.
+'''
+
+from argparse import ArgumentParser
+from os import makedirs
+from os.path import join as path_join
+from random import Random
+from typing import Callable, Dict, List
+
+
+Corpus = Dict[str, str] # Maps relative paths to file contents.
+
+words = ('alpha', 'beta', 'gamma', 'delta', 'epsilon', 'writeup', 'section', 'list', 'render', 'quote', 'code', 'span')
+
+
+def main() -> None:
+  arg_parser = ArgumentParser(description='Generate a synthetic writeup corpus for benchmarking.')
+  arg_parser.add_argument('dir', help='Output directory.')
+  arg_parser.add_argument('-scale', type=int, default=1, help='Size multiplier for every document (default: 1).')
+  arg_parser.add_argument('-seed', type=int, default=0)
+  args = arg_parser.parse_args()
+  write_corpus(args.dir, generate(scale=args.scale, seed=args.seed))
+
+
+def write_corpus(dir: str, corpus: Corpus) -> None:
+  for rel_path, text in corpus.items():
+    path = path_join(dir, rel_path)
+    makedirs(path_join(dir, *rel_path.split('/')[:-1]), exist_ok=True)
+    with open(path, 'w') as f: f.write(text)
+
+
+def generate(scale=1, seed=0) -> Corpus:
+  'Return the corpus. Documents are at the top level with a `.wu` extension; embedded assets are under `assets/`.'
+  rand = Random(seed)
+  corpus: Corpus = {}
+  for name, gen in generators.items():
+    gen(corpus, name, rand, scale)
+  return corpus
+
+
+def sentence(rand: Random, n: int) -> str:
+  return ' '.join(rand.choice(words) for _ in range(n)).capitalize() + '.'
+
+
+def doc(*lines: str) -> str:
+  return 'writeup v0\n' + ''.join(line + '\n' for line in lines)
+
+
+def gen_text_runs(corpus: Corpus, name: str, rand: Random, scale: int) -> None:
+  'Long runs of plain text paragraphs: the common case.'
+  lines: List[str] = []
+  for s in range(20 * scale):
+    lines.extend([f'# Section {s}', ''])
+    for _ in range(10):
+      lines.extend(sentence(rand, 12) for _ in range(rand.randrange(1, 8)))
+      lines.append('')
+  corpus[f'{name}.wu'] = doc(*lines)
+
+
+def gen_deep_sections(corpus: Corpus, name: str, rand: Random, scale: int) -> None:
+  'A section tree six levels deep, with a short paragraph in each section.'
+  lines: List[str] = []
+  def tree(depth: int, fanout: int) -> None:
+    for i in range(fanout):
+      lines.extend(['#' * depth + f' Level {depth} {i}', sentence(rand, 6), ''])
+      if depth < 6: tree(depth + 1, 3 if depth > 1 else 2 * scale)
+  tree(1, 2 * scale)
+  corpus[f'{name}.wu'] = doc(*lines)
+
+
+def gen_lists(corpus: Corpus, name: str, rand: Random, scale: int) -> None:
+  'Wide lists with many items, and deep lists nested to twenty levels.'
+  lines: List[str] = ['# Wide', '']
+  lines.extend(f'* item {i}: {sentence(rand, 5)}' for i in range(2000 * scale))
+  lines.extend(['', '# Deep', ''])
+  for _ in range(50 * scale):
+    lines.extend('  ' * level + f'* level {level}' for level in range(20))
+    lines.append('')
+  corpus[f'{name}.wu'] = doc(*lines)
+
+
+def gen_spans(corpus: Corpus, name: str, rand: Random, scale: int) -> None:
+  'Lines dense with inline code, bold, links and escapes, plus adversarial lines with unclosed delimiters.'
+  lines: List[str] = []
+  for i in range(3000 * scale):
+    lines.append(f'Use `code {i}` with <b: bold {i}> and <https://example.com/{i} a link>; escaped `\\`tick\\``.')
+  lines.append('')
+  lines.extend('<' * 2000 + '`' * 1000 for _ in range(10 * scale))
+  corpus[f'{name}.wu'] = doc(*lines)
+
+
+def gen_embeds(corpus: Corpus, name: str, rand: Random, scale: int) -> None:
+  'Large code, CSV and SVG embeds, and writeup documents embedded two levels deep.'
+  corpus['assets/code.py'] = ''.join(
+    f'def fn_{i}(x: int, y: str = "s{i}") -> int:\n  # Comment {i}.\n  return x * {i} + len(y)\n\n' for i in range(1000 * scale))
+  corpus['assets/table.csv'] = 'id,name,value\n' + ''.join(f'{i},{rand.choice(words)},{rand.random():.6f}\n' for i in range(5000 * scale))
+  corpus['assets/figure.svg'] = ('<svg width="100" height="100" viewBox="0 0 100 100">\n'
+    + ''.join(f'  <circle cx="{rand.randrange(100)}" cy="{rand.randrange(100)}" r="2"/>\n' for _ in range(2000 * scale))
+    + '</svg>\n')
+  corpus['assets/inner.wu'] = doc(*[sentence(rand, 8) for _ in range(50)], '', '<embed: code.py>')
+  corpus['assets/outer.wu'] = doc('# Outer', sentence(rand, 8), '', '<embed: inner.wu>', '', '> <embed: inner.wu>')
+  corpus[f'{name}.wu'] = doc(
+    '# Code', '<embed: assets/code.py>', '',
+    '# Table', '<embed: assets/table.csv>', '',
+    '# Figure', '<embed: assets/figure.svg>', '',
+    '# Nested', '<embed: assets/outer.wu>')
+
+
+generators: Dict[str, Callable[[Corpus, str, Random, int], None]] = {
+  'text-runs': gen_text_runs,
+  'deep-sections': gen_deep_sections,
+  'lists': gen_lists,
+  'spans': gen_spans,
+  'embeds': gen_embeds,
+}
+
+
+if __name__ == '__main__': main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# Dedicated to the public domain under CC0: https://creativecommons.org/publicdomain/zero/1.0/.
+
+'''
+Benchmark line classification and parsing on a synthetic document of one million lines.
+Compares `classify_line` to the reference regex `line_re`, and reports the throughput of `parse`.
+'''
+
+import gc
+from argparse import ArgumentParser
+from random import Random
+from time import perf_counter
+from typing import Callable, List
+
+from writeup.v0 import Ctx, classify_line, line_groups_to_states, line_re, parse
+
+
+def synthetic_lines(count: int, seed=0) -> List[str]:
+  'A mix of sections, paragraphs, nested lists, code and quotes, weighted towards plain text like typical documents.'
+  rand = Random(seed)
+  lines = ['writeup v0\n', '\n']
+  section = 0
+  while len(lines) < count:
+    r = rand.random()
+    if r < 0.02:
+      section += 1
+      lines.extend([f'# Section {section}\n', '\n'])
+    elif r < 0.6:
+      lines.extend(f'Some plain text with words and more words, line {len(lines)}.\n' for _ in range(rand.randrange(1, 5)))
+      lines.append('\n')
+    elif r < 0.75:
+      lines.extend('* item with `code` here.\n' for _ in range(rand.randrange(1, 4)))
+      lines.extend(['  * nested item.\n', '\n'])
+    elif r < 0.9:
+      lines.extend(f'| code line = {len(lines)}\n' for _ in range(rand.randrange(1, 6)))
+      lines.append('\n')
+    else:
+      lines.extend(['> quoted text.\n', '\n'])
+  return lines
+
+
+def best_time(fn: Callable[[], object], reps: int) -> float:
+  best = float('inf')
+  for _ in range(reps):
+    start = perf_counter()
+    fn()
+    best = min(best, perf_counter() - start)
+  return best
+
+
+def main() -> None:
+  arg_parser = ArgumentParser(description=__doc__)
+  arg_parser.add_argument('-lines', type=int, default=1_000_000)
+  arg_parser.add_argument('-reps', type=int, default=3)
+  args = arg_parser.parse_args()
+
+  lines = synthetic_lines(args.lines)
+  stripped = [line.rstrip('\n') for line in lines]
+  gc.disable() # As in the command line tool.
+
+  def classify_re() -> None:
+    for line in stripped:
+      m = line_re.fullmatch(line)
+      assert m is not None
+      line_groups_to_states[m.lastgroup]
+
+  def classify() -> None:
+    for line in stripped: classify_line(line)
+
+  def parse_doc() -> None:
+    parse(Ctx(src_path='synthetic.wu', should_embed=True), enumerate(lines))
+
+  n = len(lines)
+  for name, fn in [('line_re', classify_re), ('classify_line', classify), ('parse', parse_doc)]:
+    t = best_time(fn, args.reps)
+    print(f'{name:>14}: {t:6.2f} s; {n / t / 1e3:8.0f} klines/s')
+
+
+if __name__ == '__main__': main()
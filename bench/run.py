@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# Dedicated to the public domain under CC0: https://creativecommons.org/publicdomain/zero/1.0/.
+
+'''
+Time the phases of writeup on the synthetic corpus and write the results as JSON.
+Phases are timed separately for each document: `parse` (without embedding), `emit_html` and the full `writeup` call;
+`embed_code` and `minify_css` are timed on their own inputs.
+Each measurement is the best of several repetitions.
+With `-compare`, exit with status 1 if any phase is slower than in the baseline results by more than the threshold.
+'''
+
+import gc
+import json
+import sys
+from argparse import ArgumentParser
+from os.path import join as path_join
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Any, Callable, Dict, List
+
+from corpus import generate, write_corpus # type: ignore
+from writeup.v0 import Ctx, Env, default_css, embed_code, minify_css, parse, writeup
+
+
+Results = Dict[str, float] # Maps `document/phase` to seconds.
+
+
+def main() -> None:
+  arg_parser = ArgumentParser(description='Benchmark writeup phases on a synthetic corpus.')
+  arg_parser.add_argument('-scale', type=int, default=1, help='Corpus size multiplier (default: 1).')
+  arg_parser.add_argument('-reps', type=int, default=5, help='Repetitions per measurement; the best is reported (default: 5).')
+  arg_parser.add_argument('-out', help='Write the results to this JSON file (default: stdout).')
+  arg_parser.add_argument('-compare', help='Baseline JSON results to compare against.')
+  arg_parser.add_argument('-threshold', type=float, default=0.2,
+    help='Relative slowdown of a phase that counts as a regression (default: 0.2).')
+  arg_parser.add_argument('-min-delta', type=float, default=1.0,
+    help='Ignore slowdowns smaller than this many milliseconds, which are within timer noise (default: 1).')
+  args = arg_parser.parse_args()
+
+  gc.disable() # As in the command line tool; also reduces noise.
+  with TemporaryDirectory(prefix='writeup-bench-') as dir:
+    corpus = generate(scale=args.scale)
+    write_corpus(dir, corpus)
+    docs = sorted(p for p in corpus if '/' not in p)
+    results = run(dir, docs, corpus, reps=args.reps)
+
+  report = { 'python': sys.version.split()[0], 'scale': args.scale, 'reps': args.reps, 'results': results }
+  text = json.dumps(report, indent=2, sort_keys=True) + '\n'
+  if args.out:
+    with open(args.out, 'w') as f: f.write(text)
+  else:
+    print(text, end='')
+
+  if args.compare:
+    with open(args.compare) as f: baseline = json.load(f)
+    exit(compare(baseline['results'], results, threshold=args.threshold, min_delta=args.min_delta / 1e3))
+
+
+def run(dir: str, docs: List[str], corpus: Dict[str, str], reps: int) -> Results:
+  results: Results = {}
+
+  def measure(key: str, fn: Callable[[], Any]) -> None:
+    best = float('inf')
+    for _ in range(reps):
+      start = perf_counter()
+      fn()
+      best = min(best, perf_counter() - start)
+    results[key] = best
+    print(f'{key:>32}: {best*1e3:10.3f} ms', file=sys.stderr)
+
+  for doc in docs:
+    path = path_join(dir, doc)
+    lines = list(enumerate(corpus[doc].splitlines(keepends=True)))
+
+    def parse_doc() -> Ctx:
+      ctx = Ctx(src_path=path, should_embed=False)
+      parse(ctx, lines)
+      return ctx
+
+    def parsed_with_embeds() -> Ctx:
+      ctx = Ctx(src_path=path, should_embed=True, env=Env())
+      parse(ctx, lines)
+      ctx.resolve_embeds()
+      return ctx
+
+    ctx = parsed_with_embeds()
+    measure(f'{doc}/parse', parse_doc)
+    measure(f'{doc}/emit_html', lambda: sum(1 for _ in ctx.emit_html(depth=0)))
+    measure(f'{doc}/writeup', lambda: sum(1 for _ in writeup(src_path=path, src_lines=lines, title=doc, description='', author='',
+      css_lines=iter(()), js=None, emit_doc=True, target_section=None, emit_dbg=False, env=Env())))
+
+  code_path = path_join(dir, 'assets/code.py')
+  def embed_code_file() -> None:
+    with open(code_path) as f: embed_code(Ctx(src_path=code_path, should_embed=True), f)
+  measure('assets/code.py/embed_code', embed_code_file)
+
+  css_blocks = [default_css, *(synthetic_css(n) for n in range(200))]
+  measure('css/minify_css', lambda: list(minify_css(css_blocks)))
+  return results
+
+
+def synthetic_css(n: int) -> str:
+  return f'''
+/* Rule set {n}. */
+.class-{n} > p, .class-{n} li {{
+  color: #{n:06x};
+  margin: {n % 7}px  {n % 5}px;
+}}
+'''
+
+
+def compare(baseline: Results, results: Results, threshold: float, min_delta: float) -> int:
+  'Print the relative change of each phase; return 1 if any phase regressed past the threshold.'
+  status = 0
+  for key in sorted(results):
+    if key not in baseline: continue
+    change = results[key] / baseline[key] - 1
+    regressed = change > threshold and results[key] - baseline[key] > min_delta
+    if regressed: status = 1
+    print(f'{key:>32}: {change:+7.1%}{"  REGRESSION" if regressed else ""}', file=sys.stderr)
+  return status
+
+
+if __name__ == '__main__': main()
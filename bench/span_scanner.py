@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# Dedicated to the public domain under CC0: https://creativecommons.org/publicdomain/zero/1.0/.
+
+'''
+Benchmark span scanning on adversarial lines, comparing `scan_spans` to the reference regex `span_re`.
+For each input family, the line length doubles at each step; a linear scanner's time should roughly double too.
+Exits with status 1 if the scanner's time over the whole size range grows super-linearly.
+'''
+
+from sys import exit
+from time import perf_counter
+from typing import Callable, Dict
+
+from writeup.v0 import scan_spans, span_re
+
+
+families: Dict[str, Callable[[int], str]] = {
+  'open angles': lambda n: '<' * n,
+  'open backticks with escapes': lambda n: '`' + '\\`' * (n // 2),
+  'alternating openers': lambda n: '<`' * (n // 2),
+  'escaped closers': lambda n: '<' + '\\>' * (n // 2),
+  'prose with spans': lambda n: 'word <b: bold> `code` ' * (n // 22),
+}
+
+sizes = [1 << k for k in range(10, 16)]
+max_growth = 2.0 # Allowed ratio of the growth in time to the growth in size, over the whole range.
+regex_time_limit = 0.5 # The regex is quadratic on most families; stop timing it once a single run exceeds this.
+
+
+def best_time(fn: Callable[[], object], reps=3) -> float:
+  best = float('inf')
+  for _ in range(reps):
+    start = perf_counter()
+    fn()
+    best = min(best, perf_counter() - start)
+  return best
+
+
+def main() -> None:
+  failed = False
+  for name, make in families.items():
+    print(f'{name}:')
+    prev = None
+    first = 0.0
+    t_regex = 0.0
+    for n in sizes:
+      text = make(n)
+      t_scan = best_time(lambda: list(scan_spans(text)))
+      if t_regex < regex_time_limit:
+        t_regex = best_time(lambda: list(span_re.finditer(text)), reps=1)
+        regex_str = f'{t_regex*1e3:9.3f} ms'
+      else: regex_str = '  skipped'
+      growth = '' if prev is None else f'  x{t_scan / prev:.1f}'
+      print(f'  {n:6}: scanner {t_scan*1e3:9.3f} ms; regex {regex_str}{growth}')
+      if prev is None: first = t_scan
+      prev = t_scan
+    if prev / first > max_growth * sizes[-1] / sizes[0]:
+      print(f'  scanner time grew x{prev / first:.0f} for x{sizes[-1] // sizes[0]} size.')
+      failed = True
+  if failed: print('scanner time grew super-linearly.')
+  exit(1 if failed else 0)
+
+
+if __name__ == '__main__': main()
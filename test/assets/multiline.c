@@ -0,0 +1,4 @@
+/* A block comment
+   that spans several lines,
+   with "no string" inside. */
+int main(void) { return 0; }
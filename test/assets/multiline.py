@@ -0,0 +1,6 @@
+def greet(name: str) -> str:
+  """
+  A docstring that spans
+  several lines, with 'quotes' and # no comment.
+  """
+  return f'Hello, {name}.' # A comment.
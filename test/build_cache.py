@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# Dedicated to the public domain under CC0: https://creativecommons.org/publicdomain/zero/1.0/.
+
+'''
+Test the build cache of `-cache-dir`: an unchanged document is not rewritten,
+while editing a dependency, changing an output option, or tampering with or deleting the output causes a render.
+'''
+
+from os import remove, stat, utime
+from os.path import join as path_join
+from subprocess import run
+from sys import executable, exit, stderr
+from tempfile import TemporaryDirectory
+
+
+failures = 0
+
+def check(cond: bool, msg: str) -> None:
+  global failures
+  if not cond:
+    failures += 1
+    print(f'failure: {msg}', file=stderr)
+
+
+def render(*args: str) -> None:
+  proc = run([executable, '-m', 'writeup', *args], capture_output=True, text=True)
+  check(proc.returncode == 0 and not proc.stderr, f'writeup {" ".join(args)} failed:\n{proc.stderr}')
+
+
+def read(path: str) -> str:
+  with open(path) as f: return f.read()
+
+
+def write(path: str, text: str) -> None:
+  with open(path, 'w') as f: f.write(text)
+
+
+def main() -> None:
+  with TemporaryDirectory() as dir:
+    src_path = path_join(dir, 'doc.wu')
+    dep_path = path_join(dir, 'data.txt')
+    dst_path = path_join(dir, 'doc.html')
+    cache_args = ['-cache-dir', path_join(dir, 'cache')]
+    write(src_path, 'writeup v0\n\n<embed: data.txt>\n')
+    write(dep_path, 'first version\n')
+    render(*cache_args, src_path, dst_path)
+    check('first version' in read(dst_path), 'first render.')
+
+    # An unchanged document is left untouched.
+    utime(dst_path, ns=(0, 0))
+    render(*cache_args, src_path, dst_path)
+    check(stat(dst_path).st_mtime_ns == 0, 'unchanged output was rewritten.')
+
+    # Editing an embedded dependency causes a render.
+    write(dep_path, 'second version\n')
+    render(*cache_args, src_path, dst_path)
+    html = read(dst_path)
+    check('second version' in html and 'first version' not in html, 'edited dependency was not rendered.')
+
+    # Changing an option that affects the output causes a render.
+    check('<script' in html, 'expected the default script.')
+    render(*cache_args, '-no-js', src_path, dst_path)
+    html = read(dst_path)
+    check('<script' not in html, '`-no-js` did not cause a render.')
+
+    # A tampered or deleted output is regenerated.
+    write(dst_path, 'tampered\n')
+    render(*cache_args, '-no-js', src_path, dst_path)
+    check(read(dst_path) == html, 'tampered output was not regenerated.')
+    remove(dst_path)
+    render(*cache_args, '-no-js', src_path, dst_path)
+    check(read(dst_path) == html, 'deleted output was not regenerated.')
+
+  exit(1 if failures else 0)
+
+
+if __name__ == '__main__': main()
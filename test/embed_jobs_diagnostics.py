@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# Dedicated to the public domain under CC0: https://creativecommons.org/publicdomain/zero/1.0/.
+
+'''
+Test that diagnostics of concurrent embeds (`-embed-jobs`) are reported in source order, as in a synchronous render,
+even when a later embed finishes first.
+'''
+
+from os.path import join as path_join
+from sys import exit, stderr
+from tempfile import TemporaryDirectory
+from time import sleep
+from typing import List, Optional, TextIO
+
+import writeup.v0 as v0
+from writeup.v0 import Ctx, Diagnostic, EmbedPool, Env, WriteupError
+
+
+def embed_delayed(ctx: Ctx, f: TextIO) -> List[str]:
+  'Test embed: sleep for the number of seconds in the file, then warn, or fail if the extension is `.fail`.'
+  sleep(float(f.read()))
+  src = (0, f.name)
+  ctx.warn(src, 'embedded:', f.name)
+  if f.name.endswith('.fail'): ctx.error(src, 'failed:', f.name)
+  return [f.name]
+
+v0._add_embed(embed_delayed, '.delay', '.fail')
+
+
+def render(dir: str, names: List[str], embed_pool: Optional[EmbedPool]) -> List[Diagnostic]:
+  text = 'writeup v0\n\n' + ''.join(f'<embed: {name}>\n' for name in names)
+  diagnostics: List[Diagnostic] = []
+  try:
+    for _ in v0.writeup(src_path=path_join(dir, 'doc.wu'), src_lines=enumerate(text.splitlines(keepends=True)),
+      title='', description='', author='', css_lines=None, js=None, emit_doc=False, target_section=None, emit_dbg=False,
+      env=Env(embed_pool=embed_pool, diagnostics=diagnostics)):
+      pass
+  except WriteupError: diagnostics.append(Diagnostic(path='', line=0, col=0, label='raised', message='', text=''))
+  return diagnostics
+
+
+def main() -> None:
+  failures = 0
+  with TemporaryDirectory() as dir:
+    for name, delay in [('slow.delay', 0.3), ('fast.delay', 0), ('slow.fail', 0.3)]:
+      with open(path_join(dir, name), 'w') as f: f.write(str(delay))
+    pool = EmbedPool(4)
+    try:
+      for names in [['slow.delay', 'fast.delay', 'slow.delay'], ['slow.fail', 'fast.delay']]:
+        expected = render(dir, names, embed_pool=None)
+        actual = render(dir, names, embed_pool=pool)
+        if actual != expected or not expected:
+          failures += 1
+          print(f'diagnostics for {names}:\n  expected: {expected}\n  actual:   {actual}', file=stderr)
+    finally: pool.shutdown()
+  exit(1 if failures else 0)
+
+
+if __name__ == '__main__': main()
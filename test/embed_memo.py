@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# Dedicated to the public domain under CC0: https://creativecommons.org/publicdomain/zero/1.0/.
+
+'''
+Test the per-render embed memo: a file embedded both at top level and inside a quote is converted once,
+unless it is writeup, whose output depends on the quote depth.
+'''
+
+from sys import exit, stderr
+from typing import List
+
+from writeup.v0 import Env, Timings, writeup
+
+
+def main() -> None:
+  failures = 0
+  text = 'writeup v0\n\n<embed: text.txt>\n<embed: circle.svg>\n<embed: line.wu>\n\n> <embed: text.txt>\n> <embed: circle.svg>\n> <embed: line.wu>\n'
+  timings = Timings()
+  html_lines: List[str] = list(writeup(src_path='test/assets/memo.wu', src_lines=enumerate(text.splitlines(keepends=True)),
+    title='', description='', author='', css_lines=None, js=None, emit_doc=False, target_section=None, emit_dbg=False,
+    env=Env(timings=timings)))
+  handlers = sorted((e.path, e.handler) for e in timings.embeds)
+  expected = sorted([
+    ('test/assets/text.txt', 'embed_code'), ('test/assets/text.txt', 'memoized'),
+    ('test/assets/circle.svg', 'embed_direct'), ('test/assets/circle.svg', 'memoized'),
+    ('test/assets/line.wu', 'embed_wu'), ('test/assets/line.wu', 'embed_wu'),
+  ])
+  if handlers != expected:
+    failures += 1
+    print(f'embed handlers:\n  expected: {expected}\n  actual:   {handlers}', file=stderr)
+  if sum('Text contents.' in line for line in html_lines) != 2:
+    failures += 1
+    print('memoized embed is missing from the output.', file=stderr)
+  exit(1 if failures else 0)
+
+
+if __name__ == '__main__': main()
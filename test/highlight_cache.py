@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# Dedicated to the public domain under CC0: https://creativecommons.org/publicdomain/zero/1.0/.
+
+'''
+Test the syntax highlighting cache of `-cache-dir`: a second render is served from the cache and is byte-identical,
+keys change with the token colors and the format version, and `-highlight-cache-size` caps the size of the cache.
+'''
+
+import json
+from os import listdir, stat, utime
+from os.path import join as path_join
+from subprocess import run
+from sys import executable, exit, stderr
+from tempfile import TemporaryDirectory
+from typing import List
+
+import writeup.v0 as v0
+
+
+failures = 0
+
+def check(cond: bool, msg: str) -> None:
+  global failures
+  if not cond:
+    failures += 1
+    print(f'failure: {msg}', file=stderr)
+
+
+def render(*args: str) -> str:
+  proc = run([executable, '-m', 'writeup', '-bare', *args], capture_output=True, text=True)
+  check(proc.returncode == 0 and not proc.stderr, f'writeup {" ".join(args)} failed:\n{proc.stderr}')
+  return proc.stdout
+
+
+def entry_paths(dir: str) -> List[str]:
+  return sorted(path_join(dir, name) for name in listdir(dir) if name.endswith('.json'))
+
+
+def main() -> None:
+  with TemporaryDirectory() as dir:
+    cache_dir = path_join(dir, 'cache')
+    highlight_dir = path_join(cache_dir, 'highlight')
+    doc_path = path_join(dir, 'doc.wu')
+    count = 32
+    with open(doc_path, 'w') as f:
+      f.write('writeup v0\n\n' + ''.join(f'<embed: code{i}.py>\n\n' for i in range(count)))
+    for i in range(count):
+      with open(path_join(dir, f'code{i}.py'), 'w') as f:
+        f.write(f'def f{i}(x: int) -> str:\n  "Docstring {i}."\n  return str(x * {i}) # Comment.\n')
+
+    # A second render hits every entry and produces identical output.
+    uncached = render(doc_path)
+    first = render('-cache-dir', cache_dir, doc_path)
+    check(first == uncached, 'cached render differs from uncached render.')
+    entries = entry_paths(highlight_dir)
+    check(len(entries) == count, f'expected {count} entries: {len(entries)}')
+    for path in entries: utime(path, ns=(0, 0))
+    second = render('-cache-dir', cache_dir, doc_path)
+    check(second == first, 'second render differs from first render.')
+    check(entry_paths(highlight_dir) == entries, 'second render added entries.')
+    check(all(stat(path).st_mtime_ns > 0 for path in entries), 'second render did not read every entry.')
+
+    # Hits are served from the cache: an edited entry shows up in the output.
+    with open(entries[0]) as f: html_lines, css = json.load(f)
+    with open(entries[0], 'w') as f: json.dump([html_lines + ['<!-- cached -->'], css], f)
+    check('<!-- cached -->' in render('-cache-dir', cache_dir, doc_path), 'edited entry was not used.')
+
+    # Keys depend on the token colors and the format version.
+    cache = v0.HighlightCache(highlight_dir, max_size=1<<20)
+    lines = ['x = 1\n']
+    key = cache.key('a.py', lines)
+    check(cache.key('b.py', lines) != key, 'key does not depend on the file name.')
+    digest = v0.token_colors_digest()
+    v0._token_colors_digest = 'other colors'
+    check(cache.key('a.py', lines) != key, 'key does not depend on the token colors.')
+    v0._token_colors_digest = digest
+    v0.HighlightCache.format_version += 1
+    check(cache.key('a.py', lines) != key, 'key does not depend on the format version.')
+    v0.HighlightCache.format_version -= 1
+
+    # A tiny cap evicts the least recently used entries.
+    small_dir = path_join(dir, 'small')
+    cap = 4096
+    small = render('-cache-dir', small_dir, '-highlight-cache-size', str(cap / (1 << 20)), doc_path)
+    check(small == uncached, 'render with a small cache differs from uncached render.')
+    small_entries = entry_paths(path_join(small_dir, 'highlight'))
+    size = sum(stat(path).st_size for path in small_entries)
+    check(0 < len(small_entries) < count, f'expected some entries to be evicted: {len(small_entries)}')
+    check(size <= cap, f'cache size exceeds cap: {size} > {cap}')
+
+  exit(1 if failures else 0)
+
+
+if __name__ == '__main__': main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# Dedicated to the public domain under CC0: https://creativecommons.org/publicdomain/zero/1.0/.
+
+'''
+Test the `-index` sidecar of html-extract: building the index, querying it again (including a missing id),
+and rebuilding it once the document changes.
+'''
+
+import json
+from os import stat, utime
+from os.path import exists as path_exists, join as path_join
+from subprocess import CompletedProcess, run
+from sys import executable, exit, stderr
+from tempfile import TemporaryDirectory
+
+
+failures = 0
+
+def check(cond: bool, msg: str) -> None:
+  global failures
+  if not cond:
+    failures += 1
+    print(f'failure: {msg}', file=stderr)
+
+
+def extract(*args: str) -> CompletedProcess:
+  return run([executable, '-m', 'writeup.html_extract', *args], capture_output=True, text=True)
+
+
+def main() -> None:
+  with open('test/1/sections.out') as f: doc = f.read()
+  with TemporaryDirectory() as dir:
+    path = path_join(dir, 'doc.html')
+    index_path = path + '.ids.json'
+    with open(path, 'w') as f: f.write(doc)
+    ids = ['-id', 's2', '-id', 'h1.1.1', '-id', 's1.2']
+    expected = extract(*ids, path).stdout
+
+    # Build the index.
+    proc = extract('-index', *ids, path)
+    check(proc.returncode == 0 and proc.stdout == expected, f'first indexed query:\n{proc.stdout}{proc.stderr}')
+    check(path_exists(index_path), 'index was not written.')
+    with open(index_path) as f: index = json.load(f)
+    check(index['signature'] == [stat(path).st_size, stat(path).st_mtime_ns], f'index signature: {index["signature"]}')
+    check({'s1.1', 's1.2', 's2', 'h2'} <= set(index['ids']), f'index ids: {sorted(index["ids"])}')
+
+    # Query the existing index; it is read, not rebuilt.
+    utime(index_path, ns=(0, 0))
+    proc = extract('-index', *ids, path)
+    check(proc.returncode == 0 and proc.stdout == expected, f'second indexed query:\n{proc.stdout}{proc.stderr}')
+    check(stat(index_path).st_mtime_ns == 0, 'index was rebuilt for an unchanged document.')
+
+    # A missing id is reported after the found elements are printed.
+    proc = extract('-index', '-id', 'nope', '-id', 's2', path)
+    check(proc.returncode == 1, f'missing id exit status: {proc.returncode}')
+    check(proc.stderr == "specified element was not found: 'nope'\n", f'missing id message: {proc.stderr!r}')
+    check(proc.stdout.startswith('<section class="S1" id="s2">'), f'missing id output:\n{proc.stdout}')
+
+    # Changing the document makes the index stale; it is rebuilt from the new contents.
+    with open(path, 'w') as f: f.write('<!-- Shifts every offset. -->\n' + doc.replace('id="s2"', 'id="s9"'))
+    proc = extract('-index', '-id', 's9', path)
+    check(proc.returncode == 0 and proc.stdout.startswith('<section class="S1" id="s9">'), f'stale index query:\n{proc.stdout}{proc.stderr}')
+    check(stat(index_path).st_mtime_ns != 0, 'stale index was not rebuilt.')
+    proc = extract('-index', '-id', 's2', path)
+    check(proc.returncode == 1 and 'not found' in proc.stderr, f'removed id found in stale index:\n{proc.stdout}{proc.stderr}')
+
+  exit(1 if failures else 0)
+
+
+if __name__ == '__main__': main()
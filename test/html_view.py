@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# Dedicated to the public domain under CC0: https://creativecommons.org/publicdomain/zero/1.0/.
+
+'''
+Test the html-view preview server on an ephemeral port: writeup sources are rendered on request,
+a matching `If-None-Match` gets a 304, large pages are gzipped, paths outside the project root are forbidden,
+and a page's event stream reports a reload once one of its dependencies changes.
+'''
+
+import gzip
+import re
+from http.client import HTTPConnection
+from os import chdir, getcwd
+from os.path import join as path_join
+from sys import exit, stderr
+from tempfile import TemporaryDirectory
+from threading import Thread
+from typing import Dict, Tuple
+
+from writeup.html_view import Handler, PreviewServer
+
+
+failures = 0
+
+def check(cond: bool, msg: str) -> None:
+  global failures
+  if not cond:
+    failures += 1
+    print(f'failure: {msg}', file=stderr)
+
+
+def get(port: int, path: str, headers: Dict[str, str]={}) -> Tuple[int, Dict[str, str], bytes]:
+  conn = HTTPConnection('localhost', port, timeout=10)
+  conn.request('GET', path, headers=headers)
+  response = conn.getresponse()
+  result = (response.status, { k.lower(): v for k, v in response.getheaders() }, response.read())
+  conn.close()
+  return result
+
+
+def main() -> None:
+  Handler.log_message = lambda self, format, *args: None # type: ignore # Keep the test output quiet.
+  prev_dir = getcwd()
+  with TemporaryDirectory() as dir:
+    chdir(dir) # The server treats the current directory as the project root.
+    with open('doc.wu', 'w') as f: f.write('writeup v0\n\nPreview of <embed: data.txt>\n\n' + 'Filler text.\n' * 200)
+    with open('data.txt', 'w') as f: f.write('first version\n')
+    server = PreviewServer(('localhost', 0), Handler, stdin_page=None)
+    port = server.server_address[1]
+    Thread(target=server.serve_forever, daemon=True).start()
+    try:
+      # A writeup source is rendered, and so is its `.html` name.
+      status, headers, body = get(port, '/doc.wu')
+      check(status == 200 and headers['content-type'] == 'text/html; charset=utf-8', f'render: {status} {headers}')
+      check(b'first version' in body and b'<title>doc</title>' in body, 'rendered page contents.')
+      check(get(port, '/doc.html')[2] == body, '`doc.html` differs from `doc.wu`.')
+      etag = headers['etag']
+
+      # Revalidation.
+      status, headers, body304 = get(port, '/doc.wu', headers={'If-None-Match': etag})
+      check(status == 304 and headers['etag'] == etag and not body304, f'matching If-None-Match: {status}')
+      check(get(port, '/doc.wu', headers={'If-None-Match': '"other"'})[0] == 200, 'mismatched If-None-Match.')
+
+      # Compression.
+      status, headers, compressed = get(port, '/doc.wu', headers={'Accept-Encoding': 'gzip'})
+      check(headers.get('content-encoding') == 'gzip' and gzip.decompress(compressed) == body, 'gzipped page.')
+
+      # Paths outside the project root.
+      check(get(port, '/../x')[0] == 403, 'path outside the project root is not forbidden.')
+      check(get(port, '/missing.wu')[0] == 404, 'missing path.')
+
+      # The event stream reports a reload once a dependency changes.
+      m = re.search(rb"EventSource\('([^']+)'\)", body)
+      check(m is not None, 'page has no event source.')
+      if m:
+        conn = HTTPConnection('localhost', port, timeout=10)
+        conn.request('GET', m.group(1).decode())
+        response = conn.getresponse()
+        check(response.status == 200 and response.getheader('Content-Type') == 'text/event-stream', 'event stream.')
+        with open('data.txt', 'w') as f: f.write('second version, longer\n')
+        check(response.read() == b'event: reload\ndata: \n\n', 'no reload event.')
+        conn.close()
+        status, headers, body = get(port, '/doc.wu', headers={'If-None-Match': etag})
+        check(status == 200 and b'second version' in body, 'page was not rendered again after its dependency changed.')
+    finally:
+      server.shutdown()
+      server.server_close()
+      chdir(prev_dir)
+  exit(1 if failures else 0)
+
+
+if __name__ == '__main__': main()
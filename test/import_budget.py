@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# Dedicated to the public domain under CC0: https://creativecommons.org/publicdomain/zero/1.0/.
+
+'''
+Check the startup cost of writeup, as measured by `python3 -X importtime`.
+pygments must not be imported unless a document embeds code (plain text embeds do not count),
+and importing `writeup.v0` must stay within a budget relative to a standard library baseline measured in the same run,
+so that the check holds on slow or loaded machines.
+'''
+
+from os import environ
+from subprocess import run
+from sys import executable, exit, stderr
+from tempfile import TemporaryDirectory
+from typing import Dict, List, Sequence
+
+
+# Importing `writeup.v0` must take no longer than importing `asyncio` in a fresh interpreter.
+# It currently takes less than half as long; importing `pygments.lexers` alone takes about as long as the baseline.
+baseline_module = 'asyncio'
+budget_ratio = 1.0
+runs = 3 # The minimum of several runs discards interference from other processes.
+
+
+def main() -> None:
+  errors: List[str] = []
+
+  import_args = ['-c', 'import writeup.v0']
+  baseline_args = ['-c', f'import {baseline_module}']
+  import_times(import_args) # Warm up the bytecode cache so that source compilation is not measured.
+  totals: List[int] = []
+  baselines: List[int] = []
+  for _ in range(runs): # Interleave the measurements so that both see the same machine load.
+    times = import_times(import_args)
+    totals.append(times.get('writeup.v0', -1))
+    baselines.append(import_times(baseline_args)[baseline_module])
+  total = min(totals)
+  budget = int(min(baselines) * budget_ratio)
+  if total < 0: errors.append('`writeup.v0` was not imported.')
+  elif total > budget:
+    errors.append(f'importing `writeup.v0` took {total} µs; budget: {budget} µs ({budget_ratio} × `{baseline_module}`).')
+  check_not_imported(errors, import_args, times, lazy=('argparse', 'pygments'))
+
+  deps_args = ['-m', 'writeup', '-deps', 'test/1/html/embed.wu']
+  check_not_imported(errors, deps_args, import_times(deps_args), lazy=('pygments',))
+
+  with TemporaryDirectory() as cache_dir:
+    for plain_args in [['-m', 'writeup', 'test/assets/plain.wu'], ['-m', 'writeup', '-cache-dir', cache_dir, 'test/assets/plain.wu']]:
+      check_not_imported(errors, plain_args, import_times(plain_args), lazy=('pygments',))
+
+  for error in errors: print(error, file=stderr)
+  exit(1 if errors else 0)
+
+
+def check_not_imported(errors: List[str], args: List[str], times: Dict[str, int], lazy: Sequence[str]) -> None:
+  imported = sorted(name for name in times if name.partition('.')[0] in lazy)
+  if imported: errors.append(f'`python3 {" ".join(args)}` imported: {", ".join(imported)}.')
+
+
+def import_times(args: List[str]) -> Dict[str, int]:
+  'Run python with `-X importtime` and return the cumulative import time of each module in microseconds.'
+  env = { k: v for k, v in environ.items() if k != 'PYTHONDONTWRITEBYTECODE' }
+  proc = run([executable, '-X', 'importtime', *args], capture_output=True, text=True, env=env)
+  if proc.returncode: exit(f'`python3 {" ".join(args)}` failed:\n{proc.stderr}')
+  times: Dict[str, int] = {}
+  for line in proc.stderr.splitlines():
+    # Format: `import time: <self us> | <cumulative us> | <indented module name>`.
+    if not line.startswith('import time:'): continue
+    _, cumulative, name = line.split('|')
+    if not cumulative.strip().isdigit(): continue # Header line.
+    times[name.strip()] = int(cumulative)
+  return times
+
+
+if __name__ == '__main__': main()
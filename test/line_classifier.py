@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# Dedicated to the public domain under CC0: https://creativecommons.org/publicdomain/zero/1.0/.
+
+'''
+Differential test of `classify_line` against the reference regex `line_re`:
+states, group values and group columns must agree for every line.
+'''
+
+from itertools import product
+from random import Random
+from sys import exit, stderr
+from typing import Iterator
+
+from writeup.v0 import LineGroups, classify_line, line_groups_to_states, line_re
+
+
+alphabet = ' \t\r\xa0#*>|a' # Includes whitespace other than spaces, which `\s` also matches.
+
+group_names = list(line_re.groupindex)
+
+
+def cases() -> Iterator[str]:
+  for n in range(6):
+    for chars in product(alphabet, repeat=n):
+      yield ''.join(chars)
+  rand = Random(0)
+  for _ in range(20_000):
+    yield ''.join(rand.choice(alphabet) for _ in range(rand.randrange(6, 24)))
+
+
+def main() -> None:
+  failures = 0
+  for line in cases():
+    m = line_re.fullmatch(line)
+    assert m is not None
+    expected = (line_groups_to_states[m.lastgroup], {k: m[k] for k in group_names},
+      {k: m.start(k) for k in LineGroups.order if m[k] is not None})
+    state, groups = classify_line(line)
+    actual = (state, {k: groups[k] for k in group_names}, {k: groups.start(k) for k in LineGroups.order if groups[k] is not None})
+    if actual != expected:
+      failures += 1
+      if failures <= 10: print(f'mismatch: {line!r}\n  expected: {expected}\n  actual:   {actual}', file=stderr)
+  exit(1 if failures else 0)
+
+
+if __name__ == '__main__': main()
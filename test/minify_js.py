@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# Dedicated to the public domain under CC0: https://creativecommons.org/publicdomain/zero/1.0/.
+
+'''
+Test `minify_js` on small cases covering comments, literals, regular expressions and automatic semicolon insertion,
+and check that minifying the default Javascript removes every comment and is idempotent.
+'''
+
+from sys import exit, stderr
+from typing import List, Tuple
+
+from writeup.v0 import default_js, minify_js
+
+
+cases: List[Tuple[str, str]] = [
+  ('', ''),
+  ('  var  x  =  1 ;  ', 'var x=1;'),
+  ('f(a, b); // comment.\ng();', 'f(a,b);g();'),
+  ('/* block\n comment */ x = 1;', 'x=1;'),
+  ('var s = "a  // not a comment";', 'var s="a  // not a comment";'),
+  ("var s = 'it\\'s  /* kept */';", "var s='it\\'s  /* kept */';"),
+  ('var t = `a\n  b`;', 'var t=`a\n  b`;'),
+  ('var r = /ab+  c\\/[/]/g;', 'var r=/ab+  c\\/[/]/g;'),
+  ('return /x y/.test(s);', 'return/x y/.test(s);'),
+  ('var q = a / b / c;', 'var q=a/b/c;'),
+  ('a + +b; a - -b; a + -b;', 'a+ +b;a- -b;a+-b;'),
+  ('var a = 1\nvar b = 2', 'var a=1\nvar b=2'), # No semicolon: the line break is significant.
+  ('x = y\n(f)()', 'x=y\n(f)()'),
+  ('i\n++\nj', 'i\n++\nj'),
+  ('return\nx', 'return\nx'),
+  ('if (a) {\n  b();\n}\nelse {\n  c();\n}', 'if(a){b();}\nelse{c();}'),
+  ('f(1,\n  2);', 'f(1,2);'),
+  ('typeof  x', 'typeof x'),
+  ('a.b . c', 'a.b.c'),
+  ('x = 1.5e3 + 0x1f;', 'x=1.5e3+0x1f;'),
+]
+
+
+def main() -> None:
+  failures = 0
+  for js, expected in cases:
+    actual = minify_js(js)
+    if actual != expected:
+      failures += 1
+      print(f'mismatch: {js!r}\n  expected: {expected!r}\n  actual:   {actual!r}', file=stderr)
+
+  minified = minify_js(default_js)
+  if '//' in minified or '/*' in minified:
+    failures += 1
+    print(f'comment remains in minified default_js:\n{minified}', file=stderr)
+  if minify_js(minified) != minified:
+    failures += 1
+    print('minify_js is not idempotent on default_js.', file=stderr)
+  if len(minified) >= len(default_js) * 0.8:
+    failures += 1
+    print(f'minified default_js is too large: {len(minified)} of {len(default_js)} bytes.', file=stderr)
+  exit(1 if failures else 0)
+
+
+if __name__ == '__main__': main()
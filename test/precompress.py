@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# Dedicated to the public domain under CC0: https://creativecommons.org/publicdomain/zero/1.0/.
+
+'''
+Test `-precompress`: the gzip and zlib copies decompress to the HTML,
+and rendering an unchanged document again leaves the HTML and both copies untouched.
+'''
+
+import gzip
+import zlib
+from os import stat, utime
+from os.path import join as path_join
+from subprocess import run
+from sys import executable, exit, stderr
+from tempfile import TemporaryDirectory
+from typing import List
+
+
+failures = 0
+
+def check(cond: bool, msg: str) -> None:
+  global failures
+  if not cond:
+    failures += 1
+    print(f'failure: {msg}', file=stderr)
+
+
+def render(args: List[str]) -> None:
+  proc = run([executable, '-m', 'writeup', *args], capture_output=True, text=True)
+  check(proc.returncode == 0 and not proc.stderr, f'writeup {" ".join(args)} failed:\n{proc.stderr}')
+
+
+def main() -> None:
+  with TemporaryDirectory() as dir:
+    html_path = path_join(dir, 'basic.html')
+    paths = [html_path, html_path + '.gz', html_path + '.zz']
+    args = ['-precompress', 'gzip,zlib', '-precompress-level', '6', 'test/1/html/basic.wu', html_path]
+    render(args)
+
+    with open(html_path, 'rb') as f: html = f.read()
+    with open(html_path + '.gz', 'rb') as f: check(gzip.decompress(f.read()) == html, 'gzip copy differs from the HTML.')
+    with open(html_path + '.zz', 'rb') as f: check(zlib.decompress(f.read()) == html, 'zlib copy differs from the HTML.')
+
+    # Set old mtimes, so that a rewrite is detected even on file systems with coarse timestamps.
+    for path in paths: utime(path, ns=(0, 0))
+    render(args)
+    for path in paths: check(stat(path).st_mtime_ns == 0, f'unchanged output was rewritten: {path}')
+
+  exit(1 if failures else 0)
+
+
+if __name__ == '__main__': main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# Dedicated to the public domain under CC0: https://creativecommons.org/publicdomain/zero/1.0/.
+
+'''
+Test `Renderer.render_async`: the chunks join to the `-stream` command line output, the event loop stays responsive
+while a document renders, errors raise `WriteupError` from the iterator, and a consumer can stop early.
+'''
+
+import asyncio
+from subprocess import run
+from sys import executable, exit, stderr
+from typing import List
+
+from writeup.v0 import Renderer, WriteupError
+
+
+failures = 0
+
+def check(cond: bool, msg: str) -> None:
+  global failures
+  if not cond:
+    failures += 1
+    print(f'failure: {msg}', file=stderr)
+
+
+async def collect(renderer: Renderer, **kwargs) -> List[str]:
+  return [chunk async for chunk in renderer.render_async(**kwargs)]
+
+
+async def ticker(ticks: List[int], stop: asyncio.Event) -> None:
+  while not stop.is_set():
+    ticks[0] += 1
+    await asyncio.sleep(0.001)
+
+
+async def test_all(renderer: Renderer) -> None:
+  # Same output as the command line tool in streaming mode.
+  for path in ['test/1/html/basic.wu', 'test/assets/concurrent.wu']:
+    cli = run([executable, '-m', 'writeup', '-stream', path], capture_output=True, text=True).stdout
+    chunks = await collect(renderer, path=path)
+    check(''.join(chunks) == cli, f'render_async differs from command line output: {path}')
+    check(all(chunks), f'empty chunk: {path}')
+
+  # A large document arrives in many chunks, and the loop keeps running while it renders.
+  text = 'writeup v0\n\n' + ''.join(f'# Section {i}\n\nParagraph {i} with *emphasis* and `code`.\n\n' for i in range(2000))
+  ticks = [0]
+  stop = asyncio.Event()
+  tick_task = asyncio.create_task(ticker(ticks, stop))
+  chunks = await collect(renderer, text=text, chunk_size=1<<10)
+  stop.set()
+  await tick_task
+  check(len(chunks) > 10, f'expected many chunks: {len(chunks)}')
+  check(''.join(chunks) == ''.join(line + '\n' for line in renderer.render_lines(text=text, stream=True)),
+    'large document differs from render_lines.')
+  check(ticks[0] > 1, f'event loop was blocked: {ticks[0]} ticks.')
+
+  # Errors raise from the iterator.
+  try:
+    await collect(renderer, text='writeup v0\n\n* a\n   * b\n', path='odd.wu')
+  except WriteupError as e:
+    check([(d.line, d.label) for d in e.diagnostics] == [(4, 'error')], f'diagnostics: {e.diagnostics}')
+  else: check(False, 'expected WriteupError for odd indentation.')
+  try:
+    await collect(renderer, path='test/missing.wu')
+  except WriteupError as e:
+    check([d.message for d in e.diagnostics] == ['file does not exist.'], f'diagnostics: {e.diagnostics}')
+  else: check(False, 'expected WriteupError for a missing file.')
+
+  # Stopping early does not hang, and the renderer remains usable.
+  iterator = renderer.render_async(text=text, chunk_size=1<<8)
+  async for chunk in iterator: break
+  await iterator.aclose() # type: ignore
+  check(''.join(await collect(renderer, path='test/1/html/basic.wu')).endswith('</html>\n'), 'render after early stop.')
+
+
+def main() -> None:
+  asyncio.run(asyncio.wait_for(test_all(Renderer()), timeout=60))
+  exit(1 if failures else 0)
+
+
+if __name__ == '__main__': main()
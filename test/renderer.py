@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# Dedicated to the public domain under CC0: https://creativecommons.org/publicdomain/zero/1.0/.
+
+'''
+Test the in-process `Renderer` API: output matches the command line tool, documents rendered from text are valid HTML,
+errors raise `WriteupError` with every diagnostic, concurrent renders from many threads agree, and cached embeds are invalidated when the embedded file changes.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+from os import utime
+from os.path import join as path_join
+from subprocess import run
+from sys import executable, exit, stderr
+from tempfile import TemporaryDirectory
+from typing import List
+
+from writeup.html_check import Parser as HtmlChecker
+from writeup.v0 import Diagnostic, Renderer, WriteupError
+
+
+failures = 0
+
+def check(cond: bool, msg: str) -> None:
+  global failures
+  if not cond:
+    failures += 1
+    print(f'failure: {msg}', file=stderr)
+
+
+def main() -> None:
+  renderer = Renderer()
+
+  # Same output as the command line tool.
+  for path in ['test/1/html/basic.wu', 'test/assets/concurrent.wu']:
+    cli = run([executable, '-m', 'writeup', path], capture_output=True, text=True).stdout
+    check(renderer.render(path=path) == cli, f'render differs from command line output: {path}')
+    check(renderer.render_bytes(path=path) == cli.encode(), f'render_bytes differs from command line output: {path}')
+
+  # Text input, bare output, sections and warnings.
+  warnings: List[Diagnostic] = []
+  html = renderer.render('writeup v0\n\n# A\na\n\n# B\nb  \n', bare=True, section='B', warnings=warnings)
+  check(html == '<section class="S1" id="s1">\n  <h1 id="h1">B</h1>\n  <p>\n    b\n  </p>\n</section>\n', f'bare section: {html!r}')
+  check(not warnings, f'unexpected warnings: {warnings}')
+  warnings = []
+  renderer.render('writeup v0\nmissing newline', warnings=warnings)
+  check([(d.line, d.label, d.message) for d in warnings] == [(2, 'warning', 'missing final newline.')], f'warnings: {warnings}')
+
+  # Text without a path has an empty title; titles are escaped.
+  html = renderer.render('writeup v0\n\nhi\n')
+  check('<title></title>' in html, 'title of text without a path.')
+  checker = HtmlChecker(path='<string>')
+  checker.feed(html)
+  checker.close()
+  checker.check_completeness()
+  check(not checker.messages, f'invalid HTML: {checker.messages}')
+  check('<title>a&lt;b&gt;</title>' in renderer.render('writeup v0\n', path='a<b>.wu'), 'title is not escaped.')
+
+  # Errors raise with every diagnostic, including preceding warnings.
+  try:
+    renderer.render('writeup v0\n\n#  A\n* a\n   * b\n', path='odd.wu')
+  except WriteupError as e:
+    check([(d.path, d.line, d.label) for d in e.diagnostics] == [('odd.wu', 3, 'warning'), ('odd.wu', 5, 'error')],
+      f'diagnostics: {e.diagnostics}')
+    check(str(e).endswith('odd.wu:5:4: error: odd indentation length: 3.\n   * b'), f'message: {e}')
+  else: check(False, 'expected WriteupError for odd indentation.')
+  try:
+    renderer.render('writeup v0\n\n# A\na\n', section=['A', 'Z', '9'])
+  except WriteupError as e:
+    check([d.message for d in e.diagnostics] == ["target sections not found: 'Z', '9'"], f'diagnostics: {e.diagnostics}')
+  else: check(False, 'expected WriteupError for missing sections.')
+
+  try:
+    renderer.render(path='test/missing.wu')
+  except WriteupError as e:
+    check([str(d) for d in e.diagnostics] == ['test/missing.wu: error: file does not exist.'], f'diagnostics: {e.diagnostics}')
+  else: check(False, 'expected WriteupError for a missing file.')
+
+  # Concurrent renders from many threads agree with serial renders.
+  paths = ['test/1/html/basic.wu', 'test/1/html/lists.wu', 'test/assets/concurrent.wu', 'test/assets/nested.wu'] * 8
+  expected = { path: renderer.render(path=path) for path in set(paths) }
+  with ThreadPoolExecutor(max_workers=8) as executor:
+    results = list(executor.map(lambda path: renderer.render(path=path), paths))
+  check(all(html == expected[path] for path, html in zip(paths, results)), 'concurrent renders differ from serial renders.')
+
+  # Cached embeds are invalidated when the embedded file changes.
+  with TemporaryDirectory() as dir:
+    doc_path = path_join(dir, 'doc.wu')
+    txt_path = path_join(dir, 'data.txt')
+    with open(doc_path, 'w') as f: f.write('writeup v0\n\n<embed: data.txt>\n')
+    with open(txt_path, 'w') as f: f.write('first version\n')
+    check('first version' in renderer.render(path=doc_path), 'first render.')
+    with open(txt_path, 'w') as f: f.write('second version\n')
+    utime(txt_path, ns=(0, 0)) # Ensure a different signature even on file systems with coarse timestamps.
+    html = renderer.render(path=doc_path)
+    check('second version' in html and 'first version' not in html, 'stale cached embed.')
+
+  exit(1 if failures else 0)
+
+
+if __name__ == '__main__': main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# Dedicated to the public domain under CC0: https://creativecommons.org/publicdomain/zero/1.0/.
+
+'''
+Differential test of `scan_spans` against the reference regex `span_re`,
+over exhaustive short strings, random strings and adversarial lines.
+'''
+
+from itertools import product
+from random import Random
+from sys import exit, stderr
+from typing import Iterator, List, Tuple
+
+from writeup.v0 import scan_spans, span_re
+
+
+alphabet = '`<>\\ a'
+
+
+def reference_spans(text: str) -> List[Tuple[int, int, int]]:
+  return [(m.lastindex or 0, m.start(), m.end()) for m in span_re.finditer(text)]
+
+
+def cases() -> Iterator[str]:
+  for n in range(7):
+    for chars in product(alphabet, repeat=n):
+      yield ''.join(chars)
+  rand = Random(0)
+  for _ in range(20_000):
+    yield ''.join(rand.choice(alphabet) for _ in range(rand.randrange(8, 64)))
+  for n in (10, 100, 1000):
+    yield '<' * n
+    yield '`' * n
+    yield '<`' * n
+    yield '\\>' * n + '<'
+    yield '<' + '\\>' * n
+    yield '<' + '\\\\' * n + '>'
+    yield 'a<b:' + ' x' * n + '> `code`' * n
+
+
+def main() -> None:
+  failures = 0
+  for text in cases():
+    expected = reference_spans(text)
+    actual = list(scan_spans(text))
+    if actual != expected:
+      failures += 1
+      if failures <= 10: print(f'mismatch: {text!r}\n  expected: {expected}\n  actual:   {actual}', file=stderr)
+  exit(1 if failures else 0)
+
+
+if __name__ == '__main__': main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# Dedicated to the public domain under CC0: https://creativecommons.org/publicdomain/zero/1.0/.
+
+'''
+Test the `-timings` report on `test/1/html/embed.wu`, ignoring the times themselves,
+and check that `-profile` writes statistics that `pstats` can load.
+'''
+
+import pstats
+import re
+from os import symlink
+from os.path import abspath as abs_path, join as path_join
+from shutil import copy
+from subprocess import run
+from sys import executable, exit, stderr
+from tempfile import TemporaryDirectory
+from typing import List, Tuple
+
+
+failures = 0
+
+def check(cond: bool, msg: str) -> None:
+  global failures
+  if not cond:
+    failures += 1
+    print(f'failure: {msg}', file=stderr)
+
+
+expected_phases = [
+  ('1', 'emit html'),
+  ('1', 'parse'),
+  ('1', 'render css'),
+  ('1', 'total'),
+  ('1', 'write output'),
+  ('7', 'Section.finish'),
+  ('9', 'Text.finish'),
+]
+
+expected_embeds = [ # (handler, bytes in, bytes out, path).
+  ('embed_code', '15', '74', 'test/assets/text.txt'),
+  ('embed_csv', '0', '17', 'test/assets/empty.csv'),
+  ('embed_csv', '18', '176', 'test/assets/table.csv'),
+  ('embed_direct', '89', '89', 'test/assets/circle.svg'),
+  ('embed_img', '14465', '71', 'test/assets/head.png'),
+  ('embed_img', '6833', '71', 'test/assets/head.gif'),
+  ('embed_img', '7313', '71', 'test/assets/head.jpg'),
+  ('embed_wu', '125', '206', 'test/assets/nested.wu'),
+  ('embed_wu', '18', '17', 'test/assets/line.wu'),
+  ('memoized', '18', '0', 'test/assets/line.wu'),
+  ('memoized', '18', '0', 'test/assets/line.wu'),
+]
+
+phase_re = re.compile(r' +[\d.]+ ms +(\d+) × (.+)')
+embed_re = re.compile(r' +[\d.]+ ms  (\S+) +(\d+) +(\d+)  (.+)')
+
+
+def parse_report(report: str) -> Tuple[List[Tuple[str, ...]], List[Tuple[str, ...]]]:
+  'Return the sorted (count, name) phases and (handler, bytes in, bytes out, path) embeds of a report, without times.'
+  phases: List[Tuple[str, ...]] = []
+  embeds: List[Tuple[str, ...]] = []
+  for line in report.splitlines():
+    m = phase_re.fullmatch(line)
+    if m:
+      phases.append(m.groups())
+      continue
+    m = embed_re.fullmatch(line)
+    if m: embeds.append(m.groups())
+  return sorted(phases), sorted(embeds)
+
+
+def main() -> None:
+  with TemporaryDirectory() as dir:
+    # Embed paths in `embed.wu` are relative to a directory containing `test`.
+    symlink(abs_path('test'), path_join(dir, 'test'))
+    copy('test/1/html/embed.wu', dir)
+
+    proc = run([executable, '-m', 'writeup', '-timings', 'embed.wu', 'embed.html'], cwd=dir, capture_output=True, text=True)
+    check(proc.returncode == 0, f'-timings failed:\n{proc.stderr}')
+    lines = proc.stderr.splitlines()
+    check(lines[:1] == ['writeup timings (inclusive wall time):'], f'report header: {lines[:1]}')
+    check('embeds:' in lines, 'report has no embeds section.')
+    phases, embeds = parse_report(proc.stderr)
+    check(phases == expected_phases, f'phases:\n  expected: {expected_phases}\n  actual:   {phases}')
+    check(embeds == expected_embeds, f'embeds:\n  expected: {expected_embeds}\n  actual:   {embeds}')
+
+    profile_path = path_join(dir, 'writeup.prof')
+    proc = run([executable, '-m', 'writeup', '-profile', profile_path, 'embed.wu', 'embed.html'], cwd=dir,
+      capture_output=True, text=True)
+    check(proc.returncode == 0, f'-profile failed:\n{proc.stderr}')
+    stats = pstats.Stats(profile_path)
+    functions = { name for _, _, name in stats.stats } # type: ignore # `stats` is undocumented.
+    check('main_args' in functions and 'writeup' in functions, 'profile does not cover the render.')
+
+  exit(1 if failures else 0)
+
+
+if __name__ == '__main__': main()
@@ -1,8 +1,15 @@
 #!/usr/bin/env python3
 # Dedicated to the public domain under CC0: https://creativecommons.org/publicdomain/zero/1.0/.
 
+'''
+Check the validity of HTML documents.
+Paths can be files, directories (searched recursively for `.html` files) or glob patterns.
+Files are checked in parallel, and their diagnostics are printed in path order, followed by a summary on stderr.
+The exit status is 1 if any document has problems.
+'''
+
 import re
-from sys import stdin
+from sys import stderr, stdin
 from argparse import ArgumentParser
 from html.parser import HTMLParser
 from typing import *
@@ -10,30 +17,107 @@ from typing import *
 
 def main() -> None:
   arg_parser = ArgumentParser('Check the validity of HTML documents.')
-  arg_parser.add_argument('paths', nargs='*', help='paths to HTML documents (defaults to stdin).')
+  arg_parser.add_argument('paths', nargs='*',
+    help='paths to HTML documents, directories or glob patterns (defaults to stdin).')
+  arg_parser.add_argument('-jobs', type=int, default=None, help='Number of worker processes; defaults to the CPU count.')
   args = arg_parser.parse_args()
-
-  try: files = [open(path) for path in args.paths]
-  except FileNotFoundError as e: exit(f'file not found: {e.filename}')
-  if not files: files = [stdin]
-
-  for file in files:
-    parser = Parser(path=file.name)
-    parser.feed(file.read())
-    parser.close()
-    parser.check_completeness()
+  if args.jobs is not None and args.jobs < 1: exit(f'html-check: `-jobs` must be positive: {args.jobs}')
+
+  if not args.paths:
+    parser = Parser(path=stdin.name)
+    parser.check_file(stdin)
+    for message in parser.messages: print(message)
+    exit(1 if parser.messages else 0)
+
+  paths = expand_paths(args.paths)
+  if len(paths) > 1 and args.jobs != 1:
+    from concurrent.futures import ProcessPoolExecutor
+    from os import cpu_count
+    workers = min(len(paths), args.jobs or cpu_count() or 1)
+    chunksize = max(1, len(paths) // (4 * workers)) # Amortize IPC without starving workers at the tail.
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+      results = executor.map(check_path, paths, chunksize=chunksize)
+      failures = report(results)
+  else:
+    failures = report(map(check_path, paths))
+
+  s = '' if len(paths) == 1 else 's'
+  print(f'html-check: {len(paths)} file{s} checked; {failures} with problems.', file=stderr)
+  exit(1 if failures else 0)
+
+
+def expand_paths(args: List[str]) -> List[str]:
+  'Expand directories and glob patterns, in a deterministic order; remove duplicates.'
+  from glob import glob
+  from os import walk
+  from os.path import isdir as is_dir, join as path_join, splitext as split_ext
+  paths: List[str] = []
+  for arg in args:
+    if is_dir(arg):
+      for dir_path, dir_names, file_names in walk(arg):
+        dir_names.sort()
+        paths.extend(path_join(dir_path, name) for name in sorted(file_names) if split_ext(name)[1] in html_exts)
+    elif glob_magic_re.search(arg):
+      matches = sorted(glob(arg, recursive=True))
+      if not matches: paths.append(arg) # Reported as not found.
+      paths.extend(matches)
+    else:
+      paths.append(arg)
+  return list(dict.fromkeys(paths))
+
+glob_magic_re = re.compile(r'[*?[]')
+
+html_exts = {'.html', '.htm'}
+
+
+def report(results: Iterable[Tuple[str, List[str]]]) -> int:
+  'Print the messages for each path as results arrive, in path order; return the number of paths with problems.'
+  failures = 0
+  for path, messages in results:
+    if messages:
+      failures += 1
+      for message in messages: print(message)
+  return failures
+
+
+def check_path(path: str) -> Tuple[str, List[str]]:
+  'Check a single document in a worker process; returns the path and its diagnostic messages.'
+  parser = Parser(path=path)
+  try:
+    with open(path) as f:
+      parser.check_file(f)
+  except FileNotFoundError:
+    parser.messages.append(f'{path}: file not found.')
+  except (OSError, UnicodeDecodeError) as e:
+    parser.messages.append(f'{path}: could not read file: {e}')
+  return path, parser.messages
 
 
 Pos = Tuple[int, int]
 
+# Elements that never have a closing tag.
+void_tags = frozenset(['area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'])
+
 
 class Parser(HTMLParser):
 
+  chunk_size = 1 << 16
+
   def __init__(self, path: str) -> None:
     super().__init__(convert_charrefs=True)
     self.path = path
     self.stack: List[Tuple[Pos, str]] = []
     self.found_leading_doctype = False
+    self.messages: List[str] = []
+
+  def check_file(self, file: TextIO) -> None:
+    'Feed the file to the parser in fixed-size chunks, so that memory does not grow with the document.'
+    while True:
+      chunk = file.read(self.chunk_size)
+      if not chunk: break
+      self.feed(chunk)
+    self.close()
+    self.check_completeness()
 
   def check_completeness(self) -> None:
     if not self.found_leading_doctype:
@@ -43,6 +127,7 @@ class Parser(HTMLParser):
     pass
 
   def handle_starttag(self, tag: str, attrs: List[Tuple[str, str]]) -> None:
+    if tag in void_tags: return
     self.stack.append((self.pos, tag))
 
   def handle_endtag(self, tag: str) -> None:
@@ -62,7 +147,7 @@ class Parser(HTMLParser):
     self.msg(f'unmatched closing tag: {tag}')
 
   def handle_decl(self, decl: str) -> None:
-    if decl == 'DOCTYPE html' and self.pos == (1, 1):
+    if decl == 'DOCTYPE html' and self.pos == (0, 0):
       self.found_leading_doctype = True
       return
     self.msg(f'decl: {decl!r}')
@@ -82,7 +167,7 @@ class Parser(HTMLParser):
 
   def msg(self, msg: str, pos:Pos=None) -> None:
     if pos is None: pos = self.pos
-    print(f'{self.path}:{pos[0]+1}:{pos[1]+1}: {msg}')
+    self.messages.append(f'{self.path}:{pos[0]+1}:{pos[1]+1}: {msg}')
 
 
 if __name__ == '__main__': main()
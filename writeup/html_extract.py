@@ -1,84 +1,151 @@
 #!/usr/bin/env python3
 # Dedicated to the public domain under CC0: https://creativecommons.org/publicdomain/zero/1.0/.
 
-import re
-from sys import stdin
+'''
+Extract elements from an HTML document by `id`.
+All of the requested elements are found in a single pass, which stops as soon as the last one is closed.
+With `-index`, the byte range of every element with an `id` is saved to a sidecar file next to the document,
+so that later queries of an unchanged document read the ranges directly without parsing.
+'''
+
+import json
+from sys import stderr, stdin
 from argparse import ArgumentParser
 from html.parser import HTMLParser
+from io import BytesIO
+from os import fstat, getpid, replace, stat
 from typing import *
 
 
 def main() -> None:
-  arg_parser = ArgumentParser('Extract a portion of an HTML document.')
-  arg_parser.add_argument('-id',help='The `id` of the DOM element to extract.')
+  arg_parser = ArgumentParser('Extract portions of an HTML document.')
+  arg_parser.add_argument('-id', action='append', required=True,
+    help='The `id` of a DOM element to extract; may be repeated. Elements are printed in the order requested.')
+  arg_parser.add_argument('-index', action='store_true',
+    help='Use (or create) the sidecar index `<path>.ids.json`, which maps every id in the document to its byte range.')
   arg_parser.add_argument('path', nargs='?', help='path to the HTML document (defaults to stdin).')
   args = arg_parser.parse_args()
   path = args.path
+  ids = list(dict.fromkeys(args.id)) # Remove duplicates, preserving order.
+  if args.index and path is None: exit('`-index` requires a path.')
 
-  try: file = open(path) if path is not None else stdin
+  try: file = open(path, 'rb') if path is not None else BytesIO(stdin.buffer.read()) # Ranges are read by seeking.
   except FileNotFoundError as e: exit(f'file not found: {e.filename}')
-  parser = Parser(path=file.name, id=args.id, lines=list(file))
-  parser.extract()
+  with file:
+    if args.index:
+      ranges = load_index(path)
+      if ranges is None:
+        st = fstat(file.fileno()) # Before parsing, so that a concurrent modification leaves the index stale.
+        parser = Parser(path=path, ids=None)
+        parser.parse(file)
+        ranges = parser.ranges
+        save_index(path, signature=[st.st_size, st.st_mtime_ns], ranges=ranges)
+      unterminated: Set[str] = set()
+    else:
+      parser = Parser(path=path or '<stdin>', ids=set(ids))
+      parser.parse(file)
+      ranges = parser.ranges
+      unterminated = parser.unterminated
+    for id in ids:
+      r = ranges.get(id)
+      if r is None: continue
+      start, end = r
+      file.seek(start)
+      print(file.read(end - start).decode())
+
+  missing = [id for id in ids if id not in ranges]
+  if missing:
+    exit('\n'.join(f'specified element was {"found but unterminated" if id in unterminated else "not found"}: {id!r}'
+      for id in missing))
 
 
 Pos = Tuple[int, int]
+ByteRange = Tuple[int, int]
+
+# Elements that never have a closing tag.
+void_tags = frozenset(['area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'])
+
+
+class StopParsing(Exception): pass
 
 
 class Parser(HTMLParser):
+  '''
+  Find the byte ranges of elements by `id`, including their start and end tags.
+  If `ids` is None, record every element with an `id`; otherwise stop once all of `ids` are found.
+  The first element with a given `id` wins.
+  '''
 
-  def __init__(self, path: str, id=str, lines=List[str]) -> None:
+  def __init__(self, path: str, ids: Optional[Set[str]]) -> None:
     super().__init__(convert_charrefs=True)
     self.path = path
-    self.id = id
-    self.lines = lines
-    self.stack: List[Tuple[Pos, str]] = []
-    self.extract_start_pos: Optional[Pos] = None
-
-  def extract(self) -> None:
-    for line in self.lines:
-      self.feed(line)
-    self.close()
-    if self.extract_start_pos: exit('specified element was found but unterminated.')
-    else: exit('specified element was not found.')
-
-  def handle_starttag(self, tag: str, attrs: List[Tuple[str, str]]):
-    self.stack.append((self.pos, tag))
-    d = dict(attrs)
-    if d.get('id') == self.id:
-      self.extract_start_pos = self.pos
+    self.ids = ids
+    self.ranges: Dict[str, ByteRange] = {}
+    self.stack: List[Tuple[Pos, str, Optional[str], int]] = [] # (pos, tag, id, start byte).
+    self.line_offsets: List[int] = [] # Byte offset of each line.
+    self.lines: Dict[int, str] = {} # Lines that the parser may still refer to, by index.
+
+  def parse(self, file: BinaryIO) -> None:
+    offset = 0
+    try:
+      for line_idx, line_bytes in enumerate(file):
+        line = line_bytes.decode()
+        self.line_offsets.append(offset)
+        self.lines[line_idx] = line
+        offset += len(line_bytes)
+        self.feed(line)
+        # Events only refer to positions at or after the parser's current position.
+        current_idx = self.pos[0]
+        for idx in [idx for idx in self.lines if idx < current_idx]: del self.lines[idx]
+      self.close()
+    except StopParsing: pass
+
+  @property
+  def unterminated(self) -> Set[str]:
+    return { id for _, _, id, _ in self.stack if id is not None }
+
+  def byte_offset(self, pos: Pos) -> int:
+    line_idx, col = pos
+    return self.line_offsets[line_idx] + len(self.lines[line_idx][:col].encode())
+
+  def wants(self, id: Optional[str]) -> bool:
+    return id is not None and id not in self.ranges and (self.ids is None or id in self.ids)
+
+  def record(self, id: str, byte_range: ByteRange) -> None:
+    self.ranges[id] = byte_range
+    if self.ids is not None and len(self.ranges) == len(self.ids): raise StopParsing
+
+  def handle_starttag(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> None:
+    id = dict(attrs).get('id')
+    if tag in void_tags:
+      self.handle_startendtag(tag, attrs)
+      return
+    self.stack.append((self.pos, tag, id, self.byte_offset(self.pos) if self.wants(id) else -1))
+
+  def handle_startendtag(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> None:
+    id = dict(attrs).get('id')
+    if self.wants(id):
+      start = self.byte_offset(self.pos)
+      self.record(cast(str, id), (start, start + len((self.get_starttag_text() or '').encode())))
 
   def handle_endtag(self, tag: str) -> None:
     if self.stack and self.stack[-1][1] == tag:
-      p, t = self.stack.pop()
-      if p == self.extract_start_pos:
-        self.print_range(p, self.pos)
-        exit(0)
+      p, t, id, start = self.stack.pop()
+      if start >= 0:
+        line_idx, col = self.pos
+        close_col = self.lines[line_idx].index('>', col) + 1
+        self.record(cast(str, id), (start, self.byte_offset((line_idx, close_col))))
       return
     self.msg(f'unmatched closing tag: {tag}')
-    self.msg(f'in: {" ".join(t for _, t in self.stack)}')
+    self.msg(f'in: {" ".join(t for _, t, _, _ in self.stack)}')
     for i in reversed(range(len(self.stack))):
-      pi, ti = self.stack[i]
+      pi, ti, _, _ = self.stack[i]
       if ti == tag: # found match.
-        for p, t in self.stack[i+1:]:
+        for p, t, _, _ in self.stack[i+1:]:
           self.msg(f'note: ignoring open `{t}` here', pos=p)
         self.msg(f'note: could match here', pos=pi)
         return
 
-  def print_range(self, start_pos: Pos, end_pos: Pos) -> None:
-    sl, sc = start_pos
-    el, ec = end_pos
-    if sl == el:
-      l = self.lines[sl]
-      print(l[sc:ec], end='')
-    else:
-      print(self.lines[sl][sc:], end='')
-      for line in self.lines[sl+1:el]: print(line, end='')
-      print(self.lines[el][:ec], end='')
-    # Need to print end tag, which comes after `ec`.
-    last = self.lines[el]
-    close_pos = last.index('>', ec)
-    print(last[ec:close_pos+1])
-
   @property
   def pos(self) -> Pos:
     line1, col0 = self.getpos()
@@ -89,4 +156,32 @@ class Parser(HTMLParser):
     print(f'{self.path}:{pos[0]+1}:{pos[1]+1}: {msg}')
 
 
+# Sidecar index.
+
+def index_path(path: str) -> str:
+  return path + '.ids.json'
+
+
+def load_index(path: str) -> Optional[Dict[str, ByteRange]]:
+  'Return the recorded ranges if the index exists and was built from the current contents of `path`.'
+  try:
+    with open(index_path(path)) as f:
+      index = json.load(f)
+    st = stat(path)
+  except (OSError, ValueError): return None
+  if not isinstance(index, dict) or index.get('signature') != [st.st_size, st.st_mtime_ns]: return None
+  return { id: (start, end) for id, (start, end) in index.get('ids', {}).items() }
+
+
+def save_index(path: str, signature: List[int], ranges: Dict[str, ByteRange]) -> None:
+  index = { 'signature': signature, 'ids': ranges }
+  dst = index_path(path)
+  tmp = f'{dst}.{getpid()}.tmp' # Concurrent queries must never observe a partial index.
+  try:
+    with open(tmp, 'w') as f:
+      json.dump(index, f)
+    replace(tmp, dst)
+  except OSError as e: print(f'warning: could not write index: {dst}: {e.strerror}', file=stderr)
+
+
 if __name__ == '__main__': main()
@@ -3,51 +3,265 @@
 
 '''
 Serve a file or `stdin` to a new browser window.
+Files are served relative to the current directory, which is treated as the project root.
+Writeup sources are rendered on request; requesting `x.html` renders `x.wu` if the html file does not exist.
+Pages reload automatically (via server-sent events) when their source or any of its dependencies change.
 '''
 
-import subprocess
+import gzip
+import sys
+from argparse import ArgumentParser
+from contextlib import redirect_stderr
+from hashlib import sha256
+from html import escape as html_escape
 from http.server import HTTPServer, BaseHTTPRequestHandler
-from sys import argv, stdin
-from typing import BinaryIO, NoReturn
+from io import StringIO
+from mimetypes import guess_type
+from os import stat
+from os.path import isfile as is_file, normpath as norm_path, splitext as split_ext
+from socketserver import ThreadingMixIn
+from sys import stdin
+from threading import Lock
+from time import monotonic, sleep
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+from .v0 import load_assets, write_html, writeup_arg_parser # type: ignore
 
 
 def main() -> None:
+  arg_parser = ArgumentParser(prog='html-view', description='Serve a file or `stdin` to a new browser window.')
+  arg_parser.add_argument('path', nargs='?', help='HTML or writeup file to view, relative to the project root (defaults to stdin).')
+  arg_parser.add_argument('-port', type=int, default=8000, help='Port to serve on (default: 8000).')
+  arg_parser.add_argument('-no-open', action='store_true', help='Do not open a browser window.')
+  args = arg_parser.parse_args()
 
-  args = argv[1:]
-  if len(args) > 1:
-    exit('specify a single argument or pipe to stdin.')
+  stdin_page: Optional[Page] = None
+  if args.path is None:
+    stdin_page = make_page(stdin.buffer.read(), content_type='text/html; charset=utf-8', watched=())
+  elif not is_file(args.path):
+    exit(f'html-view: file does not exist: {args.path!r}')
 
-  path = args[0] if args else None
+  host, port = address = ('localhost', args.port)
+  server = PreviewServer(address, Handler, stdin_page=stdin_page)
+  url_path = '/' if args.path is None else '/' + quote(norm_path(args.path))
+  addr_str = f'http://{host}:{port}{url_path}'
+  print(addr_str)
+  if not args.no_open:
+    import webbrowser
+    webbrowser.open(addr_str) # The server socket is already bound, so the browser cannot race it.
+  try: server.serve_forever()
+  except KeyboardInterrupt: pass
 
-  f: BinaryIO
-  if path:
-    f = open(path, 'rb')
-  else:
-    f = stdin.detach() # type: ignore
 
+Signature = Tuple[Optional[Tuple[int, int]], ...] # Stat signatures of a page's watched paths.
 
-  class Handler(BaseHTTPRequestHandler):
 
-    def do_HEAD(self):
-      self.send_response(200)
-      self.send_header('Content-Type', 'text/html')
-      self.end_headers()
+class Page(NamedTuple):
+  body: bytes
+  content_type: str
+  etag: str
+  watched: Tuple[str, ...] # Paths whose modification should reload the page: the source and its dependencies.
+  status: int = 200
+
+
+def make_page(body: bytes, content_type: str, watched: Tuple[str, ...], status=200) -> Page:
+  return Page(body=body, content_type=content_type, etag=f'"{sha256(body).hexdigest()[:32]}"', watched=watched, status=status)
+
+
+def signature(paths: Tuple[str, ...]) -> Signature:
+  def stat_sig(path: str) -> Optional[Tuple[int, int]]:
+    try: st = stat(path)
+    except OSError: return None
+    return (st.st_mtime_ns, st.st_size)
+  return tuple(stat_sig(path) for path in paths)
+
+
+def signature_token(sig: Signature) -> str:
+  return sha256(repr(sig).encode()).hexdigest()[:16]
+
+
+class PreviewServer(ThreadingMixIn, HTTPServer):
+  '''
+  A threaded server that renders pages on demand.
+  Rendered pages are cached in memory, keyed by source path and validated against the stat signatures of the source and its dependencies.
+  '''
+  daemon_threads = True
+
+  def __init__(self, address: Tuple[str, int], handler: Any, stdin_page: Optional[Page]) -> None:
+    super().__init__(address, handler)
+    self.stdin_page = stdin_page
+    self.render_args = writeup_arg_parser().parse_args([])
+    self.css_lines, self.js = load_assets(self.render_args)
+    self.cache: Dict[str, Tuple[Signature, Page]] = {}
+    self.gzip_cache: Dict[str, bytes] = {} # Keyed by etag.
+    self.cache_lock = Lock()
+    self.render_lock = Lock() # Rendering redirects stderr to capture diagnostics, which is process-wide.
+
+  def page(self, src_path: str, is_wu: bool) -> Page:
+    with self.cache_lock:
+      cached = self.cache.get(src_path)
+    if cached is not None:
+      sig, page = cached
+      if signature(page.watched) == sig: return page
+    page = self.render_wu(src_path) if is_wu else self.read_static(src_path)
+    sig = signature(page.watched)
+    if page.content_type.startswith('text/html') and page.watched:
+      page = inject_reload(page, sig)
+    with self.cache_lock:
+      self.cache[src_path] = (sig, page)
+    return page
+
+  def render_wu(self, src_path: str) -> Page:
+    out = StringIO()
+    diagnostics = StringIO()
+    dependencies: List[str] = []
+    ok = True
+    with self.render_lock, redirect_stderr(diagnostics):
+      try:
+        with open(src_path) as f_in:
+          dependencies = write_html(self.render_args, src_path=src_path, f_in=f_in, f_out=out,
+            css_lines=self.css_lines, js=self.js, highlight_cache=None)
+      except SystemExit as e: # writeup reports errors by exiting.
+        if isinstance(e.code, str): print(e.code, file=diagnostics)
+        ok = not e.code
+    if ok:
+      return make_page(out.getvalue().encode(), content_type='text/html; charset=utf-8', watched=watched_paths(src_path, dependencies))
+    with self.cache_lock: # On failure, keep watching the dependencies of the last good render.
+      prev = self.cache.get(src_path)
+    watched = watched_paths(src_path, prev[1].watched if prev else ())
+    body = error_page(src_path, diagnostics.getvalue())
+    return make_page(body, content_type='text/html; charset=utf-8', watched=watched, status=500)
+
+  def read_static(self, path: str) -> Page:
+    with open(path, 'rb') as f:
+      body = f.read()
+    content_type = guess_type(path)[0] or 'application/octet-stream'
+    if content_type.startswith('text/'): content_type += '; charset=utf-8'
+    return make_page(body, content_type=content_type, watched=(path,))
+
+  def gzipped(self, page: Page) -> bytes:
+    with self.cache_lock:
+      compressed = self.gzip_cache.get(page.etag)
+    if compressed is None:
+      compressed = gzip.compress(page.body, compresslevel=6)
+      with self.cache_lock:
+        if len(self.gzip_cache) > 256: self.gzip_cache.clear()
+        self.gzip_cache[page.etag] = compressed
+    return compressed
 
-    def do_GET(self):
-      self.send_response(200)
-      self.send_header('Content-Type', 'text/html')
+
+def watched_paths(src_path: str, dependencies: Iterable[str]) -> Tuple[str, ...]:
+  'The source comes first; it identifies the page in event requests.'
+  return (src_path, *sorted(set(dependencies).difference((src_path,))))
+
+
+def error_page(src_path: str, diagnostics: str) -> bytes:
+  return (f'<!DOCTYPE html>\n<html>\n<head>\n  <meta charset="utf-8" />\n  <title>{html_escape(src_path)}</title>\n</head>\n'
+    f'<body>\n<pre>{html_escape(diagnostics)}</pre>\n</body>\n</html>\n').encode()
+
+
+def inject_reload(page: Page, sig: Signature) -> Page:
+  'Add a script that reloads the page when the server reports a change to its watched paths.'
+  query = f'path={quote(page.watched[0])}&sig={signature_token(sig)}'
+  script = ('<script type="text/javascript">'
+    f"new EventSource('/_writeup/events?{query}').addEventListener('reload', function() {{ location.reload(); }});"
+    '</script>\n').encode()
+  body = page.body
+  idx = body.rfind(b'</body>')
+  body = body + script if idx < 0 else body[:idx] + script + body[idx:]
+  return make_page(body, content_type=page.content_type, watched=page.watched, status=page.status)
+
+
+class Handler(BaseHTTPRequestHandler):
+
+  server: PreviewServer
+  protocol_version = 'HTTP/1.1'
+  events_poll_interval = 0.1
+  events_keepalive_interval = 15.0
+
+  def log_message(self, format: str, *args: Any) -> None:
+    # Write to the original stderr; `sys.stderr` is redirected while rendering to capture diagnostics.
+    print(f'{self.address_string()} - [{self.log_date_time_string()}] {format % args}', file=sys.__stderr__)
+
+  def do_HEAD(self) -> None:
+    self.handle_request(send_body=False)
+
+  def do_GET(self) -> None:
+    self.handle_request(send_body=True)
+
+  def handle_request(self, send_body: bool) -> None:
+    url = urlsplit(self.path)
+    path = unquote(url.path)
+    if path == '/_writeup/events':
+      self.send_events(parse_qs(url.query))
+      return
+    if self.server.stdin_page is not None and path == '/':
+      self.send_page(self.server.stdin_page, send_body)
+      return
+    rel_path = norm_path(path.lstrip('/') or '.')
+    if rel_path.startswith('..') or rel_path.startswith('/'):
+      self.send_error(403)
+      return
+    stem, ext = split_ext(rel_path)
+    if ext == '.wu' and is_file(rel_path):
+      page = self.server.page(rel_path, is_wu=True)
+    elif is_file(rel_path):
+      page = self.server.page(rel_path, is_wu=False)
+    elif ext == '.html' and is_file(stem + '.wu'):
+      page = self.server.page(stem + '.wu', is_wu=True)
+    else:
+      self.send_error(404)
+      return
+    self.send_page(page, send_body)
+
+  def send_page(self, page: Page, send_body: bool) -> None:
+    if page.status == 200 and page.etag in self.headers.get('If-None-Match', ''):
+      self.send_response(304)
+      self.send_header('ETag', page.etag)
       self.end_headers()
-      for line in f:
-        self.wfile.write(line)
-        self.wfile.flush()
+      return
+    body = page.body
+    use_gzip = 'gzip' in self.headers.get('Accept-Encoding', '') and len(body) > 1024 and is_compressible(page.content_type)
+    if use_gzip: body = self.server.gzipped(page)
+    self.send_response(page.status)
+    self.send_header('Content-Type', page.content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.send_header('ETag', page.etag)
+    self.send_header('Cache-Control', 'no-cache') # Always revalidate; unchanged pages cost a 304.
+    self.send_header('Vary', 'Accept-Encoding')
+    if use_gzip: self.send_header('Content-Encoding', 'gzip')
+    self.end_headers()
+    if send_body: self.wfile.write(body)
+
+  def send_events(self, query: Dict[str, List[str]]) -> None:
+    'Server-sent events: emit `reload` once the watched paths of the page no longer match the signature it was rendered with.'
+    path = norm_path(query.get('path', [''])[0])
+    token = query.get('sig', [''])[0]
+    with self.server.cache_lock:
+      cached = self.server.cache.get(path)
+    watched = cached[1].watched if cached else ()
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/event-stream')
+    self.send_header('Cache-Control', 'no-cache')
+    self.end_headers()
+    self.close_connection = True
+    last_write = monotonic()
+    try:
+      while signature_token(signature(watched)) == token:
+        sleep(self.events_poll_interval)
+        if monotonic() - last_write > self.events_keepalive_interval:
+          self.wfile.write(b': keepalive\n\n')
+          self.wfile.flush()
+          last_write = monotonic()
+      self.wfile.write(b'event: reload\ndata: \n\n')
+      self.wfile.flush()
+    except (BrokenPipeError, ConnectionResetError): pass # The page was closed or reloaded.
 
 
-  host, port = address = ('localhost', 8000)
-  addr_str = 'http://{}:{}'.format(host, port)
-  #print(addr_str)
-  server = HTTPServer(address, Handler)
-  subprocess.Popen(['open', addr_str]) # race condition!
-  server.handle_request()
+def is_compressible(content_type: str) -> bool:
+  return content_type.startswith('text/') or content_type.split(';')[0] in {
+    'application/javascript', 'application/json', 'image/svg+xml'}
 
 
 if __name__ == '__main__': main()
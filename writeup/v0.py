@@ -6,49 +6,61 @@ assert sys.version_info >= (3, 6, 0)
 
 import re
 
-from argparse import ArgumentParser
 from collections import defaultdict
 from html import escape as html_escape
 from os.path import normpath as norm_path, dirname as path_dir, exists as path_exists, join as path_join, \
-basename as path_name, relpath as rel_path, splitext as split_ext
-from sys import stdin, stdout, stderr
-from typing import Any, Callable, DefaultDict, Dict, Iterable, Iterator, List, Match, NoReturn, Optional, Sequence, Union, TextIO, Tuple, cast
+getsize as path_getsize, abspath as abs_path, basename as path_name, isdir as path_isdir, relpath as rel_path, splitext as split_ext
+from os import getpid
+from sys import stdin, stdout
+from time import perf_counter
+from typing import Any, AsyncIterator, BinaryIO, Callable, DefaultDict, Dict, IO, Iterable, Iterator, List, NamedTuple, NoReturn, Optional, Sequence, Set, Union, TextIO, Tuple, TYPE_CHECKING, cast
 
-import pygments # type: ignore
-import pygments.lexers # type: ignore
-import pygments.token # type: ignore
-from pygments.token import Token
-from pygments.token import *
+if TYPE_CHECKING: # concurrent.futures is only imported when embeds are rendered concurrently.
+  from concurrent.futures import Executor, Future
 
-__all__ = ['main', 'writeup', 'writeup_dependencies']
+# pygments is imported lazily by the code embedding functions; most documents and all `-deps` runs never need it.
+
+__all__ = ['Diagnostic', 'Renderer', 'WriteupError', 'main', 'writeup', 'writeup_dependencies']
 
 
 SrcLine = Tuple[int, str]
+LoggedMsg = Tuple[SrcLine, str, Tuple[Any, ...], Optional[int]] # Arguments to `Ctx.msg`: (src, label, items, col).
+CssRule = Tuple[str, str] # (selector, style).
 
 
 def main() -> None:
-  arg_parser = ArgumentParser(prog='writeup', description='Converts .wu files to html.')
-  arg_parser.add_argument('src_path', nargs='?', help='Input .wu source path; defaults to <stdin>.')
-  arg_parser.add_argument('dst_path', nargs='?', help='Output path: defaults to <stdout>.')
-  arg_parser.add_argument('-deps', action='store_true',
-    help='Print external file dependencies of the input, one per line. Does not output HTML.')
-  arg_parser.add_argument('-css-paths', nargs='+', default=(), help='paths to CSS.')
-  arg_parser.add_argument('-no-css', action='store_true', help='Omit default CSS.')
-  arg_parser.add_argument('-no-js', action='store_true', help='Omit default Javascript.')
-  arg_parser.add_argument('-bare', action='store_true', help='Omit the top-level HTML document structure.')
-  arg_parser.add_argument('-section', help='Emit only the specified section.')
-  arg_parser.add_argument('-dbg', action='store_true', help='print debug info.')
-
+  arg_parser = writeup_arg_parser()
   args = arg_parser.parse_args()
+  if args.profile:
+    import cProfile
+    profiler = cProfile.Profile()
+    try: profiler.runcall(main_args, args)
+    finally: profiler.dump_stats(args.profile)
+  else:
+    main_args(args)
+
+
+def main_args(args: Any) -> None:
+  if args.watch:
+    exit(main_watch(args))
+  if args.batch or args.manifest:
+    exit(main_batch(args))
 
   if args.src_path == '': exit('source path cannot be empty string.')
   if args.dst_path == '': exit('destination path cannot be empty string.')
   if args.src_path == args.dst_path and args.src_path is not None:
     exit(f'source path and destination path cannot be the same path: {args.src_path!r}')
+  if args.precompress and not args.dst_path and not args.deps:
+    exit('writeup: `-precompress` requires a destination path.')
+
+  if args.cache_dir and args.src_path and args.dst_path and not args.deps:
+    if build_cache_is_fresh(args, src_path=args.src_path, dst_path=args.dst_path): exit(0)
 
   try:
     f_in  = open(args.src_path) if args.src_path else stdin
-    f_out = open(args.dst_path, 'w') if args.dst_path else stdout
+    f_out: Union[TextIO, AtomicOutput] = stdout
+    if args.dst_path:
+      f_out = AtomicOutput(args.dst_path, **({} if args.deps else precompress_options(args)))
   except FileNotFoundError as e: exit(f'writeup error: file does not exist: {e.filename}')
   src_path = f_in.name
 
@@ -61,41 +73,229 @@ def main() -> None:
       text_lines=f_in,
       emit_dbg=args.dbg,
     )
-    for dep in dependencies:
-      print(dep, file=f_out)
-    exit(0)
+    from contextlib import nullcontext
+    with f_out if isinstance(f_out, AtomicOutput) else nullcontext():
+      write_lines(f_out, dependencies)
+    return
+
+  from contextlib import nullcontext
+  css_lines, js = load_assets(args)
+  shared_assets = write_shared_assets(args, css_lines, js)
+  embed_pool = EmbedPool(args.embed_jobs) if args.embed_jobs else None
+  timings = Timings() if args.timings else None
+  try:
+    # On failure the temporary output is discarded and any existing destination is left intact.
+    with f_out if isinstance(f_out, AtomicOutput) else nullcontext():
+      dependencies = write_html(args, src_path=src_path, f_in=f_in, f_out=f_out, css_lines=css_lines, js=js,
+        highlight_cache=load_highlight_cache(args), embed_pool=embed_pool, timings=timings,
+        shared_assets=shared_assets, dst_path=args.dst_path)
+  finally:
+    if embed_pool: embed_pool.shutdown()
+  if timings: timings.report()
+  if args.cache_dir and args.src_path and args.dst_path:
+    build_cache_record(args, src_path=src_path, dst_path=args.dst_path, dependencies=dependencies)
+
+
+def writeup_arg_parser() -> Any:
+  from argparse import ArgumentParser
+  arg_parser = ArgumentParser(prog='writeup', description='Converts .wu files to html.')
+  arg_parser.add_argument('src_path', nargs='?', help='Input .wu source path; defaults to <stdin>.')
+  arg_parser.add_argument('dst_path', nargs='?', help='Output path: defaults to <stdout>.')
+  arg_parser.add_argument('-deps', action='store_true',
+    help='Print external file dependencies of the input, one per line. Does not output HTML.')
+  arg_parser.add_argument('-css-paths', nargs='+', default=(), help='paths to CSS.')
+  arg_parser.add_argument('-no-css', action='store_true', help='Omit default CSS.')
+  arg_parser.add_argument('-no-js', action='store_true', help='Omit default Javascript.')
+  arg_parser.add_argument('-bare', action='store_true', help='Omit the top-level HTML document structure.')
+  arg_parser.add_argument('-section', action='append',
+    help='Emit only the specified section, identified by its number (e.g. `2.3.1`) or its title; may be repeated. '
+    'Other sections are not rendered, and their embeds are not read.')
+  arg_parser.add_argument('-stream', action='store_true',
+    help='Emit each top-level section as soon as it is parsed, bounding memory by the largest section; '
+    'document-specific CSS moves to the end of the body.')
+  arg_parser.add_argument('-batch', action='store_true',
+    help='Treat `src_path` and `dst_path` as directories: render every .wu file under `src_path` to .html under `dst_path`.')
+  arg_parser.add_argument('-manifest', help='Render every `src_path dst_path` pair listed in the manifest file, one pair per line.')
+  arg_parser.add_argument('-watch', action='store_true',
+    help='Keep running and re-render whenever a source or one of its dependencies changes; combine with `-batch` or `-manifest` to watch many documents.')
+  arg_parser.add_argument('-jobs', type=int, default=None, help='Number of batch worker processes; defaults to the CPU count.')
+  arg_parser.add_argument('-embed-jobs', type=int, default=0,
+    help='Read and highlight embedded files concurrently with parsing, using this many threads and highlighting processes '
+    '(default: 0, embed synchronously). Ignored in batch and watch modes, which already render documents in parallel.')
+  arg_parser.add_argument('-cache-dir',
+    help='Directory for the incremental build cache; skip rendering when the source, dependencies and options are unchanged.')
+  arg_parser.add_argument('-highlight-cache-size', type=float, default=64,
+    help='Size cap in MiB of the syntax highlighting cache kept in `-cache-dir` (default: 64).')
+  arg_parser.add_argument('-inline-image-size', type=float, default=0,
+    help='Inline embedded images smaller than this many KiB as data URIs (default: 0, never).')
+  arg_parser.add_argument('-assets-dir',
+    help='Write the default and `-css-paths` CSS and the default Javascript to content-hashed files in this directory, '
+    'and link to them from each page instead of inlining them; only document-specific CSS remains inline.')
+  arg_parser.add_argument('-precompress', type=parse_precompress_formats, default=(),
+    help='Also write compressed copies of the output next to it, for static file servers: '
+    f'a comma-separated list of formats from: {", ".join(precompress_exts)} (e.g. `gzip` writes `page.html.gz`).')
+  arg_parser.add_argument('-precompress-level', type=int, default=9, choices=range(10), metavar='0-9',
+    help='Compression level for `-precompress` (default: 9).')
+  arg_parser.add_argument('-timings', action='store_true',
+    help='Report the wall time and call count of each rendering phase, and the cost of each embed, to stderr.')
+  arg_parser.add_argument('-profile', help='Write cProfile statistics for the whole run to this path.')
+  arg_parser.add_argument('-dbg', action='store_true', help='print debug info.')
+  return arg_parser
 
-  css_blocks = [] if (args.bare or args.no_css) else [default_css]
+
+def load_assets(args: Any) -> Tuple[List[str], Optional[str]]:
+  'Read and minify the CSS and Javascript specified by the command line options.'
+  css_lines = [] if (args.bare or args.no_css) else list(default_css_lines())
+  css_blocks = []
   for path in args.css_paths:
     try:
       with open(path) as f:
         css_blocks.append(f.read())
     except FileNotFoundError:
       exit(f'writeup: css file does not exist: {path!r}')
+  css_lines.extend(minify_css(css_blocks))
+  js = None if args.bare or args.no_js else default_js_min()
+  return css_lines, js
+
+
+_default_css_lines: Optional[Tuple[str, ...]] = None
+_default_js_min: Optional[str] = None
+
+def default_css_lines() -> Tuple[str, ...]:
+  'The minified default CSS, computed once per process.'
+  global _default_css_lines
+  if _default_css_lines is None: _default_css_lines = tuple(minify_css([default_css]))
+  return _default_css_lines
+
+def default_js_min() -> str:
+  'The minified default Javascript, computed once per process.'
+  global _default_js_min
+  if _default_js_min is None: _default_js_min = minify_js(default_js)
+  return _default_js_min
 
-  else:
-    html_lines_gen = writeup(
-      src_path=src_path,
-      src_lines=enumerate(f_in),
-      title=split_ext(path_name(src_path))[0],
-      description='', # TODO.
-      author='', # TODO.
-      css_lines=minify_css(css_blocks),
-      js=(None if args.bare or args.no_js else minify_js(default_js)),
-      emit_doc=(not args.bare),
-      target_section=args.section,
-      emit_dbg=args.dbg,
-    )
-    for line in html_lines_gen:
-      print(line, file=f_out)
+
+class SharedAssets(NamedTuple):
+  'The content-hashed asset files written for `-assets-dir`.'
+  css_path: Optional[str]
+  js_path: Optional[str]
+
+
+def write_shared_assets(args: Any, css_lines: List[str], js: Optional[str]) -> Optional[SharedAssets]:
+  '''
+  For `-assets-dir`, write the shared CSS and Javascript to files named by the hash of their contents,
+  so that pages can link to them and browsers can cache them indefinitely.
+  '''
+  if not args.assets_dir or args.bare: return None
+  from os import makedirs
+  makedirs(args.assets_dir, exist_ok=True)
+  return SharedAssets(
+    css_path=write_shared_asset(args, 'css', ''.join(line + '\n' for line in css_lines)) if css_lines else None,
+    js_path=write_shared_asset(args, 'js', f'"use strict";{js}\n') if js else None)
+
+
+def write_shared_asset(args: Any, ext: str, text: str) -> str:
+  from hashlib import sha256
+  path = path_join(args.assets_dir, f'writeup.{sha256(text.encode()).hexdigest()[:12]}.{ext}')
+  with AtomicOutput(path, **precompress_options(args)) as f: # Unchanged files are left untouched.
+    f.write(text)
+  return path
+
+
+def asset_href(asset_path: str, dst_path: Optional[str]) -> str:
+  'The URL of an asset file relative to the page at `dst_path` (or the current directory, for `stdout`).'
+  from urllib.parse import quote
+  return quote(rel_path(asset_path, path_dir(abs_path(dst_path)) if dst_path else '.'))
+
+
+def load_highlight_cache(args: Any) -> Optional['HighlightCache']:
+  if not args.cache_dir: return None
+  return HighlightCache(path_join(args.cache_dir, 'highlight'), max_size=int(args.highlight_cache_size * (1 << 20)))
+
+
+def write_html(args: Any, src_path: str, f_in: TextIO, f_out: Union[TextIO, 'AtomicOutput'], css_lines: List[str], js: Optional[str],
+ highlight_cache: Optional['HighlightCache'], embed_pool: Optional['EmbedPool']=None, timings: Optional['Timings']=None,
+ shared_assets: Optional[SharedAssets]=None, dst_path: Optional[str]=None) -> List[str]:
+  '''
+  Render a single document according to the command line options. Returns the dependencies of the document.
+  If `shared_assets` is set, the page links to those files instead of inlining `css_lines` and `js`.
+  '''
+  start_time = perf_counter()
+  dependencies: List[str] = []
+  css_href: Optional[str] = None
+  js_src: Optional[str] = None
+  if shared_assets:
+    if shared_assets.css_path: css_href = asset_href(shared_assets.css_path, dst_path)
+    if shared_assets.js_path: js_src = asset_href(shared_assets.js_path, dst_path)
+    css_lines = []
+    js = None
+  html_lines_gen = writeup(
+    src_path=src_path,
+    src_lines=enumerate(f_in),
+    title=split_ext(path_name(src_path))[0],
+    description='', # TODO.
+    author='', # TODO.
+    css_lines=iter(css_lines),
+    js=js,
+    emit_doc=(not args.bare),
+    target_section=args.section,
+    emit_dbg=args.dbg,
+    stream=args.stream,
+    env=Env(highlight_cache=highlight_cache, embed_pool=embed_pool, inline_image_size=int(args.inline_image_size * 1024),
+      timings=timings),
+    dependencies=dependencies,
+    css_href=css_href,
+    js_src=js_src,
+  )
+  write_lines(f_out, html_lines_gen, timings=timings)
+  if timings: timings.add('total', perf_counter() - start_time)
+  return dependencies
+
+
+def write_lines(f_out: Union[TextIO, 'AtomicOutput'], lines: Iterable[str], timings: Optional['Timings']=None) -> None:
+  '''
+  Write each line followed by a newline, joining lines into large writes;
+  a `print` call per line costs more than the file operation it performs.
+  Lines are still written as they are generated, so streamed output stays incremental.
+  '''
+  buffer: List[str] = []
+  size = 0
+  for line in lines:
+    buffer.append(line)
+    size += len(line)
+    if size >= write_buffer_size:
+      buffer.append('')
+      with timed(timings, 'write output'): f_out.write('\n'.join(buffer))
+      buffer.clear()
+      size = 0
+  if buffer:
+    buffer.append('')
+    with timed(timings, 'write output'): f_out.write('\n'.join(buffer))
+
+write_buffer_size = 1 << 16
 
 
 def writeup(src_path: str, src_lines: Iterable[SrcLine], title: str, description: str, author: str,
-  css_lines: Optional[Iterator[str]], js: Optional[str], emit_doc: bool, target_section: Optional[str], emit_dbg: bool) -> Iterable[str]:
-  'generate a complete html document from a writeup file (or stream of lines).'
+  css_lines: Optional[Iterator[str]], js: Optional[str], emit_doc: bool, target_section: Union[str, Sequence[str], None],
+  emit_dbg: bool,
+  stream=False, env: Optional['Env']=None, dependencies: Optional[List[str]]=None,
+  css_href: Optional[str]=None, js_src: Optional[str]=None) -> Iterable[str]:
+  '''
+  generate a complete html document from a writeup file (or stream of lines).
+  If `stream` is true, each top-level block is emitted and then discarded as soon as it is parsed;
+  the CSS rules accumulated while rendering are then emitted in a trailing style element.
+  If `dependencies` is provided, the transitive dependencies of the document are appended to it once rendering completes.
+  `css_href` and `js_src` link to external stylesheet and script files, which are included before `css_lines` and `js`.
+  If `target_section` is a section number or title, or a sequence of them, only those sections are emitted;
+  the contents of other sections are never finished, so their spans are not parsed and their embeds are not read.
+  '''
 
-  ctx = Ctx(src_path=src_path, should_embed=True, emit_dbg=emit_dbg)
-  parse(ctx=ctx, src_lines=src_lines)
+  target_sections = (target_section,) if isinstance(target_section, str) else target_section
+  ctx = Ctx(src_path=src_path, should_embed=True, emit_dbg=emit_dbg, env=env, target_sections=target_sections)
+  timings = ctx.env.timings
+  if not stream:
+    with timed(timings, 'parse'):
+      parse(ctx=ctx, src_lines=src_lines)
+      ctx.resolve_embeds() # The CSS rules of concurrent embeds are needed for the head.
 
   if emit_doc:
     yield from [
@@ -103,25 +303,39 @@ def writeup(src_path: str, src_lines: Iterable[SrcLine], title: str, description
       '<html>',
       '<head>',
       '  <meta charset="utf-8" />',
-      f' <title>{title}</title>',
-      f' <meta name="description" content="{description}" />',
-      f' <meta name="author" content="{author}" />',
+      f' <title>{html_esc(title)}</title>',
+      f' <meta name="description" content="{html_esc_attr(description)}" />',
+      f' <meta name="author" content="{html_esc_attr(author)}" />',
       '  <link rel="icon" type="image/png" href="data:image/png;base64,iVBORw0KGgo=" />', # empty icon.
     ]
-    if css_lines is not None:
+    if css_href:
+      yield f'  <link rel="stylesheet" type="text/css" href="{html_esc_attr(css_href)}" />'
+    if css_lines is not None and not (css_href and (stream or not ctx.css)): # Omit an empty style element.
       yield f'  <style type="text/css">'
       yield from css_lines
-      yield from ctx.render_css()
+      if not stream: yield from timed_iter(timings, 'render css', ctx.render_css())
       yield '  </style>'
+    if js_src: # Not deferred: the table script at the end of the body assigns to variables that this script declares.
+      yield f'  <script type="text/javascript" src="{html_esc_attr(js_src)}"></script>'
     if js:
       yield f'  <script type="text/javascript"> "use strict";{js}</script>'
     yield '</head>'
     yield '<body id="body">'
 
-  yield from ctx.emit_html(depth=0, target_section=target_section)
-  if target_section is not None and not ctx.found_target_section: exit(f'target section not found: {target_section!r}')
+  if stream:
+    for block in timed_iter(timings, 'parse', parse_finished_blocks(ctx=ctx, src_lines=src_lines)):
+      yield from timed_iter(timings, 'emit html', ctx.emit_block_html(block, depth=0))
+    if emit_doc and css_lines is not None and ctx.css:
+      yield '<style type="text/css">'
+      yield from timed_iter(timings, 'render css', ctx.render_css())
+      yield '</style>'
+  else:
+    yield from timed_iter(timings, 'emit html', ctx.emit_html(depth=0))
+  if target_sections is not None:
+    missing = [t for t in target_sections if t not in ctx.found_target_sections]
+    if missing: ctx.fail(f'target section{"" if len(missing) == 1 else "s"} not found: {", ".join(repr(t) for t in missing)}')
 
-  if bool(js):
+  if js or js_src:
     # Generate tables.
     yield '<script type="text/javascript"> "use strict";'
     section_ids = ','.join(f"'s{sid}'" for sid in ctx.section_ids)
@@ -135,6 +349,8 @@ def writeup(src_path: str, src_lines: Iterable[SrcLine], title: str, description
       yield '<br />\n'.join(ctx.license_lines)
       yield '</footer>'
     yield '</body>\n</html>'
+  if dependencies is not None:
+    dependencies.extend(ctx.dependencies)
 
 
 def writeup_dependencies(src_path: str, text_lines: Iterable[str], emit_dbg=False) -> List[str]:
@@ -146,9 +362,849 @@ def writeup_dependencies(src_path: str, text_lines: Iterable[str], emit_dbg=Fals
   return sorted(ctx.dependencies)
 
 
+# Batch.
+
+BatchJob = Tuple[str, str] # (src_path, dst_path).
+
+
+def main_batch(args: Any) -> int:
+  'Render many documents over a process pool; returns the exit status after every document has been attempted.'
+  if args.deps: exit('writeup: `-deps` is not supported in batch mode.')
+  jobs = batch_jobs(args)
+  if args.jobs is not None and args.jobs < 1: exit(f'writeup: `-jobs` must be positive: {args.jobs}')
+  load_assets(args) # Report bad css paths once, before starting any workers.
+
+  from concurrent.futures import ProcessPoolExecutor
+  from os import cpu_count
+  workers = args.jobs or cpu_count() or 1
+  chunksize = max(1, len(jobs) // (4 * workers)) # Amortize IPC without starving workers at the tail.
+  failures = 0
+  with ProcessPoolExecutor(max_workers=workers) as executor:
+    results = executor.map(batch_render, jobs, [args] * len(jobs), chunksize=chunksize)
+    for (src_path, dst_path), (ok, diagnostics, _) in zip(jobs, results): # Results arrive in job order.
+      if diagnostics: sys.stderr.write(diagnostics)
+      if not ok:
+        failures += 1
+        errSL(f'writeup: failed: {src_path} -> {dst_path}')
+  if failures:
+    errSL(f'writeup: {failures} of {len(jobs)} documents failed.')
+    return 1
+  return 0
+
+
+def batch_jobs(args: Any) -> List[BatchJob]:
+  if args.manifest:
+    if args.batch or args.src_path is not None: exit('writeup: `-manifest` does not take `-batch` or positional paths.')
+    return batch_jobs_from_manifest(args.manifest)
+  if not args.src_path or not args.dst_path: exit('writeup: `-batch` requires source and destination directories.')
+  return batch_jobs_from_dirs(args.src_path, args.dst_path)
+
+
+def batch_jobs_from_dirs(src_dir: str, dst_dir: str) -> List[BatchJob]:
+  from os import walk
+  if not path_isdir(src_dir): exit(f'writeup: batch source is not a directory: {src_dir!r}')
+  jobs: List[BatchJob] = []
+  for dir_path, dir_names, file_names in walk(src_dir):
+    dir_names.sort()
+    for name in sorted(file_names):
+      stem, ext = split_ext(name)
+      if ext != '.wu': continue
+      rel_dir = rel_path(dir_path, start=src_dir)
+      jobs.append((path_join(dir_path, name), norm_path(path_join(dst_dir, rel_dir, stem + '.html'))))
+  return jobs
+
+
+def batch_jobs_from_manifest(manifest_path: str) -> List[BatchJob]:
+  try: f = open(manifest_path)
+  except FileNotFoundError: exit(f'writeup: manifest file does not exist: {manifest_path!r}')
+  jobs: List[BatchJob] = []
+  with f:
+    for line_num, line in enumerate(f, 1):
+      words = line.split()
+      if not words: continue
+      if len(words) != 2: exit(f'{manifest_path}:{line_num}: expected `src_path dst_path`; found: {line.strip()!r}')
+      src_path, dst_path = words
+      if src_path == dst_path:
+        exit(f'{manifest_path}:{line_num}: source path and destination path cannot be the same path: {src_path!r}')
+      jobs.append((src_path, dst_path))
+  return jobs
+
+
+_batch_assets: Optional[Tuple[List[str], Optional[str], Optional[SharedAssets], Optional['HighlightCache']]] = None # Warm per-worker state.
+
+def batch_render(job: BatchJob, args: Any) -> Tuple[bool, str, Optional[List[str]]]:
+  '''
+  Render a single batch job in a worker process, capturing diagnostics.
+  Returns (ok, diagnostics, dependencies); dependencies is None if the render did not complete.
+  '''
+  from contextlib import redirect_stderr
+  from io import StringIO
+  from os import makedirs
+  global _batch_assets
+  if _batch_assets is None:
+    css_lines, js = load_assets(args)
+    _batch_assets = (css_lines, js, write_shared_assets(args, css_lines, js), load_highlight_cache(args))
+  css_lines, js, shared_assets, highlight_cache = _batch_assets
+  src_path, dst_path = job
+  diagnostics = StringIO()
+  ok = True
+  dependencies: Optional[List[str]] = None
+  with redirect_stderr(diagnostics):
+    try:
+      if args.cache_dir and build_cache_is_fresh(args, src_path=src_path, dst_path=dst_path):
+        return True, '', build_cache_dependencies(args, src_path=src_path, dst_path=dst_path)
+      dst_dir = path_dir(dst_path)
+      if dst_dir: makedirs(dst_dir, exist_ok=True)
+      with open(src_path) as f_in, AtomicOutput(dst_path, **precompress_options(args)) as f_out:
+        dependencies = write_html(args, src_path=src_path, f_in=f_in, f_out=f_out, css_lines=css_lines, js=js,
+          highlight_cache=highlight_cache, shared_assets=shared_assets, dst_path=dst_path)
+      if args.cache_dir:
+        build_cache_record(args, src_path=src_path, dst_path=dst_path, dependencies=dependencies)
+    except SystemExit as e:
+      if isinstance(e.code, str): errSL(e.code)
+      ok = not e.code
+    except OSError as e:
+      errSL(f'writeup error: {e.strerror}: {e.filename}')
+      ok = False
+    except Exception as e: # A bad document must not abort the rest of the batch.
+      errSL(f'writeup error: {src_path}: {type(e).__name__}: {e}')
+      ok = False
+  return ok, diagnostics.getvalue(), (dependencies if ok else None)
+
+
+# Watch.
+
+def main_watch(args: Any) -> int:
+  '''
+  Render the specified documents, then re-render each one whenever its source or any of its dependencies change.
+  Rendering happens in this process, so pygments, compiled regexes and minified assets stay warm between edits.
+  '''
+  from time import perf_counter
+  global _batch_assets
+  if args.deps: exit('writeup: `-deps` is not supported in watch mode.')
+  is_dir_mode = args.batch and not args.manifest
+  if args.batch or args.manifest:
+    jobs = batch_jobs(args)
+  else:
+    if not args.src_path or not args.dst_path: exit('writeup: `-watch` requires source and destination paths.')
+    if args.src_path == args.dst_path:
+      exit(f'source path and destination path cannot be the same path: {args.src_path!r}')
+    jobs = [(args.src_path, args.dst_path)]
+  load_assets(args) # Report bad css paths before watching.
+
+  job_deps: Dict[BatchJob, List[str]] = {}
+
+  def render(job: BatchJob) -> None:
+    start_time = perf_counter()
+    ok, diagnostics, dependencies = batch_render(job, args)
+    if diagnostics: sys.stderr.write(diagnostics)
+    if dependencies is not None: job_deps[job] = dependencies # On failure, keep watching the previous dependencies.
+    status = 'updated' if ok else 'failed'
+    errSL(f'writeup: {status}: {job[0]} -> {job[1]} ({(perf_counter() - start_time) * 1000:.0f} ms)')
+
+  for job in jobs: render(job)
+
+  watcher = make_watcher()
+  try:
+    while True:
+      dst_paths = { abs_path(dst + ext) for _, dst in jobs for ext in ('', *precompressed_exts(args)) } # Never react to our own output.
+      css_paths = { abs_path(path) for path in args.css_paths }
+      files = { abs_path(src) for src, _ in jobs } | css_paths
+      for job in jobs: files.update(abs_path(dep) for dep in job_deps.get(job, ()))
+      dirs = watch_dirs(args.src_path) if is_dir_mode else set()
+      watcher.watch(files=files - dst_paths, dirs=dirs)
+
+      changed = watcher.wait() - dst_paths
+      if not changed: continue
+      if changed & css_paths:
+        _batch_assets = None # Reload assets; every document is affected.
+        affected = list(jobs)
+      else:
+        affected = [job for job in jobs if abs_path(job[0]) in changed
+          or any(abs_path(dep) in changed for dep in job_deps.get(job, ()))]
+      if is_dir_mode: # Pick up added and removed sources.
+        prev_jobs = set(jobs)
+        jobs = batch_jobs(args)
+        affected.extend(job for job in jobs if job not in prev_jobs)
+        for job in prev_jobs.difference(jobs): job_deps.pop(job, None)
+      for job in affected: render(job)
+  except KeyboardInterrupt: return 0
+
+
+def watch_dirs(root: str) -> Set[str]:
+  from os import walk
+  return { abs_path(dir_path) for dir_path, _, _ in walk(root) }
+
+
+def make_watcher(debounce=0.05) -> 'BaseWatcher':
+  'Return an inotify watcher on Linux, falling back to polling elsewhere or if inotify is unavailable.'
+  if sys.platform.startswith('linux'):
+    try: return InotifyWatcher(debounce=debounce)
+    except OSError: pass
+  return PollingWatcher(debounce=debounce)
+
+
+class BaseWatcher:
+  '''
+  Waits for changes to a set of files, and to the entries of a set of directories.
+  A burst of changes (e.g. an editor saving several files) is reported as a single set once it has been quiet for `debounce` seconds.
+  '''
+
+  def __init__(self, debounce: float) -> None:
+    self.debounce = debounce
+    self.files: Set[str] = set()
+    self.dirs: Set[str] = set()
+
+  def watch(self, files: Set[str], dirs: Set[str]) -> None:
+    self.files = files
+    self.dirs = dirs
+
+  def wait(self) -> Set[str]:
+    'Block until something changes; return the absolute paths of changed files and directory entries.'
+    raise NotImplementedError
+
+  def is_watched(self, path: str) -> bool:
+    return path in self.files or path_dir(path) in self.dirs
+
+
+class PollingWatcher(BaseWatcher):
+
+  interval = 0.1
+
+  def __init__(self, debounce: float) -> None:
+    super().__init__(debounce=debounce)
+    self.stats: Dict[str, Optional[Tuple[int, int]]] = {}
+
+  def watch(self, files: Set[str], dirs: Set[str]) -> None:
+    super().watch(files=files, dirs=dirs)
+    for path in files | dirs:
+      if path not in self.stats: self.stats[path] = self.stat(path)
+    for path in set(self.stats).difference(files, dirs): del self.stats[path]
+
+  def wait(self) -> Set[str]:
+    from time import sleep
+    changed: Set[str] = set()
+    while True:
+      sleep(self.debounce if changed else self.interval)
+      new_changes = self.poll()
+      if new_changes: changed.update(new_changes)
+      elif changed: return changed
+
+  def poll(self) -> Set[str]:
+    changed = set()
+    for path, prev in self.stats.items():
+      curr = self.stat(path)
+      if curr != prev:
+        self.stats[path] = curr
+        changed.add(path) # A changed directory mtime means entries were added or removed.
+    return changed
+
+  @staticmethod
+  def stat(path: str) -> Optional[Tuple[int, int]]:
+    from os import stat
+    try: st = stat(path)
+    except OSError: return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+class InotifyWatcher(BaseWatcher):
+  '''
+  Linux inotify, via ctypes.
+  Files are watched through their parent directories, because editors commonly save by replacing the file.
+  '''
+
+  # From <sys/inotify.h>.
+  IN_CLOSE_WRITE = 0x8
+  IN_MOVED_FROM = 0x40
+  IN_MOVED_TO = 0x80
+  IN_CREATE = 0x100
+  IN_DELETE = 0x200
+  IN_Q_OVERFLOW = 0x4000
+  IN_NONBLOCK = 0o4000
+  IN_CLOEXEC = 0o2000000
+  mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+  def __init__(self, debounce: float) -> None:
+    import ctypes
+    import ctypes.util
+    super().__init__(debounce=debounce)
+    self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+    if self.fd < 0: self.raise_errno()
+    self.wd_dirs: Dict[int, str] = {}
+    self.dir_wds: Dict[str, int] = {}
+
+  def raise_errno(self, path:str=None) -> NoReturn:
+    import ctypes
+    from os import strerror
+    errno = ctypes.get_errno()
+    raise OSError(errno, strerror(errno), path)
+
+  def watch(self, files: Set[str], dirs: Set[str]) -> None:
+    super().watch(files=files, dirs=dirs)
+    needed = dirs | { path_dir(path) for path in files }
+    for dir_path in needed.difference(self.dir_wds):
+      wd = self.libc.inotify_add_watch(self.fd, dir_path.encode(), self.mask)
+      if wd < 0: continue # Directory does not exist (yet); a missing dependency cannot change until its parent exists.
+      self.wd_dirs[wd] = dir_path
+      self.dir_wds[dir_path] = wd
+    for dir_path in set(self.dir_wds).difference(needed):
+      self.libc.inotify_rm_watch(self.fd, self.dir_wds.pop(dir_path))
+
+  def wait(self) -> Set[str]:
+    from select import select
+    changed: Set[str] = set()
+    while True:
+      readable, _, _ = select([self.fd], [], [], self.debounce if changed else None)
+      if not readable: return changed # Quiet for the debounce interval.
+      changed.update(path for path in self.read_events() if self.is_watched(path))
+
+  def read_events(self) -> Iterator[str]:
+    from os import read
+    from struct import calcsize, unpack_from
+    try: buffer = read(self.fd, 1 << 16)
+    except BlockingIOError: return
+    header_size = calcsize('iIII')
+    offset = 0
+    while offset < len(buffer):
+      wd, mask, _cookie, name_len = unpack_from('iIII', buffer, offset)
+      name = buffer[offset+header_size:offset+header_size+name_len].rstrip(b'\0').decode(errors='surrogateescape')
+      offset += header_size + name_len
+      if mask & self.IN_Q_OVERFLOW: # Events were dropped; conservatively report everything.
+        yield from self.files
+        continue
+      dir_path = self.wd_dirs.get(wd)
+      if dir_path is not None and name:
+        yield path_join(dir_path, name)
+
+
+# Renderer.
+
+class Diagnostic(NamedTuple):
+  'A warning or error about a source line, as collected by `Renderer`; line and column are 1-based, or 0 if not applicable.'
+  path: str
+  line: int
+  col: int
+  label: str # 'warning' or 'error'.
+  message: str
+  text: str # The source line.
+
+  def __str__(self) -> str:
+    loc = f'{self.path}:{self.line}:{self.col}' if self.line else self.path
+    return f'{loc}: {self.label}: {self.message}' + (f'\n{self.text}' if self.text else '')
+
+
+class WriteupError(Exception):
+  'Raised by `Renderer` when a document has an error; `diagnostics` lists every diagnostic of the render, including warnings.'
+  def __init__(self, diagnostics: List[Diagnostic]) -> None:
+    self.diagnostics = list(diagnostics)
+    super().__init__('\n'.join(str(d) for d in self.diagnostics))
+
+
+class Renderer:
+  '''
+  Render documents in-process, keeping state warm between renders:
+  the minified assets, the syntax highlighting cache (if `cache_dir` is set) and the results of embedding files.
+  Cached embeds are validated against the stat signatures of the embedded files, so edits are picked up.
+  Errors raise `WriteupError` rather than exiting, and diagnostics are collected rather than printed.
+  A renderer can be shared between threads: every render has its own context, and the shared caches are thread-safe.
+  '''
+  def __init__(self, css_paths: Sequence[str]=(), no_css=False, no_js=False, cache_dir: Optional[str]=None,
+   highlight_cache_size=64.0, embed_cache_size=64.0, inline_image_size=0.0) -> None:
+    'Sizes are in MiB, except for `inline_image_size`, which is in KiB, as for the command line options.'
+    self.css_lines = [] if no_css else list(default_css_lines())
+    for path in css_paths:
+      with open(path) as f:
+        self.css_lines.extend(minify_css([f.read()]))
+    self.js = None if no_js else default_js_min()
+    self.highlight_cache = HighlightCache(path_join(cache_dir, 'highlight'), max_size=int(highlight_cache_size * (1 << 20))) \
+      if cache_dir else None
+    self.embed_cache = EmbedCache(max_chars=int(embed_cache_size * (1 << 20)))
+    self.inline_image_size = int(inline_image_size * 1024)
+
+  def render(self, text: Optional[str]=None, path: Optional[str]=None, bare=False,
+   section: Union[str, Sequence[str], None]=None, warnings: Optional[List[Diagnostic]]=None) -> str:
+    '''
+    Render a document given as `text`, or read from `path`, and return the HTML.
+    `path` names the document for diagnostics and locates its embeds, which are relative to it;
+    without a path, embeds are relative to the current directory.
+    Warnings are appended to `warnings` if it is provided.
+    '''
+    return ''.join(line + '\n' for line in self.render_lines(text=text, path=path, bare=bare, section=section, warnings=warnings))
+
+  def render_bytes(self, text: Optional[str]=None, path: Optional[str]=None, bare=False,
+   section: Union[str, Sequence[str], None]=None, warnings: Optional[List[Diagnostic]]=None) -> bytes:
+    'Render a document as UTF-8 encoded HTML, as declared by the document head.'
+    return self.render(text=text, path=path, bare=bare, section=section, warnings=warnings).encode()
+
+  def render_lines(self, text: Optional[str]=None, path: Optional[str]=None, bare=False,
+   section: Union[str, Sequence[str], None]=None, warnings: Optional[List[Diagnostic]]=None, stream=False) -> Iterator[str]:
+    'Generate the lines of HTML without newlines, reading `path` as they are generated. See `render` and `writeup`.'
+    if text is None and path is None: raise ValueError('Renderer requires `text` or `path`.')
+    src_path = path or '<string>'
+    diagnostics: List[Diagnostic] = []
+    env = Env(highlight_cache=self.highlight_cache, inline_image_size=self.inline_image_size, embed_cache=self.embed_cache,
+      diagnostics=diagnostics)
+    f: Optional[TextIO] = None
+    src_lines: Iterable[str]
+    if text is None:
+      try: f = open(src_path)
+      except OSError as e:
+        message = 'file does not exist.' if isinstance(e, FileNotFoundError) else f'could not read file: {e.strerror}.'
+        raise WriteupError([Diagnostic(path=src_path, line=0, col=0, label='error', message=message, text='')]) from None
+      src_lines = f
+    else:
+      src_lines = text.splitlines(keepends=True)
+    try:
+      yield from writeup(
+        src_path=src_path,
+        src_lines=enumerate(src_lines),
+        title=(split_ext(path_name(path))[0] if path else ''),
+        description='',
+        author='',
+        css_lines=iter(self.css_lines),
+        js=(None if bare else self.js),
+        emit_doc=(not bare),
+        target_section=section,
+        emit_dbg=False,
+        stream=stream,
+        env=env)
+    finally:
+      if f: f.close()
+    if warnings is not None: warnings.extend(diagnostics)
+
+  async def render_async(self, text: Optional[str]=None, path: Optional[str]=None, bare=False,
+   section: Union[str, Sequence[str], None]=None, warnings: Optional[List[Diagnostic]]=None,
+   executor: Optional['Executor']=None, chunk_size=1<<12) -> AsyncIterator[str]:
+    '''
+    Render a document without blocking the event loop, yielding chunks of HTML as they are generated.
+    Reading the source and embedded files, parsing and highlighting all run on `executor`
+    (the loop's default executor if None), while the loop only passes the chunks along.
+    As with `-stream`, each top-level block is emitted as soon as it is parsed, so a response can start
+    before the document is fully rendered; document-specific CSS comes at the end of the body.
+    Errors raise `WriteupError` from the iterator. If the consumer stops early, rendering stops at the next chunk.
+    '''
+    import asyncio
+    from threading import Event
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=4) # Bounds the output held in memory when the consumer is slow.
+    cancelled = Event()
+    done = object()
+
+    def put(item: Any) -> None:
+      asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def produce() -> None:
+      try:
+        chunk: List[str] = []
+        size = 0
+        for line in self.render_lines(text=text, path=path, bare=bare, section=section, warnings=warnings, stream=True):
+          chunk.append(line)
+          size += len(line) + 1
+          if size >= chunk_size:
+            chunk.append('')
+            if cancelled.is_set(): return
+            put('\n'.join(chunk))
+            chunk.clear()
+            size = 0
+        if chunk:
+          chunk.append('')
+          if cancelled.is_set(): return
+          put('\n'.join(chunk))
+      except Exception as e:
+        if not cancelled.is_set(): put(e)
+        return
+      if not cancelled.is_set(): put(done)
+
+    loop.run_in_executor(executor, produce)
+    try:
+      while True:
+        item = await queue.get()
+        if item is done: break
+        if isinstance(item, Exception): raise item
+        yield item
+    finally:
+      cancelled.set()
+      while not queue.empty(): queue.get_nowait() # Unblock the producer if it is waiting to put; it then sees `cancelled`.
+
+
+Signature = Optional[Tuple[int, int]]
+
+def stat_signature(path: str) -> Signature:
+  from os import stat
+  try: st = stat(path)
+  except OSError: return None
+  return (st.st_mtime_ns, st.st_size)
+
+
+class EmbedCache:
+  '''
+  Results of embedding files, shared between the renders of a `Renderer`.
+  An entry is valid while the embedded file and its own dependencies have the same stat signatures as when it was computed.
+  Least recently used entries are evicted once the total size of the cached contents exceeds `max_chars`.
+  '''
+  def __init__(self, max_chars: int) -> None:
+    from collections import OrderedDict
+    from threading import Lock
+    self.max_chars = max_chars
+    self.entries: 'OrderedDict[Tuple, Tuple[Tuple[Signature, ...], Embedded, int]]' = OrderedDict() # (signatures, embedded, size).
+    self.size = 0
+    self.lock = Lock()
+
+  def get(self, key: Tuple) -> Optional['Embedded']:
+    key = self.abs_key(key)
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None: return None
+      self.entries.move_to_end(key)
+    signatures, embedded, _ = entry
+    if signatures != self.signatures(key[0], embedded): return None
+    return embedded
+
+  def put(self, key: Tuple, signature: Signature, embedded: 'Embedded') -> None:
+    size = sum(len(line) for line in embedded.contents)
+    if signature is None or size > self.max_chars: return
+    key = self.abs_key(key)
+    signatures = (signature, *(stat_signature(dep) for dep in embedded.dependencies))
+    with self.lock:
+      prev = self.entries.pop(key, None)
+      if prev is not None: self.size -= prev[2]
+      self.entries[key] = (signatures, embedded, size)
+      self.size += size
+      while self.size > self.max_chars:
+        _, (_, _, evicted_size) = self.entries.popitem(last=False)
+        self.size -= evicted_size
+
+  def abs_key(self, key: Tuple) -> Tuple:
+    'Embed keys contain relative paths; the cache outlives any one render, so make them absolute.'
+    path, should_embed, quote_depth, src_dir, attrs = key
+    return (abs_path(path), should_embed, quote_depth, abs_path(src_dir), attrs)
+
+  def signatures(self, path: str, embedded: 'Embedded') -> Tuple[Signature, ...]:
+    return (stat_signature(path), *(stat_signature(dep) for dep in embedded.dependencies))
+
+
+# Output.
+
+class AtomicOutput:
+  '''
+  A text file that replaces `path` only once the render completes.
+  Output goes to a temporary file in the same directory, which is renamed over `path` on success;
+  if the new contents are byte-for-byte identical to the existing file, `path` is left untouched so that its mtime does not change.
+  If the render fails, the temporary file is removed and `path` is left intact.
+  Each of `compress_formats` adds a compressed sibling (e.g. `path.gz`), compressed as the text is written
+  and committed the same way.
+  '''
+  def __init__(self, path: str, binary=False, compress_formats: Iterable[str]=(), compress_level=9) -> None:
+    self.path = path
+    self.tmp_path = path_join(path_dir(path), f'.{path_name(path)}.{getpid()}.tmp')
+    try: self.file: IO[Any] = open(self.tmp_path, 'wb' if binary else 'w', buffering=write_buffer_size)
+    except FileNotFoundError as e: raise FileNotFoundError(e.errno, e.strerror, path) from None # Report the destination.
+    self.encoding = '' if binary else cast(TextIO, self.file).encoding
+    self.compressed: List[Tuple[Any, AtomicOutput]] = []
+    if compress_formats:
+      import zlib
+      for fmt in compress_formats:
+        # The gzip header written by zlib has a zero mtime and no file name, so unchanged content compresses to identical bytes.
+        wbits = 31 if fmt == 'gzip' else 15
+        try: sibling = AtomicOutput(path + precompress_exts[fmt], binary=True)
+        except BaseException:
+          self.discard()
+          raise
+        self.compressed.append((zlib.compressobj(compress_level, zlib.DEFLATED, wbits), sibling))
+
+  def write(self, text: str) -> int:
+    if self.compressed:
+      data = text.encode(self.encoding)
+      for compressor, sibling in self.compressed:
+        sibling.write_bytes(compressor.compress(data))
+    return self.file.write(text)
+
+  def write_bytes(self, data: bytes) -> None:
+    'Write to a binary output.'
+    self.file.write(data)
+
+  def __enter__(self) -> 'AtomicOutput':
+    return self
+
+  def __exit__(self, exc_type: Any, exc: Any, tb: Any) -> None:
+    if exc_type is None: self.commit()
+    else: self.discard()
+
+  def commit(self) -> bool:
+    'Move the output into place. Returns false if the destination already had identical contents.'
+    from os import chmod, remove, replace, stat
+    for compressor, sibling in self.compressed:
+      sibling.write_bytes(compressor.flush())
+      sibling.commit()
+    self.file.close()
+    if files_are_identical(self.tmp_path, self.path):
+      remove(self.tmp_path)
+      return False
+    try: chmod(self.tmp_path, stat(self.path).st_mode & 0o7777) # Preserve the mode of an existing destination.
+    except FileNotFoundError: pass
+    replace(self.tmp_path, self.path)
+    return True
+
+  def discard(self) -> None:
+    from os import remove
+    for _, sibling in self.compressed: sibling.discard()
+    self.file.close()
+    try: remove(self.tmp_path)
+    except FileNotFoundError: pass
+
+
+precompress_exts = {
+  'gzip': '.gz',
+  'zlib': '.zz',
+}
+
+def parse_precompress_formats(arg: str) -> Tuple[str, ...]:
+  from argparse import ArgumentTypeError
+  formats = tuple(fmt for fmt in arg.split(',') if fmt)
+  for fmt in formats:
+    if fmt not in precompress_exts:
+      raise ArgumentTypeError(f'unknown format: {fmt!r}; expected a comma-separated list from: {", ".join(precompress_exts)}.')
+  return tuple(dict.fromkeys(formats)) # Remove duplicates.
+
+
+def precompress_options(args: Any) -> Dict[str, Any]:
+  return { 'compress_formats': args.precompress, 'compress_level': args.precompress_level }
+
+
+def precompressed_exts(args: Any) -> List[str]:
+  return [precompress_exts[fmt] for fmt in args.precompress]
+
+
+def files_are_identical(path_a: str, path_b: str) -> bool:
+  from os import stat
+  try:
+    if stat(path_a).st_size != stat(path_b).st_size: return False
+    with open(path_a, 'rb') as a, open(path_b, 'rb') as b:
+      while True:
+        chunk = a.read(1 << 16)
+        if chunk != b.read(1 << 16): return False
+        if not chunk: return True
+  except FileNotFoundError: return False
+
+
+# Timings.
+
+class EmbedTiming(NamedTuple):
+  path: str
+  handler: str
+  bytes_in: int
+  bytes_out: int
+  time: float
+
+
+def lines_size(lines: Iterable[str]) -> int:
+  'The size in bytes of `lines` as written to the output, one per line.'
+  return sum(len(line.encode()) + 1 for line in lines)
+
+
+class Timings:
+  '''
+  Wall time and call counts of the phases of a render, and the cost of each embed, for the `-timings` option.
+  Phase times are inclusive: `parse` includes `Block.finish`, which includes synchronous embeds.
+  Concurrent embeds record their time on worker threads.
+  '''
+  def __init__(self) -> None:
+    from threading import Lock
+    self.phases: Dict[str, List[float]] = {} # Maps phase name to [total time, count].
+    self.embeds: List[EmbedTiming] = []
+    self.lock = Lock()
+
+  def add(self, phase: str, elapsed: float, count=1) -> None:
+    with self.lock:
+      entry = self.phases.setdefault(phase, [0.0, 0])
+      entry[0] += elapsed
+      entry[1] += count
+
+  def phase(self, phase: str) -> 'TimedPhase':
+    return TimedPhase(self, phase)
+
+  def iter_phase(self, phase: str, it: Iterable[Any]) -> Iterator[Any]:
+    'Time only the production of each item, not the consumer; count the whole iteration as a single call.'
+    it = iter(it)
+    count = 1
+    while True:
+      start = perf_counter()
+      try: item = next(it)
+      except StopIteration: break
+      finally: self.add(phase, perf_counter() - start, count=count)
+      count = 0
+      yield item
+
+  def add_embed(self, path: str, handler: str, bytes_out: int, elapsed: float) -> None:
+    try: bytes_in = path_getsize(path)
+    except OSError: bytes_in = 0
+    with self.lock:
+      self.embeds.append(EmbedTiming(path=path, handler=handler, bytes_in=bytes_in, bytes_out=bytes_out, time=elapsed))
+
+  def stream_embed(self, path: str, handler: str, stream: Callable[[], Iterator[str]]) -> Callable[[], Iterator[str]]:
+    'Wrap the stream function of a streamed embed, which does its work as the output is written.'
+    def timed_stream() -> Iterator[str]:
+      elapsed = 0.0
+      bytes_out = 0
+      it = stream()
+      while True:
+        start = perf_counter()
+        try: line = next(it)
+        except StopIteration: break
+        finally: elapsed += perf_counter() - start
+        bytes_out += len(line.encode()) + 1
+        yield line
+      self.add_embed(path, handler, bytes_out, elapsed)
+    return timed_stream
+
+  def report(self) -> None:
+    errSL('writeup timings (inclusive wall time):')
+    for name, (elapsed, count) in sorted(self.phases.items(), key=lambda item: -item[1][0]):
+      errSL(f'  {elapsed*1e3:10.3f} ms  {count:8} × {name}')
+    if not self.embeds: return
+    errSL('embeds:')
+    errSL(f'  {"time":>13}  {"handler":12}  {"bytes in":>10}  {"bytes out":>10}  path')
+    for e in sorted(self.embeds, key=lambda e: -e.time):
+      errSL(f'  {e.time*1e3:10.3f} ms  {e.handler:12}  {e.bytes_in:10}  {e.bytes_out:10}  {e.path}')
+
+
+class TimedPhase:
+  def __init__(self, timings: Timings, phase: str) -> None:
+    self.timings = timings
+    self.phase = phase
+    self.start = 0.0
+
+  def __enter__(self) -> None:
+    self.start = perf_counter()
+
+  def __exit__(self, *exc_info: Any) -> None:
+    self.timings.add(self.phase, perf_counter() - self.start)
+
+
+def timed(timings: Optional[Timings], phase: str) -> Any:
+  'Context manager that times a phase if `timings` is set.'
+  if timings is None:
+    from contextlib import nullcontext
+    return nullcontext()
+  return timings.phase(phase)
+
+
+def timed_iter(timings: Optional[Timings], phase: str, it: Iterable[Any]) -> Iterable[Any]:
+  return it if timings is None else timings.iter_phase(phase, it)
+
+
+# Build cache.
+
+# Each cache entry records the hashes of everything that went into a previously rendered output:
+# the source, the transitive dependencies found while rendering, the output-affecting options and the writeup implementation.
+# When every recorded hash still matches, the existing output is left untouched.
+
+def build_cache_is_fresh(args: Any, src_path: str, dst_path: str) -> bool:
+  entry = build_cache_load(build_cache_entry_path(args.cache_dir, src_path, dst_path))
+  if entry is None: return False
+  if entry.get('options') != build_cache_options_key(args): return False
+  if entry.get('src') != hash_path(src_path): return False
+  if entry.get('dst') != hash_path(dst_path): return False # Output is missing or was modified.
+  if not all(path_exists(dst_path + ext) for ext in precompressed_exts(args)): return False
+  deps = entry.get('deps')
+  if not isinstance(deps, dict): return False
+  return all(hash_path(path) == digest for path, digest in deps.items())
+
+
+def build_cache_record(args: Any, src_path: str, dst_path: str, dependencies: Iterable[str]) -> None:
+  import json
+  from os import makedirs, replace
+  entry = {
+    'options': build_cache_options_key(args),
+    'src': hash_path(src_path),
+    'dst': hash_path(dst_path),
+    'deps': { path: hash_path(path) for path in sorted(set(dependencies)) },
+  }
+  entry_path = build_cache_entry_path(args.cache_dir, src_path, dst_path)
+  makedirs(args.cache_dir, exist_ok=True)
+  tmp_path = f'{entry_path}.{getpid()}.tmp' # Concurrent batch workers must never observe a partial entry.
+  with open(tmp_path, 'w') as f:
+    json.dump(entry, f, indent=0)
+  replace(tmp_path, entry_path)
+
+
+def build_cache_dependencies(args: Any, src_path: str, dst_path: str) -> Optional[List[str]]:
+  entry = build_cache_load(build_cache_entry_path(args.cache_dir, src_path, dst_path))
+  deps = entry and entry.get('deps')
+  return list(deps) if isinstance(deps, dict) else None
+
+
+def build_cache_load(entry_path: str) -> Optional[Dict[str, Any]]:
+  import json
+  try:
+    with open(entry_path) as f:
+      entry = json.load(f)
+  except (OSError, ValueError): return None
+  return entry if isinstance(entry, dict) else None
+
+
+def build_cache_entry_path(cache_dir: str, src_path: str, dst_path: str) -> str:
+  from hashlib import sha256
+  key = sha256(f'{abs_path(src_path)}\0{abs_path(dst_path)}'.encode()).hexdigest()
+  return path_join(cache_dir, key[:32] + '.json')
+
+
+def build_cache_options_key(args: Any) -> str:
+  'Hash the options that affect the output, including the contents of CSS files and of the writeup implementation itself.'
+  from hashlib import sha256
+  options = [
+    writeup_version_hash(),
+    bool(args.bare), bool(args.no_css), bool(args.no_js), bool(args.stream), args.section, args.inline_image_size,
+    args.precompress, args.precompress_level, args.assets_dir and abs_path(args.assets_dir),
+    [(path, hash_path(path)) for path in args.css_paths],
+  ]
+  return sha256(repr(options).encode()).hexdigest()
+
+
+_writeup_version_hash: Optional[str] = None
+
+def writeup_version_hash() -> str:
+  'Hash of the writeup implementation, so that upgrading writeup invalidates cached outputs.'
+  global _writeup_version_hash
+  if _writeup_version_hash is None:
+    _writeup_version_hash = hash_path(__file__)
+    assert _writeup_version_hash is not None
+  return _writeup_version_hash
+
+
+def hash_path(path: str) -> Optional[str]:
+  'Return the sha256 hex digest of the file at `path`, or None if it cannot be read.'
+  from hashlib import sha256
+  h = sha256()
+  try:
+    with open(path, 'rb') as f:
+      for chunk in iter(lambda: f.read(1 << 16), b''):
+        h.update(chunk)
+  except OSError: return None
+  return h.hexdigest()
+
+
 class Ctx: ...
 
 
+class Env:
+  '''
+  State shared by every context of a single render: the root document, its quotes and its embedded documents.
+  '''
+  def __init__(self, highlight_cache: Optional['HighlightCache']=None, embed_pool: Optional['EmbedPool']=None,
+   inline_image_size=0, timings: Optional['Timings']=None, embed_cache: Optional['EmbedCache']=None,
+   diagnostics: Optional[List['Diagnostic']]=None) -> None:
+    self.highlight_cache = highlight_cache
+    self.embed_cache = embed_cache # Embed results shared between renders.
+    self.diagnostics = diagnostics # If set, diagnostics are collected here and errors raise `WriteupError` instead of exiting.
+    self.timings = timings
+    self.embed_pool = embed_pool
+    self.inline_image_size = inline_image_size # Images smaller than this many bytes are inlined as data URIs.
+    self.embeds: Dict[Tuple, Union['Embedded', 'Future']] = {} # Memoized embed results, possibly still being computed.
+    self.embed_stack: List[Tuple[str, int, str]] = [] # (embedding path, line index, embedded path) for embeds in progress.
+
+
 class Span:
   'A tree node of inline HTML content.'
   def __init__(self, text: str) -> None:
@@ -188,24 +1244,36 @@ class BoldSpan(AttrSpan):
 
 
 class EmbedSpan(AttrSpan):
-  def __init__(self, text: str, attrs: Dict[str, str], path: str, contents: Tuple[str, ...]) -> None:
+  '''
+  An embedded file.
+  Embeds computed concurrently are created with empty `contents`, which are filled in by `Ctx.resolve_embeds` before emission.
+  Streamed embeds have a `stream` function instead, which reads the file anew each time the span is rendered.
+  '''
+  def __init__(self, text: str, attrs: Dict[str, str], path: str, contents: Tuple[str, ...],
+   stream: Optional[Callable[[], Iterator[str]]]=None) -> None:
     super().__init__(text=text, attrs=attrs)
     self.path = path
     self.contents = contents
+    self.stream = stream
 
   def __repr__(self) -> str:
     return f'{self.__class__.__name__}({self.text!r}, attrs={self.attrs}, path={self.path!r}, contents={self.contents})'
 
 
   def html(self, depth: int) -> str:
+    return '\n'.join(self.html_lines(depth))
+
+  def html_lines(self, depth: int) -> Iterator[str]:
     if attrs_bool(self.attrs, 'titled'):
-      label = f'<div class="embed-label">{html_esc(self.path)}</div>\n'
-    else:
-      label= ''
+      yield f'<div class="embed-label">{html_esc(self.path)}</div>'
 
-    j = '\n' + '  ' * (depth + 1)
+    j = '  ' * (depth + 1)
     # TODO: migrate various embed html details up to here?
-    return label + j.join(self.contents)
+    is_empty = True
+    for line in (self.stream() if self.stream else self.contents):
+      yield line if is_empty else j + line
+      is_empty = False
+    if is_empty: yield ''
 
 
 class GenericSpan(AttrSpan):
@@ -250,6 +1318,7 @@ class Section(Block):
     self.index_path = index_path
     self.title = title
     self.blocks: List[Block] = []
+    self.is_target = False # Selected by `-section`.
 
   def __repr__(self) -> str: return f'Section({self.sid}, {self.title}, {len(self.blocks)} blocks)'
 
@@ -299,7 +1368,7 @@ class ListItem(Block):
         yield indent(depth, f'<li>')
         for i, line in enumerate(self.blocks[0].lines):
           if i: yield indent(depth, '<br />')
-          yield indent(depth + 1, html_for_spans(line, depth=depth))
+          yield from html_lines_for_spans(line, depth=depth)
         yield indent(depth, f'</li>')
     else:
       yield indent(depth, f'<li>')
@@ -333,10 +1402,12 @@ class Quote(LeafBlock):
       is_versioned=False,
       warn_missing_final_newline=False,
       should_embed=ctx.should_embed,
-      emit_dbg=ctx.emit_dbg)
+      emit_dbg=ctx.emit_dbg,
+      env=ctx.env)
     unquoted_src_lines = list(enumerate(self.content_lines, self.src_lines[0][0]))
     parse(ctx=quote_ctx, src_lines=unquoted_src_lines)
     self.blocks = quote_ctx.blocks
+    ctx.absorb(quote_ctx)
 
   def html(self, ctx: Ctx, depth: int) -> Iterable[str]:
     yield indent(depth, '<blockquote>')
@@ -367,7 +1438,7 @@ class Text(LeafBlock):
     yield indent(depth, '<p>')
     for i, line in enumerate(self.lines):
       if i: yield indent(depth, '<br />')
-      yield indent(depth + 1, html_for_spans(line, depth=depth))
+      yield from html_lines_for_spans(line, depth=depth)
     yield indent(depth, '</p>')
 
 
@@ -379,7 +1450,8 @@ class Ctx: # type: ignore
   '''
 
   def __init__(self, src_path: str, should_embed: bool, is_versioned=True,
-   warn_missing_final_newline=True, quote_depth=0, line_offset=0, emit_dbg=False) -> None:
+   warn_missing_final_newline=True, quote_depth=0, line_offset=0, emit_dbg=False, env: Env=None,
+   target_sections: Optional[Iterable[str]]=None) -> None:
     self.src_path = src_path
     self.should_embed = should_embed
     self.is_versioned = is_versioned
@@ -387,6 +1459,7 @@ class Ctx: # type: ignore
     self.quote_depth = quote_depth
     self.line_offset = line_offset
     self.emit_dbg = emit_dbg
+    self.env = env or Env()
 
     self.project_dir = '.' # For now, assume that writeup is invoked from the project root.
     self.src_dir = path_dir(src_path) or '.'
@@ -397,7 +1470,14 @@ class Ctx: # type: ignore
     self.section_ids: List[str] = [] # accumulated list of all section ids.
     self.paging_ids: List[str] = [] # accumulated list of all paging (level 1 & 2) section ids.
     self.css: DefaultDict[str, List[str]] = defaultdict(list)
-    self.found_target_section = False
+    self.css_log: Optional[List[CssRule]] = None # When set, records css rules as they are added, for embed memoization.
+    # Concurrent embeds, in source order, and whether each span is the one that started the embed (rather than a memo hit).
+    self.pending_embeds: List[Tuple[EmbedSpan, 'Future', bool]] = []
+    self.msg_log: Optional[List[LoggedMsg]] = None # When set, diagnostics are recorded rather than reported, for detached embeds.
+    # If set, only sections whose number or title is in `target_sections` are emitted,
+    # and blocks outside of them are not finished.
+    self.target_sections = None if target_sections is None else frozenset(target_sections)
+    self.found_target_sections: Set[str] = set()
 
 
   @property
@@ -426,9 +1506,25 @@ class Ctx: # type: ignore
 
   def pop(self) -> Block:
     popped = self.stack.pop()
-    popped.finish(self)
+    if self.target_sections is not None and not self.in_target_section(): return popped # Never emitted; skip the work.
+    timings = self.env.timings
+    if timings is None:
+      popped.finish(self)
+    else:
+      with timings.phase(f'{type(popped).__name__}.finish'):
+        popped.finish(self)
     return popped
 
+  def in_target_section(self) -> bool:
+    return any(type(block) is Section and block.is_target for block in self.stack)
+
+  def mark_target_section(self, section: Section) -> None:
+    assert self.target_sections is not None
+    matches = self.target_sections.intersection((section.sid, text_for_spans(section.title)))
+    if matches:
+      section.is_target = True
+      self.found_target_sections.update(matches)
+
   def pop_to_section_depth(self, section_depth: int) -> int:
     prev_index = 0
     while self.depth > section_depth:
@@ -446,7 +1542,19 @@ class Ctx: # type: ignore
       self.pop()
 
   def append_to_leaf_block(self, src: SrcLine, list_level: int, block_type: type, content: str) -> None:
-    self.dbg(src, "APPEND", list_level, block_type.__name__)
+    if self.emit_dbg: self.dbg(src, "APPEND", list_level, block_type.__name__)
+    stack = self.stack
+    if stack and type(stack[-1]) is block_type: # Continuing the current leaf is the common case.
+      # A leaf's parent is either a list item or a section, which cannot be inside a list.
+      parent = stack[-2] if len(stack) > 1 else None
+      is_continuation = (parent.list_level if type(parent) is ListItem else 0) == list_level
+    else: is_continuation = False
+    if is_continuation:
+      continued = cast(LeafBlock, stack[-1])
+      continued.src_lines.append(src)
+      continued.content_lines.append(content)
+      if self.emit_dbg: self.dbg(src, '-', self.stack)
+      return
     while self.stack:
       top = self.top
       if isinstance(top, Section): break
@@ -461,22 +1569,40 @@ class Ctx: # type: ignore
     assert isinstance(leaf, LeafBlock)
     leaf.src_lines.append(src)
     leaf.content_lines.append(content)
-    self.dbg(src, '-', self.stack)
+    if self.emit_dbg: self.dbg(src, '-', self.stack)
 
   def close_leaf_block(self) -> None:
     if self.stack and isinstance(self.top, LeafBlock):
       self.pop()
       assert not self.stack or isinstance(self.top, (Section, ListItem))
 
-  def emit_html(self, depth: int, target_section: Optional[str]=None) -> Iterator[str]:
+  def emit_html(self, depth: int) -> Iterator[str]:
     for block in self.blocks:
-      if target_section is not None:
-        if not isinstance(block, Section): continue
-        title = text_for_spans(block.title)
-        # TODO: this only works for top level section ids; fixing it requires a recursive approach.
-        if title != target_section and block.sid != target_section: continue
-        self.found_target_section = True
+      yield from self.emit_block_html(block, depth=depth)
+
+  def emit_block_html(self, block: Block, depth: int) -> Iterator[str]:
+    self.resolve_embeds()
+    if self.target_sections is None:
       yield from block.html(ctx=self, depth=depth)
+    else:
+      yield from self.emit_target_sections(block, depth=depth)
+
+  def emit_target_sections(self, block: Block, depth: int) -> Iterator[str]:
+    'Emit the target sections within `block`, in document order; a target nested within another is emitted as part of it.'
+    if not isinstance(block, Section): return
+    if block.is_target:
+      yield from block.html(ctx=self, depth=depth)
+    else:
+      for child in block.blocks:
+        yield from self.emit_target_sections(child, depth=depth)
+
+  def take_finished_blocks(self) -> List[Block]:
+    'Remove and return the top-level blocks that are complete, i.e. all but the one that is still open, if any.'
+    end = len(self.blocks)
+    if self.stack and end and self.stack[0] is self.blocks[-1]: end -= 1
+    finished = self.blocks[:end]
+    del self.blocks[:end]
+    return finished
 
   def add_dependency(self, dependency: str) -> str:
     assert dependency
@@ -489,17 +1615,49 @@ class Ctx: # type: ignore
     return path
 
   def add_css(self, class_, style) -> None:
+    if self.css_log is not None: self.css_log.append((class_, style))
     l = self.css[class_] # get list from default dict.
     if style not in l: l.append(style) # deduplicate but preserve order.
 
+  def absorb(self, child: 'Ctx') -> None:
+    'Take the transitive dependencies and css rules of a nested context (quote or embedded document).'
+    child.resolve_embeds()
+    self.dependencies.extend(child.dependencies)
+    for class_, styles in child.css.items():
+      for style in styles: self.add_css(class_, style)
+
+  def resolve_embeds(self) -> None:
+    '''
+    Wait for the pending concurrent embeds and fill in their spans.
+    Results are taken in source order, and their diagnostics and CSS rules are replayed,
+    so the order of diagnostics and CSS rules does not depend on timing.
+    '''
+    for span, future, is_origin in self.pending_embeds:
+      try: embedded = future.result()
+      except DetachedEmbedError as e:
+        for logged in e.messages: self.msg(*logged)
+        self.abort()
+      if is_origin:
+        for logged in embedded.messages: self.msg(*logged)
+      span.contents = embedded.contents
+      for class_, style in embedded.css: self.add_css(class_, style)
+    self.pending_embeds.clear()
+
   def render_css(self) -> Iterator[str]:
     for selector, styles in self.css.items():
       style_string = ''.join(f'{style};' for style in styles)
       yield f'{selector}{{{style_string}}}'
 
   def msg(self, src: SrcLine, label: str, items: Tuple[Any, ...], col: Optional[int]) -> None:
+    if self.msg_log is not None:
+      self.msg_log.append((src, label, items, col))
+      return
     line, txt = src
     if col is None: col = 0
+    if self.env.diagnostics is not None:
+      self.env.diagnostics.append(Diagnostic(path=self.src_path, line=line+1, col=col+1, label=label,
+        message=' '.join(str(item) for item in items), text=txt.rstrip('\n')))
+      return
     errSL(f'{self.src_path}:{line+1}:{col+1}: {label}:', *items)
     errSL(txt.rstrip('\n'))
 
@@ -508,8 +1666,20 @@ class Ctx: # type: ignore
 
   def error(self, src: SrcLine, *items: Any, col:int=None) -> NoReturn:
     self.msg(src, 'error', items, col)
+    if self.msg_log is not None: raise DetachedEmbedError(tuple(self.msg_log))
+    self.abort()
+
+  def abort(self) -> NoReturn:
+    'Stop the render after an error has been reported.'
+    if self.env.diagnostics is not None: raise WriteupError(self.env.diagnostics)
     exit(1)
 
+  def fail(self, message: str) -> NoReturn:
+    'Report an error that does not belong to a source line.'
+    if self.env.diagnostics is None: exit(message)
+    self.env.diagnostics.append(Diagnostic(path=self.src_path, line=0, col=0, label='error', message=message, text=''))
+    raise WriteupError(self.env.diagnostics)
+
   def dbg(self, src: SrcLine, *items: Any, col:int=None) -> None:
     if self.emit_dbg: self.msg(src, 'debug', items, col)
 
@@ -546,9 +1716,78 @@ line_groups_to_states = {
   'text': s_text,
   'blank': s_blank,
 }
+# `line_re` is the reference definition of the line syntax; `classify_line` implements it without the regex.
+
+line_markers = frozenset('#*>|') # The first non-space characters that distinguish line types other than text.
+
+
+class LineGroups(Dict[str, str]):
+  'The groups of a classified line; implements the subset of the `Match` interface used by `writeup_line`.'
+
+  order = ('section_indents', 'section_hashes', 'section_spaces', 'indents', 'list_star', 'list_spaces')
+
+  def __missing__(self, key: str) -> None: return None # Like a group that did not participate in the match.
+
+  def start(self, key: str) -> int:
+    'Column of a group, for the groups in `order`; a line is the concatenation of its groups.'
+    col = 0
+    for k in self.order:
+      if k == key: return col
+      col += len(self.get(k) or '')
+    raise KeyError(key)
+
+
+def classify_line(line: str) -> Tuple[int, LineGroups]:
+  '''
+  Return the state and groups of a source line, equivalent to matching `line_re` and looking up `m.lastgroup`.
+  Most lines are text or blank, so dispatching on the first non-space character is much cheaper than the regex alternation.
+  '''
+  first = line[:1]
+  if not first: return s_blank, LineGroups(indents='', blank='')
+  if first not in line_markers and not first.isspace(): return s_text, LineGroups(indents='', text=line)
+  content = line.lstrip() # Same as the regex `\s*`.
+  indents = line[:len(line)-len(content)]
+  first = content[:1]
+  if first == '#':
+    title_spaced = content.lstrip('#')
+    title = title_spaced.lstrip()
+    return s_section, LineGroups(section_indents=indents, section_hashes=content[:len(content)-len(title_spaced)],
+      section_spaces=title_spaced[:len(title_spaced)-len(title)], section_title=title)
+  if first == '*':
+    rest = content[1:].lstrip()
+    m = LineGroups(indents=indents, list_star='*', list_spaces=content[1:len(content)-len(rest)])
+    first = rest[:1]
+  else:
+    rest = content
+    m = LineGroups(indents=indents)
+  if first == '>' or first == '|':
+    body = rest[1:]
+    if body[:1].isspace(): body = body[1:]
+    if first == '>':
+      m['quote'] = body
+      return s_quote, m
+    m['code'] = body
+    return s_code, m
+  if not rest:
+    m['blank'] = rest
+    return s_blank, m
+  m['text'] = rest
+  return s_text, m
 
 
 def parse(ctx: Ctx, src_lines: Iterable[SrcLine]) -> None:
+  for _ in parse_lines(ctx, src_lines): pass
+
+
+def parse_finished_blocks(ctx: Ctx, src_lines: Iterable[SrcLine]) -> Iterator[Block]:
+  'Parse the source, yielding each top-level block as soon as it is finished; yielded blocks are removed from `ctx.blocks`.'
+  for _ in parse_lines(ctx, src_lines):
+    if ctx.blocks:
+      yield from ctx.take_finished_blocks()
+
+
+def parse_lines(ctx: Ctx, src_lines: Iterable[SrcLine]) -> Iterator[None]:
+  'Parse the source into `ctx.blocks`, yielding after each line so that callers can consume finished blocks.'
   iter_src_lines = iter(src_lines)
 
   # Handle version line.
@@ -585,23 +1824,29 @@ def parse(ctx: Ctx, src_lines: Iterable[SrcLine]) -> None:
         continue # remain in s_license.
 
     # normal line.
-    m = line_re.fullmatch(line)
-    if m is None: ctx.error(src, 'invalid line (unknown reason; please report)')
-    #errSL('L', repr(line))
-    #errSL('M', m)
-    state = line_groups_to_states[m.lastgroup]
-    writeup_line(ctx=ctx, src=src, state=state, m=m)
+    first = line[:1]
+    if ctx.emit_dbg or (first and (first in line_markers or first.isspace())):
+      state, groups = classify_line(line)
+      writeup_line(ctx=ctx, src=src, state=state, m=groups)
+    elif first: # Unindented text; the common case, which needs no classification.
+      state = s_text
+      ctx.append_to_leaf_block(src, 0, Text, content=line)
+    else: # Empty line.
+      state = s_blank
+      ctx.close_leaf_block()
     prev_state = state
+    yield
 
   # Finish.
   while ctx.stack:
     ctx.pop()
+  yield
 
 
-def writeup_line(ctx: Ctx, src: SrcLine, state: int, m: Match) -> None:
+def writeup_line(ctx: Ctx, src: SrcLine, state: int, m: 'LineGroups') -> None:
   'Process a source line.'
 
-  ctx.dbg(src, state_letters[state])
+  if ctx.emit_dbg: ctx.dbg(src, state_letters[state])
 
   if state == s_section:
     ctx.pop_to_list(0)
@@ -621,6 +1866,7 @@ def writeup_line(ctx: Ctx, src: SrcLine, state: int, m: Match) -> None:
         index_path = (prev_index+1,)
     title = parse_spans(ctx, src=src, text=m['section_title'])
     section = Section(section_depth=section_depth, quote_depth=ctx.quote_depth, index_path=index_path, title=title)
+    if ctx.target_sections is not None: ctx.mark_target_section(section)
     ctx.push(section)
     return
 
@@ -630,7 +1876,7 @@ def writeup_line(ctx: Ctx, src: SrcLine, state: int, m: Match) -> None:
   if l % 2: ctx.error(src, f'odd indentation length: {l}.', col=l)
   list_level = l // 2
   if ctx.list_level < list_level:
-    errSL(ctx.stack)
+    if ctx.env.diagnostics is None: errSL(ctx.stack)
     ctx.error(src, f'indent implies missing parent list at indent depth {ctx.list_level+1}.')
 
   if m['list_star']:
@@ -665,9 +1911,10 @@ def writeup_line(ctx: Ctx, src: SrcLine, state: int, m: Match) -> None:
   else: ctx.error(src, f'bad state: {state}')
 
 
-def check_whitespace(ctx: Ctx, src: SrcLine, len_exp: Optional[int], m: Match, key: str, msg_suffix='') -> bool:
-  col = m.start(key)
+def check_whitespace(ctx: Ctx, src: SrcLine, len_exp: Optional[int], m: 'LineGroups', key: str, msg_suffix='') -> bool:
   string = m[key]
+  if (len_exp is None or len(string) == len_exp) and not string.strip(' '): return True # Common case.
+  col = m.start(key)
   i = 0
   for i, c in enumerate(string):
     if c != ' ':
@@ -681,23 +1928,97 @@ def check_whitespace(ctx: Ctx, src: SrcLine, len_exp: Optional[int], m: Match, k
 
 
 def parse_spans(ctx: Ctx, src: SrcLine, text: str) -> Spans:
+  if '`' not in text and '<' not in text: # Plain text; the common case.
+    return (Span(text=text),) if text else ()
   spans: List[Span] = []
   prev_idx = 0
   def flush(curr_idx: int) -> None:
     if prev_idx < curr_idx:
       spans.append(Span(text=text[prev_idx:curr_idx]))
-  for m in span_re.finditer(text):
-    start_idx = m.start()
+  for i, start_idx, end_idx in scan_spans(text):
     flush(start_idx)
-    prev_idx = m.end()
-    i = m.lastindex or 0
+    prev_idx = end_idx
     span_fn = span_fns[i]
-    group_text = m.group(i)
+    group_text = text[start_idx+1:end_idx-1]
     spans.append(span_fn(ctx, src, group_text))
   flush(len(text))
   return tuple(spans)
 
 
+def scan_spans(text: str) -> Iterator[Tuple[int, int, int]]:
+  '''
+  Yield (kind, start, end) for each span in `text`, where kind is the `span_fns` index and the range includes the delimiters.
+  Equivalent to `span_re.finditer`, but guaranteed linear time: the regex rescans the rest of the line
+  from every unmatched opening delimiter, which is quadratic for lines like '<<<<…'.
+  '''
+  if '`' not in text and '<' not in text: return
+  scanners: Dict[int, SpanScanner] = {}
+  unclosed: Set[int] = set() # Kinds with no closing delimiter in the rest of the text.
+  resume_idx = 0
+  for m in span_open_re.finditer(text):
+    start_idx = m.start()
+    if start_idx < resume_idx: continue
+    kind = 1 if m.group() == '`' else 2
+    if kind in unclosed: continue
+    scanner = scanners.get(kind)
+    if scanner is None:
+      # Fast path: if there is no backslash before the next closing delimiter, then that delimiter closes the span.
+      # Matched ranges do not overlap, so this examines each character at most once per kind.
+      closer = span_closers[kind]
+      close_idx = text.find(closer, start_idx + 1)
+      if close_idx < 0:
+        unclosed.add(kind)
+        continue
+      if text.find('\\', start_idx + 1, close_idx) >= 0: # Escapes; from now on, scan this kind with memoization.
+        scanner = scanners[kind] = SpanScanner(text, closer=closer)
+        close_idx = scanner.close(start_idx + 1)
+    else:
+      close_idx = scanner.close(start_idx + 1)
+    if close_idx < 0: continue
+    yield (kind, start_idx, close_idx + 1)
+    resume_idx = close_idx + 1
+
+
+class SpanScanner:
+  '''
+  Finds the closing delimiter of a span of one kind.
+  The scan visits only the closing delimiters and backslashes ("specials");
+  from each special the outcome is fixed, so it is computed once and shared by all scans that reach it.
+  '''
+  def __init__(self, text: str, closer: str) -> None:
+    self.text = text
+    self.closer = closer
+    self.specials = [m.start() for m in re.finditer(re.escape(closer) + r'|\\', text)]
+    self.outcomes: List[Optional[int]] = [None] * len(self.specials) # Index of the closing delimiter, or -1 if unclosed.
+    self.next_special = 0 # Scans are requested in increasing order of position.
+
+  def close(self, idx: int) -> int:
+    'Return the index of the delimiter closing a span whose body starts at `idx`, or -1.'
+    specials = self.specials
+    k = self.next_special
+    while k < len(specials) and specials[k] < idx: k += 1
+    self.next_special = k
+    text = self.text
+    closer = self.closer
+    path: List[int] = []
+    outcome = -1
+    while k < len(specials):
+      known = self.outcomes[k]
+      if known is not None:
+        outcome = known
+        break
+      path.append(k)
+      pos = specials[k]
+      if text[pos] == closer:
+        outcome = pos
+        break
+      # Backslash: only an escaped closer or backslash is allowed, and the escaped character is the next special.
+      if pos + 1 < len(text) and text[pos + 1] in (closer, '\\'): k += 2
+      else: break
+    for k in path: self.outcomes[k] = outcome
+    return outcome
+
+
 def span_dummy_conv(ctx: Ctx, src: SrcLine, text: str) -> Span:
   raise Exception('unreachable')
 
@@ -777,29 +2098,155 @@ span_pairs = (
 
 span_fns = (span_dummy_conv,) + tuple(f for _, f in span_pairs) # Match.group() is 1-indexed.
 
-span_re = re.compile('|'.join(p for p, _ in span_pairs))
+span_re = re.compile('|'.join(p for p, _ in span_pairs)) # Reference implementation for `scan_spans`.
+
+span_open_re = re.compile(r'[`<]')
+span_closers: Dict[int, str] = { 1: '`', 2: '>' } # Keyed by `span_fns` index.
 
 
 # Embed.
 
 
+class Embedded(NamedTuple):
+  'The memoized result of an embed, including the side effects on the embedding context.'
+  contents: Tuple[str, ...]
+  css: Tuple[CssRule, ...]
+  dependencies: Tuple[str, ...] # Transitive dependencies, excluding the embedded path itself.
+  messages: Tuple['LoggedMsg', ...] = () # Diagnostics of a detached embed, replayed by `Ctx.resolve_embeds`.
+
+
+class DetachedEmbedError(Exception):
+  'Raised on a worker thread by an error in a detached embed; carries its diagnostics, ending with the error, for replay.'
+  def __init__(self, messages: Tuple['LoggedMsg', ...]) -> None:
+    super().__init__(messages)
+    self.messages = messages
+
+
+embed_memo_max_chars = 1 << 20 # Larger results are not memoized, so that streaming renders stay memory-bounded.
+
+
 def embed(ctx: Ctx, src: SrcLine, text: str, attrs: Dict[str, str]) -> Span:
   'convert an `embed` span into html.'
   path = ctx.add_dependency(text)
-  if ctx.should_embed:
+  if not ctx.should_embed:
+    return EmbedSpan(text=text, attrs=attrs, path=path, contents=())
+
+  env = ctx.env
+  timings = env.timings
+  start_time = perf_counter()
+  span = EmbedSpan(text=text, attrs=attrs, path=path, contents=())
+  embed_fn = embed_dispatch.get(attrs.get('ext') or split_ext(path)[1], embed_code)
+  # The quote depth and source directory affect the output of embedded writeup and html respectively;
+  # other kinds leave them out of the key, so that they are converted once however many places embed them.
+  key = (path, ctx.should_embed,
+    (ctx.quote_depth if embed_fn is embed_wu else 0),
+    (ctx.src_dir if embed_fn is embed_html else '.'),
+    tuple(sorted(attrs.items())))
+  embedded = env.embeds.get(key)
+  if embedded is None and env.embed_cache is not None:
+    embedded = env.embed_cache.get(key)
+  if embedded is None:
+    stack_entry = (ctx.src_path, src[0], path)
+    abs_embed_path = abs_path(path)
+    for i, (embedding_path, _, _) in enumerate(env.embed_stack):
+      if abs_path(embedding_path) == abs_embed_path: # The embedded file is already open further up the stack.
+        chain = env.embed_stack[i:] + [stack_entry]
+        ctx.error(src, 'embed cycle:\n' + '\n'.join(f'  {sp}:{line+1}: embeds {p!r}' for sp, line, p in chain))
+    if abs_path(ctx.src_path) == abs_embed_path:
+      ctx.error(src, f'embed cycle: {ctx.src_path!r} embeds itself.')
+    signature = stat_signature(path) # Taken before reading, so that a concurrent modification invalidates the cached result.
     try: f = open(path)
     except FileNotFoundError:
       ctx.error(src, f'embedded file not found: {path!r}')
-    ext = attrs.get('ext')
-    if not ext:
-      ext = split_ext(path)[1]
-    try: embed_fn = embed_dispatch.get(ext, embed_code)
-    except KeyError:
-      ctx.error(src, f'embedded file has unknown extension type: {path!r}')
-    contents = tuple(embed_fn(ctx, f))
-  else:
-    contents = ()
-  return EmbedSpan(text=text, attrs=attrs, path=path, contents=contents)
+    if embed_fn is embed_csv: # Streamed at emit time and never memoized, so that tables of any size are not held in memory.
+      f.close()
+      limits = csv_limits(ctx, src, attrs)
+      span.stream = lambda: embed_stream(path, lambda f: embed_csv(ctx, f, limits=limits))
+      if timings: span.stream = timings.stream_embed(path, 'embed_csv', span.stream)
+      return span
+    if env.embed_pool is not None and embed_fn is not embed_wu: # Embedded writeup is parsed in place; it may embed further.
+      future = env.embed_pool.threads.submit(embed_detached, ctx, embed_fn, f)
+      env.embeds[key] = future
+      future.add_done_callback(lambda fut: embed_memo_forget_large(env, key, fut))
+      ctx.pending_embeds.append((span, future, True))
+      return span
+    css_log: List[CssRule] = []
+    prev_css_log = ctx.css_log
+    ctx.css_log = css_log
+    deps_start = len(ctx.dependencies)
+    env.embed_stack.append(stack_entry)
+    try:
+      with f: contents = tuple(embed_fn(ctx, f))
+    finally:
+      env.embed_stack.pop()
+      ctx.css_log = prev_css_log
+    if prev_css_log is not None: prev_css_log.extend(css_log)
+    embedded = Embedded(contents=contents, css=tuple(css_log), dependencies=tuple(ctx.dependencies[deps_start:]))
+    if sum(len(line) for line in contents) <= embed_memo_max_chars:
+      env.embeds[key] = embedded
+    if env.embed_cache is not None: env.embed_cache.put(key, signature, embedded)
+    if timings: timings.add_embed(path, embed_fn.__name__, lines_size(contents), perf_counter() - start_time)
+  elif not isinstance(embedded, Embedded): # Still being computed; share the result.
+    ctx.pending_embeds.append((span, embedded, False))
+    return span
+  else: # Replay the side effects of the original embed.
+    ctx.dependencies.extend(embedded.dependencies)
+    for class_, style in embedded.css: ctx.add_css(class_, style)
+    if timings: timings.add_embed(path, 'memoized', 0, perf_counter() - start_time)
+  span.contents = embedded.contents
+  return span
+
+
+def embed_memo_forget_large(env: Env, key: Tuple, future: 'Future') -> None:
+  if future.exception() is None and sum(len(line) for line in future.result().contents) > embed_memo_max_chars:
+    env.embeds.pop(key, None)
+
+
+def embed_detached(ctx: Ctx, embed_fn: Callable[[Ctx, TextIO], Iterable[str]], f: TextIO) -> Embedded:
+  '''
+  Run an embed function on a worker thread.
+  The function gets a private context so that its diagnostics and CSS rules can be applied to `ctx` in source order
+  by `Ctx.resolve_embeds`.
+  '''
+  start_time = perf_counter()
+  detached = Ctx(src_path=ctx.src_path, should_embed=ctx.should_embed, quote_depth=ctx.quote_depth, emit_dbg=ctx.emit_dbg, env=ctx.env)
+  detached.css_log = []
+  detached.msg_log = []
+  with f: contents = tuple(embed_fn(detached, f))
+  if ctx.env.timings: ctx.env.timings.add_embed(f.name, embed_fn.__name__, lines_size(contents), perf_counter() - start_time)
+  return Embedded(contents=contents, css=tuple(detached.css_log), dependencies=(), messages=tuple(detached.msg_log))
+
+
+class EmbedPool:
+  '''
+  Executors for concurrent embeds: threads read and convert embedded files while the document is parsed,
+  and large code files are highlighted in worker processes, since pygments holds the GIL.
+  '''
+  def __init__(self, jobs: int) -> None:
+    from concurrent.futures import ThreadPoolExecutor
+    from os import cpu_count
+    from threading import Lock
+    self.threads = ThreadPoolExecutor(max_workers=jobs)
+    self.process_count = min(jobs, cpu_count() or 1)
+    self._processes: Any = None
+    self._lock = Lock()
+
+  @property
+  def processes(self) -> Any:
+    'The process pool is started on first use; most documents never need it. None if there is only one CPU.'
+    if self.process_count < 2: return None
+    with self._lock:
+      if self._processes is None:
+        from concurrent.futures import ProcessPoolExecutor
+        self._processes = ProcessPoolExecutor(max_workers=self.process_count)
+      return self._processes
+
+  def shutdown(self) -> None:
+    self.threads.shutdown()
+    if self._processes is not None: self._processes.shutdown()
+
+
+highlight_process_min_chars = 1 << 14 # Smaller files highlight faster than they can be sent to another process.
 
 
 def embed_css(ctx: Ctx, f: TextIO) -> List[str]:
@@ -807,43 +2254,312 @@ def embed_css(ctx: Ctx, f: TextIO) -> List[str]:
   return [f'<style type="text/css">{html_esc(css)}</style>']
 
 
-def embed_csv(ctx: Ctx, f: TextIO) -> List[str]:
-  from csv import reader
-  csv_reader = reader(f)
-  it = iter(csv_reader)
-  lines = ['<table>']
+def embed_stream(path: str, embed_fn: Callable[[TextIO], Iterator[str]]) -> Iterator[str]:
+  with open(path, newline='') as f:
+    yield from embed_fn(f)
+
+
+class CsvLimits(NamedTuple):
+  'Which data rows of a CSV embed to show; None means no limit.'
+  head: Optional[int] = None # Show the first `head` rows.
+  tail: Optional[int] = None # Show the last `tail` rows.
+  sample: Optional[int] = None # Show a uniform random sample of rows, in file order.
 
-  def append(*els:str) -> None: lines.append(''.join(els))
 
+def csv_limits(ctx: Ctx, src: SrcLine, attrs: Dict[str, str]) -> CsvLimits:
+  '''
+  Parse the `head`, `tail`, `sample` and `max-rows` embed attributes.
+  `max-rows` caps the total number of rows shown; on its own it is equivalent to `head`.
+  '''
+  def count(key: str) -> Optional[int]:
+    val = attrs.get(key)
+    if val is None: return None
+    if not val.isdigit(): ctx.error(src, f'embed attribute {key!r} must be a non-negative integer: {val!r}')
+    return int(val)
+  head = count('head')
+  tail = count('tail')
+  sample = count('sample')
+  max_rows = count('max-rows')
+  if sample is not None and (head is not None or tail is not None):
+    ctx.error(src, 'embed attribute `sample` cannot be combined with `head` or `tail`.')
+  if max_rows is not None:
+    if sample is not None: sample = min(sample, max_rows)
+    elif head is None and tail is None: head = max_rows
+    elif (head or 0) + (tail or 0) > max_rows:
+      ctx.error(src, f'embed attributes `head` and `tail` exceed `max-rows`: {max_rows}.')
+  return CsvLimits(head=head, tail=tail, sample=sample)
+
+
+def embed_csv(ctx: Ctx, f: TextIO, limits=CsvLimits()) -> Iterator[str]:
+  from csv import reader
+  it = reader(f)
+  yield '<table>'
   try: header = next(it)
   except StopIteration: pass
   else:
-    append('<thead>', '<tr>')
-    append('  ', *[f'<th>{html_esc(col)}</th>' for col in header])
-    append('</tr>', '</thead>', '<tbody>')
-    for row in it:
-      append('  <tr>', *[f'<td>{html_esc(cell)}</td>' for cell in row], '</tr>')
-    append('</tbody>')
-  append('</table>')
-  return lines
+    yield '<thead><tr>'
+    yield '  ' + ''.join(f'<th>{html_esc(col)}</th>' for col in header)
+    yield '</tr></thead><tbody>'
+    for row in csv_rows(it, limits):
+      if isinstance(row, list):
+        yield '  <tr>' + ''.join(f'<td>{html_esc(cell)}</td>' for cell in row) + '</tr>'
+      else:
+        elided = 'more rows' if row is None else f'{row} row{"" if row == 1 else "s"}'
+        yield f'  <tr class="elided"><td colspan="{max(1, len(header))}">… {elided} elided …</td></tr>'
+    yield '</tbody>'
+  yield '</table>'
 
 
-def embed_code(ctx: Ctx, f: TextIO) -> Iterator[str]:
+def csv_rows(rows: Iterator[List[str]], limits: CsvLimits) -> Iterator[Union[List[str], int, None]]:
+  '''
+  Yield the selected rows, with the number of elided rows at each gap in between.
+  A gap is None if its size is unknown because the rest of the file was not read.
+  At most `head`, `tail` or `sample` rows are held in memory.
+  '''
+  from collections import deque
+  from itertools import islice
+  head, tail, sample = limits
+  if sample is not None:
+    yield from csv_sample(rows, sample)
+    return
+  if head is None and tail is None:
+    yield from rows
+    return
+  yield from islice(rows, head or 0)
+  if not tail:
+    if next(rows, None) is not None: yield None
+    return
+  last: deque = deque(maxlen=tail)
+  count = 0
+  for row in rows:
+    last.append(row)
+    count += 1
+  if count > len(last): yield count - len(last)
+  yield from last
+
+
+def csv_sample(rows: Iterator[List[str]], size: int) -> Iterator[Union[List[str], int]]:
+  'Reservoir sample `size` rows, yielding them in file order with the gap sizes in between. The seed is fixed so that output is reproducible.'
+  from random import Random
+  rand = Random(0)
+  reservoir: List[Tuple[int, List[str]]] = []
+  count = 0
+  for i, row in enumerate(rows):
+    count += 1
+    if i < size: reservoir.append((i, row))
+    else:
+      j = rand.randrange(i + 1)
+      if j < size: reservoir[j] = (i, row)
+  reservoir.sort(key=lambda pair: pair[0])
+  next_idx = 0
+  for i, row in reservoir:
+    if i > next_idx: yield i - next_idx
+    yield row
+    next_idx = i + 1
+  if count > next_idx: yield count - next_idx
+
+
+
+Highlighted = Tuple[List[str], List[CssRule]] # (html lines, css rules used by those lines).
+
+
+def embed_code(ctx: Ctx, f: TextIO) -> List[str]:
   lines = list(f)
+  cache = ctx.env.highlight_cache
+  if is_plain_text(f.name, lines): # Needs neither pygments nor the cache, whose keys depend on the pygments version.
+    html_lines, css = highlight_lines(None, lines)
+  elif cache is None:
+    html_lines, css = highlight(ctx.env, f.name, lines)
+  else:
+    key = cache.key(f.name, lines)
+    highlighted = cache.get(key)
+    if highlighted is None:
+      highlighted = highlight(ctx.env, f.name, lines)
+      cache.put(key, highlighted)
+    html_lines, css = highlighted
+  for selector, style in css:
+    ctx.add_css(selector, style=style)
+  return html_lines
+
+
+def highlight(env: Env, path: str, lines: List[str]) -> Highlighted:
+  processes = env.embed_pool.processes if env.embed_pool and sum(len(line) for line in lines) >= highlight_process_min_chars else None
+  if processes is None: return highlight_path(path, lines)
+  return cast(Highlighted, processes.submit(highlight_path, path, lines).result())
+
+
+def highlight_path(path: str, lines: List[str]) -> Highlighted:
+  return highlight_lines(guess_lexer(path, lines), lines)
+
+
+def is_plain_text(path: str, lines: List[str]) -> bool:
+  '''
+  True for files that are known to be plain text without consulting pygments, which is expensive to import:
+  plain text extensions, and files without an extension or a shebang line, other than well-known build files.
+  '''
+  name = path_name(path)
+  if name in code_file_names: return False
+  ext = split_ext(name)[1]
+  if ext: return ext.lower() in plain_text_exts
+  return not name.startswith('.') and not (lines and lines[0].startswith('#!')) # Dotfiles are usually configuration or scripts.
+
+plain_text_exts = frozenset(['.log', '.text', '.txt'])
+
+# Names that pygments recognizes as code despite a plain text extension or no extension.
+code_file_names = frozenset(['CMakeLists.txt', 'Dockerfile', 'GNUmakefile', 'Gemfile', 'Makefile', 'Rakefile', 'Vagrantfile', 'makefile'])
+
+
+_lexer_memo: Dict[Tuple[str, str], Any] = {}
+
+def guess_lexer(path: str, lines: List[str]) -> Any:
+  '''
+  Return the pygments lexer for a file, or None if the file should be rendered as plain text.
+  `guess_lexer_for_filename` only considers the file name and the text it is given (the first line),
+  so its results are memoized on exactly those.
+  '''
+  if is_plain_text(path, lines): return None
   first = lines[0] if lines else ''
-  lexer = pygments.lexers.guess_lexer_for_filename(f.name, first)
-  yield '<div class="code-block">'
-  for line in lines:
-    content = ''.join(render_token(ctx, *t) for t in pygments.lex(line, lexer))
-    yield f'<code class="line">{content}</code>'
-  yield '</div>'
-
-def render_token(ctx: Ctx, kind: pygments.token._TokenType, text: str) -> str:
-  class_, color = token_class_colors.get(kind, ('t', None))
-  if color is None: return text
-  ctx.add_css(f'code.line span.{class_}', style=f'color: {color}')
+  key = (path_name(path), first)
+  try: return _lexer_memo[key]
+  except KeyError: pass
+  import pygments.lexers # type: ignore
+  import pygments.lexers.special # type: ignore
+  import pygments.util # type: ignore
+  try: lexer = pygments.lexers.guess_lexer_for_filename(path, first, stripnl=False) # Keep leading and trailing blank lines.
+  except pygments.util.ClassNotFound: lexer = None
+  else:
+    if isinstance(lexer, pygments.lexers.special.TextLexer): lexer = None
+  if len(_lexer_memo) >= 1024: _lexer_memo.clear() # Bound memory when many distinct first lines are seen.
+  _lexer_memo[key] = lexer
+  return lexer
+
+
+def highlight_lines(lexer: Any, lines: List[str]) -> Highlighted:
+  '''
+  Render source lines with the given pygments lexer, or as escaped plain text if `lexer` is None.
+  The whole text is lexed in a single pass so that multiline tokens (strings, comments) are highlighted correctly;
+  the token stream is then split back into lines.
+  '''
+  css: List[CssRule] = []
+  html_lines = ['<div class="code-block">']
+  if lexer is None or not lines:
+    for line in lines:
+      if not line.endswith('\n'): line += '\n' # Match the lexer's `ensurenl` behavior.
+      html_lines.append(f'<code class="line">{html_esc(line)}</code>')
+  else:
+    import pygments
+    class_colors = token_class_colors()
+    parts: List[str] = []
+    for kind, text in pygments.lex(''.join(lines), lexer):
+      for piece in token_line_re.findall(text):
+        parts.append(piece if piece == '\n' else render_token(css, class_colors, kind, piece))
+        if piece.endswith('\n'):
+          html_lines.append(f'<code class="line">{"".join(parts)}</code>')
+          parts.clear()
+    if parts: # Only possible if the lexer was configured without `ensurenl`.
+      html_lines.append(f'<code class="line">{"".join(parts)}</code>')
+  html_lines.append('</div>')
+  return html_lines, css
+
+token_line_re = re.compile(r'[^\n]*\n|[^\n]+') # Split token text after each newline; unlike `splitlines`, ignore other line separators.
+
+def render_token(css: List[CssRule], class_colors: Dict[Any, Tuple[str, Optional[str]]], kind: Any, text: str) -> str:
+  class_, color = class_colors.get(kind, ('t', None))
+  if color is None: return html_esc(text)
+  rule = (f'code.line span.{class_}', f'color: {color}')
+  if rule not in css: css.append(rule)
   return f'<span class="{class_}">{html_esc(text)}</span>'
 
+
+class HighlightCache:
+  '''
+  A persistent cache of highlighted code, stored as one JSON file per entry.
+  Entries are keyed by the source text, the lexer and the token color table.
+  The lexer is represented by the inputs that determine it (the file name, the text and the pygments version),
+  so that a hit skips lexer resolution, which is itself expensive.
+  Reads bump the entry mtime, and writes evict the least recently used entries once the total size exceeds `max_size` bytes.
+  '''
+
+  format_version = 2 # Bump when the highlighted output format changes.
+
+  def __init__(self, dir: str, max_size: int) -> None:
+    self.dir = dir
+    self.max_size = max_size
+    self.size: Optional[int] = None # Estimated total size of entries; computed lazily on first write.
+
+  def key(self, path: str, lines: List[str]) -> str:
+    from hashlib import sha256
+    import pygments
+    h = sha256(f'{self.format_version}\0{pygments.__version__}\0{path_name(path)}\0{token_colors_digest()}\0'.encode())
+    for line in lines: h.update(line.encode())
+    return h.hexdigest()
+
+  def entry_path(self, key: str) -> str:
+    return path_join(self.dir, key + '.json')
+
+  def get(self, key: str) -> Optional[Highlighted]:
+    import json
+    from os import utime
+    path = self.entry_path(key)
+    try:
+      with open(path) as f:
+        html_lines, css = json.load(f)
+      utime(path) # Mark as recently used.
+    except (OSError, ValueError, TypeError): return None
+    return html_lines, [(selector, style) for selector, style in css]
+
+  def put(self, key: str, highlighted: Highlighted) -> None:
+    import json
+    from os import makedirs, replace
+    from threading import get_ident
+    path = self.entry_path(key)
+    tmp_path = f'{path}.{getpid()}.{get_ident()}.tmp' # Unique per thread, for renderers shared between threads.
+    try:
+      makedirs(self.dir, exist_ok=True)
+      with open(tmp_path, 'w') as f:
+        json.dump(highlighted, f)
+        entry_size = f.tell()
+      replace(tmp_path, path)
+    except OSError: return # The cache is an optimization; failing to write it is not an error.
+    if self.size is None: self.size = self.scan_size()
+    else: self.size += entry_size
+    if self.size > self.max_size: self.evict()
+
+  def scan_size(self) -> int:
+    from os import scandir
+    try: return sum(e.stat().st_size for e in scandir(self.dir) if e.name.endswith('.json'))
+    except OSError: return 0
+
+  def evict(self) -> None:
+    'Remove least recently used entries until the cache is at most three quarters of `max_size`.'
+    from os import remove, scandir
+    entries = []
+    for e in scandir(self.dir):
+      if not e.name.endswith('.json'): continue
+      try: st = e.stat()
+      except OSError: continue # Removed concurrently.
+      entries.append((st.st_mtime, st.st_size, e.path))
+    entries.sort()
+    size = sum(entry_size for _, entry_size, _ in entries)
+    goal = self.max_size * 3 // 4 # Evict in bulk so that steady-state writes do not rescan the directory every time.
+    for _, entry_size, path in entries:
+      if size <= goal: break
+      try: remove(path)
+      except OSError: pass
+      size -= entry_size
+    self.size = size
+
+
+_token_colors_digest: Optional[str] = None
+
+def token_colors_digest() -> str:
+  global _token_colors_digest
+  if _token_colors_digest is None:
+    from hashlib import sha256
+    table = sorted((str(kind), class_, str(color)) for kind, (class_, color) in token_class_colors().items())
+    _token_colors_digest = sha256(repr(table).encode()).hexdigest()
+  return _token_colors_digest
+
 def embed_direct(ctx: Ctx, f: TextIO) -> List[str]:
   return list(filter(None, (xml_processing_instruction_re.sub('', line.rstrip()) for line in f)))
 
@@ -871,7 +2587,65 @@ html_doc_re = re.compile(r'''(?xi)
 
 
 def embed_img(ctx: Ctx, f: TextIO) -> List[str]:
-  return [f'<img src={html_esc(f.name)}>']
+  '''
+  Emit the intrinsic size of the image so that the page does not reflow as it loads.
+  Small images are inlined as data URIs, saving a request each.
+  '''
+  from os import fstat
+  with open(f.name, 'rb') as fb:
+    size = image_size(fb)
+    fb.seek(0)
+    if fstat(fb.fileno()).st_size < ctx.env.inline_image_size:
+      src = image_data_uri(fb.read(), path=f.name)
+      loading = ''
+    else:
+      src = f.name
+      loading = ' loading="lazy"'
+  dims = '' if size is None else f' width="{size[0]}" height="{size[1]}"'
+  return [f'<img src="{html_esc_attr(src)}"{dims}{loading}>']
+
+
+def image_size(f: BinaryIO) -> Optional[Tuple[int, int]]:
+  'Read the (width, height) of a PNG, GIF or JPEG image from its header, or return None if the format is not recognized.'
+  from struct import unpack
+  head = f.read(26)
+  if head.startswith(b'\x89PNG\r\n\x1a\n') and head[12:16] == b'IHDR':
+    return cast(Tuple[int, int], unpack('>II', head[16:24]))
+  if head[:6] in (b'GIF87a', b'GIF89a'):
+    return cast(Tuple[int, int], unpack('<HH', head[6:10]))
+  if head.startswith(b'\xff\xd8'):
+    f.seek(2)
+    while True: # Walk the JPEG segments up to the start of frame, which holds the dimensions.
+      byte = f.read(1)
+      while byte == b'\xff': byte = f.read(1) # Skip the marker prefix and any fill bytes.
+      if not byte: return None
+      marker = byte[0]
+      if marker == 0x01 or 0xd0 <= marker <= 0xd9: continue # Markers without a segment.
+      length_bytes = f.read(2)
+      if len(length_bytes) < 2: return None
+      length = unpack('>H', length_bytes)[0]
+      if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc): # Start of frame (excluding DHT, JPG and DAC).
+        frame = f.read(5)
+        if len(frame) < 5: return None
+        height, width = unpack('>HH', frame[1:5])
+        return (width, height)
+      f.seek(length - 2, 1)
+  return None
+
+
+_data_uris: Dict[Tuple[str, str], str] = {} # Keyed by (mime type, content hash); shared by all renders in the process.
+
+def image_data_uri(data: bytes, path: str) -> str:
+  from base64 import b64encode
+  from hashlib import sha256
+  from mimetypes import guess_type
+  mime = guess_type(path)[0] or 'application/octet-stream'
+  key = (mime, sha256(data).hexdigest())
+  try: return _data_uris[key]
+  except KeyError: pass
+  if len(_data_uris) >= 1024: _data_uris.clear()
+  uri = _data_uris[key] = f'data:{mime};base64,{b64encode(data).decode()}'
+  return uri
 
 
 def embed_wu(ctx: Ctx, f: TextIO) -> List[str]:
@@ -880,8 +2654,10 @@ def embed_wu(ctx: Ctx, f: TextIO) -> List[str]:
     quote_depth=ctx.quote_depth,
     line_offset=0,
     is_versioned=True,
-    should_embed=ctx.should_embed)
+    should_embed=ctx.should_embed,
+    env=ctx.env)
   parse(embed_ctx, src_lines=enumerate(f))
+  ctx.absorb(embed_ctx)
   return list(embed_ctx.emit_html(depth=0))
 
 
@@ -921,6 +2697,23 @@ def html_for_spans(spans: Spans, depth: int) -> str:
   return ''.join(span.html(depth=depth) for span in spans).strip()
 
 
+def html_lines_for_spans(spans: Spans, depth: int) -> Iterator[str]:
+  '''
+  Equivalent to `indent(depth + 1, html_for_spans(spans, depth))`,
+  except that a line consisting of a single streamed embed is yielded line by line as the embedded file is read.
+  '''
+  streamed = [span for span in spans if isinstance(span, EmbedSpan) and span.stream]
+  if len(streamed) != 1 or any(span is not streamed[0] and (type(span) is not Span or span.text.strip()) for span in spans):
+    yield indent(depth + 1, html_for_spans(spans, depth=depth))
+    return
+  lines = streamed[0].html_lines(depth=depth)
+  prev = indent(depth + 1, next(lines).lstrip())
+  for line in lines:
+    yield prev
+    prev = line
+  yield prev.rstrip()
+
+
 def text_for_spans(spans: Spans) -> str:
   return ''.join(span.text for span in spans).strip()
 
@@ -932,7 +2725,7 @@ def indent(depth: int, *items: str) -> str:
 # Error reporting.
 
 def errSL(*items) -> None:
-  print(*items, file=stderr)
+  print(*items, file=sys.stderr) # Looked up per call so that batch workers can capture diagnostics.
 
 
 # CSS.
@@ -1129,8 +2922,63 @@ ul {
 
 # Javascript.
 
+js_token_re = re.compile(r'''(?xs)
+  (?P<space> \s+ )
+| (?P<comment> //[^\n]* | /\*.*?\*/ )
+| (?P<literal> '(?:[^'\\\n]|\\.)*' | "(?:[^"\\\n]|\\.)*" | `(?:[^`\\]|\\.)*` )
+| (?P<word> [\w$]+ )
+| (?P<other> . )
+''')
+
+js_regex_re = re.compile(r'/(?:[^/\\\[\n]|\\.|\[(?:[^\]\\\n]|\\.)*\])+/[\w$]*')
+
+# A slash begins a regular expression literal rather than a division after these tokens.
+js_regex_preceders = frozenset('(,=:[!&|?{};+-*%<>~^') | {'', 'return', 'typeof', 'case', 'do', 'else', 'in', 'instanceof',
+  'new', 'void', 'delete', 'throw', 'yield', 'await'}
+
+# A line break is kept if it falls between a token that can end a statement and one that can begin the next,
+# because removing it could change automatic semicolon insertion.
+js_line_enders = frozenset(')]}\'"`+-/')
+js_line_starters = frozenset('([{\'"`+-/!~')
+
+def is_js_word_char(c: str) -> bool:
+  return c.isalnum() or c == '_' or c == '$'
+
+
 def minify_js(js: str) -> str:
-  return js
+  '''
+  Remove comments and collapse whitespace in Javascript.
+  String, template and regular expression literals are copied verbatim.
+  '''
+  out: List[str] = []
+  prev = '' # The previous token.
+  space = '' # Whitespace skipped since `prev`: '', ' ' or '\n'.
+  pos = 0
+  while pos < len(js):
+    m = js_token_re.match(js, pos)
+    assert m
+    kind = m.lastgroup
+    text = m.group()
+    if text == '/' and kind == 'other' and prev in js_regex_preceders:
+      regex_m = js_regex_re.match(js, pos)
+      if regex_m: kind, text = 'literal', regex_m.group()
+    pos += len(text)
+    if kind == 'space' or kind == 'comment':
+      if '\n' in text: space = '\n'
+      elif not space: space = ' '
+      continue
+    if space and prev:
+      p = prev[-1]
+      c = text[0]
+      if space == '\n' and (is_js_word_char(p) or p in js_line_enders) and (is_js_word_char(c) or c in js_line_starters):
+        out.append('\n')
+      elif (is_js_word_char(p) and is_js_word_char(c)) or (p == c and c in '+-'):
+        out.append(' ')
+    space = ''
+    out.append(text)
+    prev = text
+  return ''.join(out)
+
 
 default_js = '''
 function scrollToElementId(id) {
@@ -1186,84 +3034,92 @@ red     = '#800000'
 yellow  = '#806000'
 green   = '#008000'
 
-token_class_colors = {
-  Token.Text                        : ('t',   None),
-  Token.Escape                      : ('esc', yellow),
-  Token.Error                       : ('err', red),
-  Token.Other                       : ('x',   black),
-  Token.Keyword                     : ('k',   magenta),
-  Token.Keyword.Constant            : ('kc',  black),
-  Token.Keyword.Declaration         : ('kd',  black),
-  Token.Keyword.Namespace           : ('kn',  magenta),
-  Token.Keyword.Pseudo              : ('kp',  black),
-  Token.Keyword.Reserved            : ('kr',  black),
-  Token.Keyword.Type                : ('kt',  black),
-  Token.Name                        : ('n',   black),
-  Token.Name.Attribute              : ('na',  black),
-  Token.Name.Builtin                : ('nb',  black),
-  Token.Name.Builtin.Pseudo         : ('bp',  black),
-  Token.Name.Class                  : ('nc',  black),
-  Token.Name.Constant               : ('no',  black),
-  Token.Name.Decorator              : ('nd',  black),
-  Token.Name.Entity                 : ('ni',  black),
-  Token.Name.Exception              : ('ne',  black),
-  Token.Name.Function               : ('nf',  black),
-  Token.Name.Function.Magic         : ('fm',  black),
-  Token.Name.Property               : ('py',  black),
-  Token.Name.Label                  : ('nl',  black),
-  Token.Name.Namespace              : ('nn',  black),
-  Token.Name.Other                  : ('nx',  black),
-  Token.Name.Tag                    : ('nt',  black),
-  Token.Name.Variable               : ('nv',  black),
-  Token.Name.Variable.Class         : ('vc',  black),
-  Token.Name.Variable.Global        : ('vg',  black),
-  Token.Name.Variable.Instance      : ('vi',  black),
-  Token.Name.Variable.Magic         : ('vm',  black),
-  Token.Literal                     : ('l',   black),
-  Token.Literal.Date                : ('ld',  green),
-  Token.Literal.String              : ('s',   green),
-  Token.Literal.String.Affix        : ('sa',  green),
-  Token.Literal.String.Backtick     : ('sb',  green),
-  Token.Literal.String.Char         : ('sc',  green),
-  Token.Literal.String.Delimiter    : ('dl',  green),
-  Token.Literal.String.Doc          : ('sd',  green),
-  Token.Literal.String.Double       : ('s2',  green),
-  Token.Literal.String.Escape       : ('se',  green),
-  Token.Literal.String.Heredoc      : ('sh',  green),
-  Token.Literal.String.Interpol     : ('si',  green),
-  Token.Literal.String.Other        : ('sx',  green),
-  Token.Literal.String.Regex        : ('sr',  green),
-  Token.Literal.String.Single       : ('s1',  green),
-  Token.Literal.String.Symbol       : ('ss',  green),
-  Token.Literal.Number              : ('m',   blue),
-  Token.Literal.Number.Bin          : ('mb',  blue),
-  Token.Literal.Number.Float        : ('mf',  blue),
-  Token.Literal.Number.Hex          : ('mh',  blue),
-  Token.Literal.Number.Integer      : ('mi',  blue),
-  Token.Literal.Number.Integer.Long : ('il',  blue),
-  Token.Literal.Number.Oct          : ('mo',  blue),
-  Token.Operator                    : ('o',   black),
-  Token.Operator.Word               : ('ow',  black),
-  Token.Punctuation                 : ('p',   black),
-  Token.Comment                     : ('c',   gray),
-  Token.Comment.Hashbang            : ('ch',  gray),
-  Token.Comment.Multiline           : ('cm',  gray),
-  Token.Comment.Preproc             : ('cp',  gray),
-  Token.Comment.PreprocFile         : ('cpf', gray),
-  Token.Comment.Single              : ('c1',  gray),
-  Token.Comment.Special             : ('cs',  gray),
-  Token.Generic                     : ('g',   black),
-  Token.Generic.Deleted             : ('gd',  black),
-  Token.Generic.Emph                : ('ge',  black),
-  Token.Generic.Error               : ('gr',  black),
-  Token.Generic.Heading             : ('gh',  black),
-  Token.Generic.Inserted            : ('gi',  black),
-  Token.Generic.Output              : ('go',  black),
-  Token.Generic.Prompt              : ('gp',  black),
-  Token.Generic.Strong              : ('gs',  black),
-  Token.Generic.Subheading          : ('gu',  black),
-  Token.Generic.Traceback           : ('gt',  orange),
-}
+_token_class_colors: Optional[Dict[Any, Tuple[str, Optional[str]]]] = None
+
+def token_class_colors() -> Dict[Any, Tuple[str, Optional[str]]]:
+  'Map pygments token types to (css class, color) pairs; built on first use.'
+  global _token_class_colors
+  if _token_class_colors is None:
+    from pygments.token import Token # type: ignore
+    _token_class_colors = {
+      Token.Text                        : ('t',   None),
+      Token.Escape                      : ('esc', yellow),
+      Token.Error                       : ('err', red),
+      Token.Other                       : ('x',   black),
+      Token.Keyword                     : ('k',   magenta),
+      Token.Keyword.Constant            : ('kc',  black),
+      Token.Keyword.Declaration         : ('kd',  black),
+      Token.Keyword.Namespace           : ('kn',  magenta),
+      Token.Keyword.Pseudo              : ('kp',  black),
+      Token.Keyword.Reserved            : ('kr',  black),
+      Token.Keyword.Type                : ('kt',  black),
+      Token.Name                        : ('n',   black),
+      Token.Name.Attribute              : ('na',  black),
+      Token.Name.Builtin                : ('nb',  black),
+      Token.Name.Builtin.Pseudo         : ('bp',  black),
+      Token.Name.Class                  : ('nc',  black),
+      Token.Name.Constant               : ('no',  black),
+      Token.Name.Decorator              : ('nd',  black),
+      Token.Name.Entity                 : ('ni',  black),
+      Token.Name.Exception              : ('ne',  black),
+      Token.Name.Function               : ('nf',  black),
+      Token.Name.Function.Magic         : ('fm',  black),
+      Token.Name.Property               : ('py',  black),
+      Token.Name.Label                  : ('nl',  black),
+      Token.Name.Namespace              : ('nn',  black),
+      Token.Name.Other                  : ('nx',  black),
+      Token.Name.Tag                    : ('nt',  black),
+      Token.Name.Variable               : ('nv',  black),
+      Token.Name.Variable.Class         : ('vc',  black),
+      Token.Name.Variable.Global        : ('vg',  black),
+      Token.Name.Variable.Instance      : ('vi',  black),
+      Token.Name.Variable.Magic         : ('vm',  black),
+      Token.Literal                     : ('l',   black),
+      Token.Literal.Date                : ('ld',  green),
+      Token.Literal.String              : ('s',   green),
+      Token.Literal.String.Affix        : ('sa',  green),
+      Token.Literal.String.Backtick     : ('sb',  green),
+      Token.Literal.String.Char         : ('sc',  green),
+      Token.Literal.String.Delimiter    : ('dl',  green),
+      Token.Literal.String.Doc          : ('sd',  green),
+      Token.Literal.String.Double       : ('s2',  green),
+      Token.Literal.String.Escape       : ('se',  green),
+      Token.Literal.String.Heredoc      : ('sh',  green),
+      Token.Literal.String.Interpol     : ('si',  green),
+      Token.Literal.String.Other        : ('sx',  green),
+      Token.Literal.String.Regex        : ('sr',  green),
+      Token.Literal.String.Single       : ('s1',  green),
+      Token.Literal.String.Symbol       : ('ss',  green),
+      Token.Literal.Number              : ('m',   blue),
+      Token.Literal.Number.Bin          : ('mb',  blue),
+      Token.Literal.Number.Float        : ('mf',  blue),
+      Token.Literal.Number.Hex          : ('mh',  blue),
+      Token.Literal.Number.Integer      : ('mi',  blue),
+      Token.Literal.Number.Integer.Long : ('il',  blue),
+      Token.Literal.Number.Oct          : ('mo',  blue),
+      Token.Operator                    : ('o',   black),
+      Token.Operator.Word               : ('ow',  black),
+      Token.Punctuation                 : ('p',   black),
+      Token.Comment                     : ('c',   gray),
+      Token.Comment.Hashbang            : ('ch',  gray),
+      Token.Comment.Multiline           : ('cm',  gray),
+      Token.Comment.Preproc             : ('cp',  gray),
+      Token.Comment.PreprocFile         : ('cpf', gray),
+      Token.Comment.Single              : ('c1',  gray),
+      Token.Comment.Special             : ('cs',  gray),
+      Token.Generic                     : ('g',   black),
+      Token.Generic.Deleted             : ('gd',  black),
+      Token.Generic.Emph                : ('ge',  black),
+      Token.Generic.Error               : ('gr',  black),
+      Token.Generic.Heading             : ('gh',  black),
+      Token.Generic.Inserted            : ('gi',  black),
+      Token.Generic.Output              : ('go',  black),
+      Token.Generic.Prompt              : ('gp',  black),
+      Token.Generic.Strong              : ('gs',  black),
+      Token.Generic.Subheading          : ('gu',  black),
+      Token.Generic.Traceback           : ('gt',  orange),
+    }
+  return _token_class_colors
 
 
 if __name__ == '__main__': main()